@@ -0,0 +1,82 @@
+from typing import Callable, Dict, Tuple
+
+from adhoccomputing.Experimentation.Topology import Topology
+
+from TORA.TORAComponent import ApplicationLayerTORA, TORAControlMessageTypes, TORAHeight, UpdateMessagePayload
+
+'''
+Aggregation of UPD broadcasts.
+Without an advertiser, every height change broadcasts an UPD at once. During a reversal cascade
+a node can go through several heights for a destination within a few milliseconds, and after
+a link change (ApplicationLayerTORA.link_up) it announces its height for every destination.
+With an AdvertisementScheduler set on the nodes, the first UPD of a node opens a window of
+window seconds. UPDs for the same destination within the window are merged, the last height
+wins and the link reversal flag is kept if any of the merged UPDs had it. When the window
+closes, the UPDs of all destinations go out as one message (a frame with TORAWireFormat), so a
+node sends at most one UPD message per window.
+
+A CLR or QRY of the node flushes the pending UPDs first, so that the neighbors see the packets
+of a destination in order. Windows need a scheduler, e.g.
+AdvertisementScheduler(schedule=simulation.scheduler.schedule) for a TORASimulation. Without
+one, every UPD is broadcast at once.
+
+Merged UPDs are counted as UPD.merged in the metrics (see TORAMetrics), UPD.sent keeps
+counting packets, so it shows how many UPDs were batched into the frames.
+'''
+class AdvertisementScheduler:
+    def __init__(self, window: float = 0.005, schedule: Callable = None):
+        self.window = window
+        self.schedule = schedule
+        # node -> destination -> (height, link_reversal) of the pending UPD
+        self.pending: Dict[int, Dict[int, Tuple[TORAHeight, bool]]] = {}
+        # UPD broadcasts requested by the nodes, UPDs merged into a later one, messages and packets sent
+        self.requested: int = 0
+        self.merged: int = 0
+        self.frames: int = 0
+        self.packets: int = 0
+
+    @property
+    def saved(self) -> int:
+        # Broadcasts saved by merging and batching, UPDs dropped by a reset of the node included
+        return self.requested - self.frames
+
+    def enqueue(self, app_layer: ApplicationLayerTORA, destination_id: int, height: TORAHeight, link_reversal: bool) -> bool:
+        # Returns False if the UPD has to be broadcast at once
+        if self.window <= 0 or self.schedule is None:
+            return False
+        self.requested += 1
+        pending = self.pending.get(app_layer.componentinstancenumber)
+        if pending is None:
+            pending = self.pending[app_layer.componentinstancenumber] = {}
+            self.schedule(self.window, self.window_closed, app_layer, pending)
+        previous = pending.get(destination_id)
+        if previous is not None:
+            self.merged += 1
+            link_reversal = link_reversal or previous[1]
+            if app_layer.metrics is not None:
+                app_layer.metrics.count("UPD.merged")
+        pending[destination_id] = (height, link_reversal)
+        return True
+
+    def window_closed(self, app_layer: ApplicationLayerTORA, pending: dict):
+        # The UPDs of this window may have been flushed already, by a CLR or QRY
+        if self.pending.get(app_layer.componentinstancenumber) is pending:
+            self.flush(app_layer)
+
+    def flush(self, app_layer: ApplicationLayerTORA):
+        pending = self.pending.pop(app_layer.componentinstancenumber, None)
+        if not pending:
+            return
+        # A node that was reset meanwhile forgot the destinations, their UPDs are dropped
+        payloads = [UpdateMessagePayload(destination_id, height, link_reversal)
+                    for destination_id, (height, link_reversal) in pending.items() if destination_id in app_layer.destinations]
+        if payloads:
+            self.frames += 1
+            self.packets += len(payloads)
+            app_layer.broadcaster.broadcast_batch(TORAControlMessageTypes.UPD, payloads)
+
+
+def use_advertisement_scheduler(topo: Topology, advertiser: AdvertisementScheduler = None):
+    # One AdvertisementScheduler serves all nodes of topo, None broadcasts every UPD at once again
+    for node in topo.nodes:
+        topo.nodes[node].app_layer.advertiser = advertiser
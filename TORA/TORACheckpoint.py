@@ -0,0 +1,180 @@
+import gc
+import mmap
+import struct
+
+import numpy as np
+
+from adhoccomputing.Experimentation.Topology import Topology
+
+from TORA.TORAComponent import TORAHeight
+
+'''
+Checkpoints of the routing state of all nodes.
+A checkpoint holds, for every node and destination, the height, the route-required flag, the
+time of the last UPD and the heights of the neighbors with the times their links became
+active. Restoring it into a topology built from the same graph (Topology, TORATopology or
+TORASimulation) replaces the route creation before a maintenance experiment, like
+ReferenceSolution.seed_heights, but for any state, e.g. one reached by a long run.
+
+The file is a 48 byte header followed by two packed record arrays, one record per
+(node, destination) state and one per neighbor entry, in the order of the states:
+    header      magic, version, state count, neighbor count, saved_at, highest tau
+    state       node, destination, height, flags, last_update, number of neighbor entries and
+                of the non-NULL ones among them
+    neighbor    neighbor, height, flags, activated, the non-NULL heights first and sorted
+Heights are stored as (tau, oid, r, delta), i is the node or the neighbor. load maps the file
+into memory, the records are read in place when a topology is restored.
+
+Link timestamps (last_update, activated) are read from the node clocks, which differ between
+runs. They are stored relative to saved_at, the clock time at saving, and restored relative to
+the clock time at restoring, which keeps their order. Reference levels (tau) are restored as
+saved. Reference levels defined after the restore must be higher than all of them, so restore
+first moves every node clock past the highest tau (see advance_past in TORAClock). Logical and
+simulated clocks can be moved, a physical clock that is behind makes restore raise ValueError.
+'''
+HEADER = struct.Struct("<8sqqqdd")
+MAGIC = b"TORACKPT"
+VERSION = 2
+
+FLAG_NULL = 0x01
+FLAG_ROUTE_REQUIRED = 0x02
+
+STATE_RECORD = np.dtype([
+    ("node", "<i4"), ("destination", "<i4"),
+    ("tau", "<f8"), ("oid", "<i4"), ("r", "u1"), ("delta", "<i4"), ("flags", "u1"),
+    ("last_update", "<f8"), ("neighbor_count", "<i4"), ("indexed_count", "<i4"),
+])
+NEIGHBOR_RECORD = np.dtype([
+    ("neighbor", "<i4"),
+    ("tau", "<f8"), ("oid", "<i4"), ("r", "u1"), ("delta", "<i4"), ("flags", "u1"),
+    ("activated", "<f8"),
+])
+
+def reference_clock(topo: Topology):
+    # Clock the timestamps are relative to, the clock of the node with the lowest id
+    return topo.nodes[min(topo.nodes)].app_layer.clock
+
+
+class Checkpoint:
+    def __init__(self, states: np.ndarray, neighbors: np.ndarray, saved_at: float, max_tau: float = None):
+        self.states = states
+        self.neighbors = neighbors
+        self.saved_at = saved_at
+        if max_tau is None:
+            max_tau = highest_tau(states, neighbors)
+        self.max_tau = max_tau
+
+    @classmethod
+    def from_topology(cls, topo: Topology) -> "Checkpoint":
+        saved_at = reference_clock(topo).now()
+        state_rows = []
+        neighbor_rows = []
+        for node in sorted(topo.nodes):
+            for destination_id, state in topo.nodes[node].app_layer.destinations.items():
+                height = state.height
+                flags = (FLAG_NULL if height.is_null else 0) | (FLAG_ROUTE_REQUIRED if state.route_required else 0)
+                state_rows.append((node, destination_id, *height_fields(height), flags, state.last_update - saved_at, len(state.neighbor_heights), len(state.link_index)))
+                # Non-NULL heights first, in the order of the link-state index, so it needs no sorting on restore
+                for neighbor_height in state.link_index:
+                    neighbor_rows.append((neighbor_height.i, *height_fields(neighbor_height), 0, state.neighbor_heights[neighbor_height.i][1] - saved_at))
+                for neighbor, (neighbor_height, activated) in state.neighbor_heights.items():
+                    if neighbor_height.is_null:
+                        neighbor_rows.append((neighbor, *height_fields(neighbor_height), FLAG_NULL, activated - saved_at))
+        return cls(np.array(state_rows, dtype=STATE_RECORD), np.array(neighbor_rows, dtype=NEIGHBOR_RECORD), saved_at)
+
+    @classmethod
+    def empty(cls) -> "Checkpoint":
+        return cls(np.zeros(0, dtype=STATE_RECORD), np.zeros(0, dtype=NEIGHBOR_RECORD), 0.0)
+
+    def save(self, path: str) -> int:
+        # Returns the size of the file in bytes
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, VERSION, len(self.states), len(self.neighbors), self.saved_at, self.max_tau))
+            file.write(self.states.tobytes())
+            file.write(self.neighbors.tobytes())
+            return file.tell()
+
+    @classmethod
+    def load(cls, path: str) -> "Checkpoint":
+        with open(path, "rb") as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, state_count, neighbor_count, saved_at, max_tau = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a TORA checkpoint (version {VERSION})")
+        states = np.frombuffer(buffer, dtype=STATE_RECORD, count=state_count, offset=HEADER.size)
+        neighbors = np.frombuffer(buffer, dtype=NEIGHBOR_RECORD, count=neighbor_count, offset=HEADER.size + states.nbytes)
+        return cls(states, neighbors, saved_at, max_tau)
+
+    def restore(self, topo: Topology):
+        '''
+        Replaces the state of every node and destination in the checkpoint. topo must be built
+        from the same graph, or at least keep every link a neighbor entry refers to.
+        '''
+        clocks = {}
+        for node in np.unique(self.states["node"]).tolist():
+            if node not in topo.nodes:
+                raise ValueError(f"Node {node} of the checkpoint is not in the topology")
+            clock = topo.nodes[node].app_layer.clock
+            clocks.setdefault(id(clock), (node, clock))
+        for node, clock in clocks.values():
+            if not clock.advance_past(self.max_tau):
+                raise ValueError(f"The clock of node {node} is at {clock.now()}, behind the reference levels of the checkpoint (up to {self.max_tau})")
+
+        # Restoring creates a few objects per neighbor entry and no garbage, collections would only slow it down
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self.restore_states(topo)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def restore_states(self, topo: Topology):
+        offset = reference_clock(topo).now() - self.saved_at
+        nodes = self.states["node"].tolist()
+        destinations = self.states["destination"].tolist()
+        heights = record_heights(self.states, nodes)
+        route_required = ((self.states["flags"] & FLAG_ROUTE_REQUIRED) != 0).tolist()
+        last_updates = (self.states["last_update"] + offset).tolist()
+        neighbor_ids = self.neighbors["neighbor"].tolist()
+        entry_heights = record_heights(self.neighbors, neighbor_ids)
+        activated = (self.neighbors["activated"] + offset).tolist()
+
+        start = 0
+        indexed_counts = self.states["indexed_count"].tolist()
+        for k, count in enumerate(self.states["neighbor_count"].tolist()):
+            node = nodes[k]
+            app_layer = topo.nodes[node].app_layer
+            end = start + count
+            entries = {neighbor_ids[j]: (entry_heights[j], activated[j]) for j in range(start, end)}
+            unknown = entries.keys() - set(app_layer.neighbors)
+            if unknown:
+                raise ValueError(f"Links from node {node} to {sorted(unknown)} of the checkpoint are not in the topology")
+            app_layer.state(destinations[k]).restore(heights[k], route_required[k], last_updates[k], entries, entry_heights[start:start + indexed_counts[k]])
+            start = end
+
+
+def highest_tau(states: np.ndarray, neighbors: np.ndarray) -> float:
+    # Highest tau of the non-NULL heights, -inf without any
+    taus = [records["tau"][(records["flags"] & FLAG_NULL) == 0] for records in (states, neighbors)]
+    return max((float(tau.max()) for tau in taus if len(tau)), default=float('-inf'))
+
+def height_fields(height: TORAHeight) -> tuple:
+    if height.is_null:
+        return 0.0, 0, 0, 0
+    return height.tau, height.oid, height.r, height.delta
+
+def record_heights(records: np.ndarray, ids: list) -> list:
+    # TORAHeights of a record array, built from whole columns
+    heights = list(map(TORAHeight._make, zip(records["tau"].tolist(), records["oid"].tolist(), records["r"].tolist(), records["delta"].tolist(), ids)))
+    for k in np.flatnonzero(records["flags"] & FLAG_NULL).tolist():
+        heights[k] = TORAHeight.null(ids[k])
+    return heights
+
+def save_checkpoint(topo: Topology, path: str) -> int:
+    return Checkpoint.from_topology(topo).save(path)
+
+def restore_checkpoint(topo: Topology, path: str) -> Checkpoint:
+    checkpoint = Checkpoint.load(path)
+    checkpoint.restore(topo)
+    return checkpoint
@@ -0,0 +1,122 @@
+import time
+
+'''
+Clock sources for ApplicationLayerTORA.
+TORA reads the clock to stamp new reference levels (tau), link activation times and the time
+of the last UPD broadcast. Reference levels must be ordered in time, so the clock must never
+go backwards, and a reference level defined after another one was seen must be higher. Every
+clock has:
+    now()               the current time
+    witness(tau)        called with the tau of every received reference level. Logical clocks
+                        move past it, SimulatedClock counts the taus that are ahead of now() in
+                        `ahead`: reference levels it defines next would be lower than those.
+                        The clocks that follow a time source ignore it, the default clock is
+                        shared by the threads of all nodes and witness is on the path of every UPD
+    advance_past(tau)   moves the clock past tau if it can, e.g. before restoring a checkpoint
+                        (see TORACheckpoint), returns False if the clock is behind and can not move
+Benchmark timings (ActivityRecorder, ThroughputRecorder) stay on wall-clock time.
+'''
+class PhysicalClock:
+    # Base of the clocks that follow a time source and can not be moved forward
+    def now(self) -> float:
+        raise NotImplementedError
+
+    def witness(self, tau: float):
+        pass
+
+    def advance_past(self, tau: float) -> bool:
+        return self.now() > tau
+
+
+class MonotonicClock(PhysicalClock):
+    # Default clock, time.monotonic() can not go backwards and is shared by all processes of a host
+    def now(self) -> float:
+        return time.monotonic()
+
+
+class WallClock(PhysicalClock):
+    # time.time(), the clock used before clocks were pluggable. It can jump back when the system time is set.
+    def now(self) -> float:
+        return time.time()
+
+
+class LamportClock:
+    '''
+    Logical clock of one node. Every reading is larger than all earlier readings and all
+    witnessed reference levels, so a reference level defined after another one was seen
+    is always higher. Give every node its own instance (see use_clock).
+    '''
+    def __init__(self):
+        self.counter: int = 0
+
+    def now(self) -> float:
+        self.counter += 1
+        return float(self.counter)
+
+    def witness(self, tau: float):
+        if tau > self.counter:
+            self.counter = int(tau)
+
+    def advance_past(self, tau: float) -> bool:
+        self.witness(tau)
+        return True
+
+
+class SimulatedClock(PhysicalClock):
+    '''
+    Time of a discrete-event scheduler (see TORASimulation). Runs with the same seed stamp
+    the same reference levels, which makes them reproducible.
+    advance_past moves the clock by an offset and leaves the scheduler time alone, so events
+    that are scheduled at absolute times (e.g. a Workload) still happen when they should.
+    '''
+    def __init__(self, scheduler, offset: float = 0.0):
+        self.scheduler = scheduler
+        self.offset = offset
+        # A simulation runs in one thread, so the clock of all nodes can keep these
+        self.ahead: int = 0
+        self.latest_witnessed: float = float('-inf')
+
+    def now(self) -> float:
+        return self.scheduler.now + self.offset
+
+    def witness(self, tau: float):
+        if tau > self.latest_witnessed:
+            self.latest_witnessed = tau
+        if tau > self.now():
+            self.ahead += 1
+
+    def advance_past(self, tau: float) -> bool:
+        now = self.now()
+        if now <= tau:
+            # The next reference level is a second above tau
+            self.offset += tau - now + 1.0
+        return True
+
+
+class ReplayClock:
+    # Returns recorded timestamps in order, for replaying a trace. Falls back to `after` once they run out.
+    def __init__(self, timestamps, after=None):
+        self.timestamps = iter(timestamps)
+        self.after = after or MonotonicClock()
+
+    def now(self) -> float:
+        timestamp = next(self.timestamps, None)
+        return self.after.now() if timestamp is None else timestamp
+
+    def witness(self, tau: float):
+        self.after.witness(tau)
+
+    def advance_past(self, tau: float) -> bool:
+        # The recorded timestamps are replayed as they are, only the fallback clock can move
+        return self.after.advance_past(tau)
+
+
+MONOTONIC_CLOCK = MonotonicClock()
+
+def use_clock(topo, clock=None, factory=None):
+    '''
+    Sets the clock of every node of topo: either one shared clock, or factory() per node
+    (e.g. use_clock(topo, factory=LamportClock)).
+    '''
+    for node in topo.nodes:
+        topo.nodes[node].app_layer.clock = factory() if factory is not None else (clock or MONOTONIC_CLOCK)
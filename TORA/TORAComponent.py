@@ -1,51 +1,102 @@
 import time
+from bisect import bisect_left, insort
 from enum import Enum
 from threading import Lock
 import threading
-from typing import Dict, Tuple, List
+from typing import Dict, Iterable, Tuple, List, NamedTuple
+
+import networkx as nx
 
 from adhoccomputing.Experimentation.Topology import Topology
 from adhoccomputing.GenericModel import GenericModel
-from adhoccomputing.Generics import ConnectorTypes, Event, EventTypes
+from adhoccomputing.Generics import ConnectorTypes, Event, EventTypes, MessageDestinationIdentifiers
 from adhoccomputing.Networking.LinkLayer.GenericLinkLayer import GenericLinkLayer
-from adhoccomputing.Networking.NetworkLayer.GenericNetworkLayer import GenericNetworkLayer
+from adhoccomputing.Networking.NetworkLayer.GenericNetworkLayer import GenericNetworkLayer, NetworkLayerMessageHeader, NetworkLayerMessageTypes
 
 # Types
 from adhoccomputing.Generics import GenericMessage, GenericMessageHeader, GenericMessagePayload
 
+from TORA.TORAClock import MONOTONIC_CLOCK
+
 '''
 The functions and variables below are used in tests. 
 Since Topology uses daemon threads, it is better to keep them here.
 '''
-INITIAL_TIME = float('inf')
-BENCHMARK_TIME_LOCK: Lock = Lock()
-BENCHMARK_TIME: float = float('inf')
+# Set by a node when it runs out of work, wakes up wait_for_action_to_complete
+ACTIVITY_EVENT: threading.Event = threading.Event()
 
-def all_edges(topo: Topology):
+def all_edges(topo: Topology, destination_id: int = None):
     edges = []
     for node in topo.nodes:
-        downstream_links = topo.nodes[node].app_layer.find_downstream_links()
+        downstream_links = topo.nodes[node].app_layer.find_downstream_links(destination_id)
 
         for i in list(downstream_links):
             edges.append((node, i))
 
     return edges
 
-def heights(topo: Topology):
+def heights(topo: Topology, destination_id: int = None):
     heights = []
     for node in topo.nodes:
-        heights.append((node, topo.nodes[node].app_layer.height.delta))
+        heights.append((node, topo.nodes[node].app_layer.state(destination_id).height.delta))
     return heights
 
-def wait_for_action_to_complete():
-    while time.time() - 0.25 < BENCHMARK_TIME:
-        time.sleep(0.25)
-    return BENCHMARK_TIME
+def set_forwarding_mode(topo: Topology, mode):
+    for node in topo.nodes:
+        topo.nodes[node].app_layer.forwarding_mode = mode
 
+def link_utilization(topo: Topology) -> Dict[Tuple[int, int], int]:
+    # Data packets sent over each directed link (node, neighbor)
+    utilization = {}
+    for node in topo.nodes:
+        for neighbor, packets in topo.nodes[node].app_layer.link_utilization.items():
+            utilization[(node, neighbor)] = packets
+    return utilization
+
+def goodput(topo: Topology):
+    '''
+    Returns (bytes, seconds, bytes per second) of the data delivered to destinations, from the
+    first frame sent to the last frame received anywhere in the topology.
+    '''
+    recorders = [topo.nodes[node].app_layer.throughput for node in list(topo.nodes)]
+    delivered = sum(recorder.bytes_received for recorder in recorders)
+    started = min(recorder.first_sent for recorder in recorders)
+    finished = max(recorder.last_received for recorder in recorders)
+    seconds = finished - started if delivered else 0.0
+    return delivered, seconds, (delivered / seconds if seconds > 0 else 0.0)
+
+def count_messages(topo: Topology):
+    '''
+    Returns the (sent, received) TORA message totals of the topology.
+    The received counters are summed first: every counter only grows and a node counts a message
+    as received after it has counted everything it sent while handling it, so if both sums are
+    equal there was a moment when no message was in flight.
+    '''
+    recorders = [topo.nodes[node].app_layer.recorder for node in list(topo.nodes)]
+    received = sum(recorder.messages_received for recorder in recorders)
+    sent = sum(recorder.messages_sent for recorder in recorders)
+    return sent, received
+
+def last_activity(topo: Topology) -> float:
+    # Time the last message was handled anywhere in the topology
+    return max(topo.nodes[node].app_layer.recorder.last_activity for node in list(topo.nodes))
+
+def wait_for_action_to_complete(topo: Topology, timeout: float = None):
+    '''
+    Blocks until no TORA message is in flight and returns the time the last message was handled.
+    Nodes wake this function up whenever they become idle, so there is no polling interval.
+    '''
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        ACTIVITY_EVENT.clear()
+        sent, received = count_messages(topo)
+        if sent == received:
+            return last_activity(topo)
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError(f"{sent - received} TORA messages are still in flight")
+        ACTIVITY_EVENT.wait(remaining)
 
-def set_benchmark_time():
-    global BENCHMARK_TIME
-    BENCHMARK_TIME = INITIAL_TIME
 
 '''
 TORA starts here.
@@ -53,22 +104,39 @@ TORA starts here.
     - TORAHeight -> Keeps the height of TORA nodes: (tau, oid, r, delta, i) quintuple
     - ReferenceLevel -> (tau, oid, r) tuple
 2. TORA control messages -> Types, and payload definitions.
-3. ApplicationLayerTORA -> This class implements all the functionalities for TORA to work.
-4. TORANode -> A node in ad-hoc network that has application layer, network layer, etc.
+3. DestinationState -> The routing state a node keeps for one destination.
+4. ApplicationLayerTORA -> This class implements all the functionalities for TORA to work.
+5. TORANetworkLayer -> Network layer that passes TORA broadcasts down as link-layer broadcasts.
+6. TORANode -> A node in ad-hoc network that has application layer, network layer, etc.
 '''
-class TORAHeight:
-    def __init__(self, tau: float, oid: int, r: int, delta: int, i: int):
-        self.tau = tau
-        self.oid = oid
-        self.r = r
-        self.delta = delta
-        self.i = i
-
-class ReferenceLevel:
-    def __init__(self, tau: float, oid: int, r: int):
-        self.tau = tau
-        self.oid = oid
-        self.r = r
+class ReferenceLevel(NamedTuple):
+    tau: float
+    oid: int
+    r: int
+
+class TORAHeight(NamedTuple):
+    '''
+    Immutable height quintuple. Heights are plain tuples, so they compare lexicographically
+    on (tau, oid, r, delta, i) and can be used as dict and heap keys.
+    A NULL height has every field but i set to None and must not be ordered against other heights.
+    '''
+    tau: float
+    oid: int
+    r: int
+    delta: int
+    i: int
+
+    @classmethod
+    def null(cls, i: int) -> "TORAHeight":
+        return cls(None, None, None, None, i)
+
+    @property
+    def is_null(self) -> bool:
+        return self.delta is None
+
+    @property
+    def reference_level(self) -> ReferenceLevel:
+        return ReferenceLevel(self.tau, self.oid, self.r)
 
 # TORA message types & payloads
 class TORAControlMessageTypes(Enum):
@@ -93,68 +161,426 @@ class UpdateMessagePayload(GenericMessagePayload):
         self.height = height
         self.link_reversal = link_reversal
 
+class ControlBatchPayload(GenericMessagePayload):
+    # Several control packets sent as one message, as (messagetype, source_id, payload) triples
+    def __init__(self, messages: list):
+        self.messages = messages
+
 class ArbitraryMessagePayload(GenericMessagePayload):
-    def __init__(self, destination_id: int, message):
+    '''
+    A single data payload. The message (bytes, bytearray, memoryview or str) is never copied
+    or encoded on the way, its size in bytes is taken once when the payload is created.
+    '''
+    def __init__(self, destination_id: int, message, source_id: int = None, flow_id: int = 0, size: int = None):
         self.destination_id = destination_id
         self.message = message
+        # Used by ForwardingModes.FLOW_HASH to keep the packets of a flow on one path
+        self.source_id = source_id
+        self.flow_id = flow_id
+        self.size = payload_size(message) if size is None else size
+
+class DataFramePayload(GenericMessagePayload):
+    '''
+    Several data payloads of one stream, forwarded hop by hop as a single packet.
+    size is the sum of the payload sizes, last marks the final frame of the stream.
+    '''
+    def __init__(self, destination_id: int, source_id: int, stream_id: int, sequence: int, payloads: list, size: int, last: bool, flow_id: int = 0):
+        self.destination_id = destination_id
+        self.source_id = source_id
+        self.stream_id = stream_id
+        self.sequence = sequence
+        self.payloads = payloads
+        self.size = size
+        self.last = last
+        self.flow_id = flow_id
+
+def payload_size(payload) -> int:
+    if isinstance(payload, memoryview):
+        return payload.nbytes
+    if isinstance(payload, str):
+        return len(payload.encode())
+    return len(payload)
+
+DEFAULT_MTU = 1500
+
+# How a node picks the next hop of a data packet among its downstream neighbors
+class ForwardingModes(Enum):
+    SINGLE_PATH = "SINGLE_PATH"     # always the minimum height neighbor
+    ROUND_ROBIN = "ROUND_ROBIN"     # packet by packet over all downstream neighbors
+    FLOW_HASH = "FLOW_HASH"         # hash of (source, destination, flow id), a flow stays on one path
+    LEAST_USED = "LEAST_USED"       # the downstream link that carried the fewest packets so far
+
+# Per-node instrumentation, only ever written by the node that owns it
+class ActivityRecorder:
+    __slots__ = ("first_activity", "last_activity", "messages_sent", "messages_received", "bytes_sent")
+
+    def __init__(self):
+        self.first_activity: float = float('inf')
+        self.last_activity: float = float('-inf')
+        self.messages_sent: int = 0
+        self.messages_received: int = 0
+        # Only counted for encoded control packets (see TORAWireFormat)
+        self.bytes_sent: int = 0
+
+    def message_handled(self):
+        now = time.time()
+        if self.messages_received == 0:
+            self.first_activity = now
+        self.last_activity = now
+        self.messages_received += 1
+
+# Data plane counters of a node, only written by the node that owns it
+class ThroughputRecorder:
+    __slots__ = ("frames_sent", "payloads_sent", "bytes_sent", "frames_received", "payloads_received", "bytes_received", "first_sent", "last_received")
+
+    def __init__(self):
+        self.frames_sent: int = 0
+        self.payloads_sent: int = 0
+        self.bytes_sent: int = 0
+        self.frames_received: int = 0
+        self.payloads_received: int = 0
+        self.bytes_received: int = 0
+        self.first_sent: float = float('inf')
+        self.last_received: float = float('-inf')
+
+    def sent(self, payloads: int, size: int):
+        if self.frames_sent == 0:
+            self.first_sent = time.time()
+        self.frames_sent += 1
+        self.payloads_sent += payloads
+        self.bytes_sent += size
+
+    def received(self, payloads: int, size: int):
+        self.last_received = time.time()
+        self.frames_received += 1
+        self.payloads_received += payloads
+        self.bytes_received += size
+
+# Reassembles the frames of one received stream in sequence order
+class StreamReassembly:
+    __slots__ = ("next_sequence", "pending", "payloads", "complete")
+
+    def __init__(self):
+        self.next_sequence: int = 0
+        self.pending: Dict[int, DataFramePayload] = {}
+        self.payloads: list = []
+        self.complete: bool = False
+
+    def add(self, frame: DataFramePayload):
+        # With multipath forwarding frames may overtake each other, later frames wait in pending
+        if frame.sequence != self.next_sequence:
+            self.pending[frame.sequence] = frame
+            return
+        while frame is not None:
+            self.payloads.extend(frame.payloads)
+            self.complete = frame.last
+            self.next_sequence += 1
+            frame = self.pending.pop(self.next_sequence, None)
+
+# Routing state a node keeps for one destination
+class DestinationState:
+    '''
+    Besides the height array, the state keeps a link-state index: all non-NULL neighbor heights
+    in sorted order. Links to neighbors lower than our own height are downstream, the rest are
+    upstream, so both sets are a slice of the index and the minimum downstream neighbor is its
+    first entry. The index is only touched when a neighbor height changes.
+    Any change of the own or a neighbor height drops the destination from the forwarding table
+    of the node, so the cached next hop is recomputed on the next data packet.
+    '''
+    __slots__ = ("_height", "route_required", "last_update", "neighbor_heights", "link_index", "destination_id", "forwarding_table")
+
+    def __init__(self, componentinstancenumber: int, destination_id: int = None, forwarding_table: Dict[int, Tuple[int, ...]] = None):
+        self._height: TORAHeight = TORAHeight.null(componentinstancenumber)
+        self.route_required: bool = False
+        self.last_update = 0
+        self.neighbor_heights: Dict[int, Tuple[TORAHeight, int]] = {}
+        self.link_index: List[TORAHeight] = []
+        self.destination_id = destination_id
+        self.forwarding_table = forwarding_table
+
+    @property
+    def height(self) -> TORAHeight:
+        return self._height
+
+    @height.setter
+    def height(self, height: TORAHeight):
+        self._height = height
+        if self.forwarding_table is not None:
+            self.forwarding_table.pop(self.destination_id, None)
+
+    def set_neighbor_height(self, neighbor: int, height: TORAHeight, timestamp):
+        previous = self.neighbor_heights.get(neighbor)
+        if previous is not None and not previous[0].is_null:
+            del self.link_index[bisect_left(self.link_index, previous[0])]
+        if not height.is_null:
+            insort(self.link_index, height)
+        self.neighbor_heights[neighbor] = (height, timestamp)
+        if self.forwarding_table is not None:
+            self.forwarding_table.pop(self.destination_id, None)
+
+    def restore(self, height: TORAHeight, route_required: bool, last_update, neighbor_heights: Dict[int, Tuple[TORAHeight, int]], link_index: List[TORAHeight] = None):
+        # Replaces the whole state at once. The index is sorted once instead of one insort per neighbor,
+        # or taken as given when the caller has the non-NULL heights in order already (see TORACheckpoint).
+        self.height = height
+        self.route_required = route_required
+        self.last_update = last_update
+        self.neighbor_heights = neighbor_heights
+        if link_index is None:
+            link_index = sorted(height for height, _ in neighbor_heights.values() if not height.is_null)
+        self.link_index = link_index
+
+    def remove_neighbor(self, neighbor: int):
+        previous = self.neighbor_heights.pop(neighbor, None)
+        if previous is not None and not previous[0].is_null:
+            del self.link_index[bisect_left(self.link_index, previous[0])]
+        if self.forwarding_table is not None:
+            self.forwarding_table.pop(self.destination_id, None)
+
+    # A node with a NULL height treats every non-NULL neighbor as both downstream and upstream
+    def downstream_count(self) -> int:
+        if self._height.is_null:
+            return len(self.link_index)
+        return bisect_left(self.link_index, self._height)
+
+    def downstream_neighbors(self) -> List[int]:
+        return [height.i for height in self.link_index[:self.downstream_count()]]
+
+    def upstream_start(self) -> int:
+        if self._height.is_null:
+            return 0
+        return bisect_left(self.link_index, self._height)
+
+    def upstream_count(self) -> int:
+        return len(self.link_index) - self.upstream_start()
+
+    def upstream_neighbors(self) -> List[int]:
+        return [height.i for height in self.link_index[self.upstream_start():]]
+
+    def minimum_downstream_neighbor(self) -> int:
+        if self.downstream_count() == 0:
+            return None
+        return self.link_index[0].i
 
 # The Application Layer for TORA
 class ApplicationLayerTORA(GenericModel):
-    def __init__(self, componentname, componentinstancenumber, topology: Topology):
+    def __init__(self, componentname, componentinstancenumber, topology: Topology, num_worker_threads=1):
         '''
-        Each node i requires:
+        Each node i requires, per destination:
         - Height
         - Route-required flag
         - Time of the last update (last time UPD was broadcast)
         - Time when each link (i, j) became active
+        The per-destination entries are created lazily, when the first packet for a destination arrives.
         '''
-        super().__init__(componentname, componentinstancenumber, topology=topology)
+        super().__init__(componentname, componentinstancenumber, num_worker_threads=num_worker_threads, topology=topology)
         self.neighbors = topology.get_neighbors(componentinstancenumber)
-        self.height: TORAHeight = TORAHeight(None, None, None, None, self.componentinstancenumber)
-        self.last_update = 0
-        self.route_required: bool = False
-        self.neighbor_heights: Dict[int, Tuple[TORAHeight, int]] = {}
+        self.destinations: Dict[int, DestinationState] = {}
+        # The first destination this node has seen, used when no destination is given
+        self.default_destination_id = None
+        self.recorder: ActivityRecorder = ActivityRecorder()
+        self.broadcaster = self.Broadcaster(self)
+        # Wire codec for control packets (see TORAWireFormat), None sends payload objects
+        self.codec = None
+        # NodeMetrics of this node (see TORAMetrics), None records nothing
+        self.metrics = None
+        # Time source for reference levels and link timestamps (see TORAClock)
+        self.clock = MONOTONIC_CLOCK
+        # Decides on QRY rebroadcasts (see TORAFloodControl), None floods every QRY
+        self.flood_control = None
+        # Merges and batches UPD broadcasts (see TORAAdvertisement), None broadcasts every UPD at once
+        self.advertiser = None
+        # Data plane: downstream neighbors per destination (lowest first), kept up to date by DestinationState
+        self.forwarding_table: Dict[int, Tuple[int, ...]] = {}
+        self.forwarding_mode: ForwardingModes = ForwardingModes.SINGLE_PATH
+        self.round_robin: Dict[int, int] = {}
+        # Data packets sent over the link to each neighbor
+        self.link_utilization: Dict[int, int] = {}
+        # Print every data packet that is forwarded or delivered
+        self.log_data_plane = False
+        # Streams (see send_stream): frames are filled up to mtu bytes of payload
+        self.mtu: int = DEFAULT_MTU
+        self.next_stream_id: int = 0
+        self.streams: Dict[Tuple[int, int], StreamReassembly] = {}
+        self.throughput: ThroughputRecorder = ThroughputRecorder()
         self.lock: Lock = Lock()
 
     def on_init(self, eventobj: Event):
         pass
+
+    def state(self, destination_id: int = None) -> DestinationState:
+        if destination_id is None:
+            destination_id = self.default_destination_id
+            if destination_id is None:
+                return DestinationState(self.componentinstancenumber)
+
+        state = self.destinations.get(destination_id)
+        if state is None:
+            state = DestinationState(self.componentinstancenumber, destination_id, self.forwarding_table)
+            self.destinations[destination_id] = state
+            if self.default_destination_id is None:
+                self.default_destination_id = destination_id
+        return state
     
     # When node gets message
     def on_message_from_bottom(self, eventobj: Event):
-        # print("HEELP", self.componentinstancenumber)
-        self.update_time()
         with self.lock:
-            try:
-                message = eventobj.eventcontent
-                header = message.header
-                payload: GenericMessagePayload = message.payload
-                if header.messagetype == TORAControlMessageTypes.QRY:
-                    # print("GOT QRY")
-                    # print(payload.)
-                    self.process_query_message(payload.destination_id, header.messagefrom)
-                elif header.messagetype == TORAControlMessageTypes.UPD:
-                    self.process_update_message(payload.destination_id,header.messagefrom,payload.height,payload.link_reversal)
-                elif header.messagetype == TORAControlMessageTypes.CLR:
-                    self.process_clear_message(payload.destination_id, payload.reference_level)
-                else:
-                    # Here we receive some normal packet containig arbitrary sized data (for benchmarks)
-                    # print("HEER")
-                    self.process_arbitrary_message(payload.destination_id, payload.reference_level)
-            except AttributeError:
-                print("Attribute Error")
-        self.update_time()
-
-    def process_arbitrary_message(self, destination_id: int, message: str):
-        if destination_id == self.componentinstancenumber:
-            print(f"NODE {self.componentinstancenumber} RECEIVED MESSAGE OF LENGTH {len(message.encode())} BYTES")
-        elif len(self.find_downstream_links()) == 0:
-            print(f"Node {self.componentinstancenumber} cannot find route to destination")
+            message = eventobj.eventcontent
+            header = message.header
+            payload: GenericMessagePayload = message.payload
+            if isinstance(payload, (bytes, bytearray, memoryview)):
+                # Encoded control packet(s), the source is part of the packet
+                if self.codec is None:
+                    raise RuntimeError(f"Node {self.componentinstancenumber} received an encoded control packet without a codec (see use_wire_format)")
+                for messagetype, source_id, decoded_payload in self.codec.decode(payload):
+                    self.process_control_message(messagetype, source_id, decoded_payload)
+            elif isinstance(payload, ControlBatchPayload):
+                for messagetype, source_id, batched_payload in payload.messages:
+                    self.process_control_message(messagetype, source_id, batched_payload)
+            elif isinstance(header.messagetype, TORAControlMessageTypes):
+                self.process_control_message(header.messagetype, header.messagefrom, payload)
+            else:
+                # Here we receive some normal packet containig arbitrary sized data (for benchmarks)
+                self.process_data_packet(message)
+        self.recorder.message_handled()
+        if self.inputqueue.empty() and not ACTIVITY_EVENT.is_set():
+            ACTIVITY_EVENT.set()
+
+    def process_control_message(self, messagetype: TORAControlMessageTypes, source_id: int, payload: GenericMessagePayload):
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.perf_counter()
+        if messagetype == TORAControlMessageTypes.QRY:
+            # print("GOT QRY")
+            # print(payload.)
+            self.process_query_message(payload.destination_id, source_id)
+        elif messagetype == TORAControlMessageTypes.UPD:
+            self.process_update_message(payload.destination_id,source_id,payload.height,payload.link_reversal)
+        elif messagetype == TORAControlMessageTypes.CLR:
+            self.process_clear_message(payload.destination_id, payload.reference_level)
+        if metrics is not None:
+            metrics.count(f"{messagetype.name}.received")
+            metrics.observe(f"handler.{messagetype.name}", time.perf_counter() - started)
+
+    def process_arbitrary_message(self, destination_id: int, message: str, source_id: int = None, flow_id: int = 0):
+        # Sends message to destination_id, the packet is built once and reused on every hop
+        if source_id is None:
+            source_id = self.componentinstancenumber
+        payload = ArbitraryMessagePayload(destination_id, message, source_id, flow_id)
+        if source_id == self.componentinstancenumber:
+            self.throughput.sent(1, payload.size)
+        self.process_data_packet(GenericMessage(GenericMessageHeader("Message", self.componentinstancenumber, None), payload))
+
+    def send_stream(self, destination_id: int, payloads: Iterable, mtu: int = None, flow_id: int = 0) -> int:
+        '''
+        Sends payloads (bytes or str, any iterable or generator) to destination_id as one stream.
+        Consecutive payloads are packed into frames of at most mtu bytes, and every frame is sent
+        as soon as it is full. A payload larger than mtu travels alone in its own frame.
+        Returns the stream id, the destination reassembles the stream under (source, stream id).
+        '''
+        if mtu is None:
+            mtu = self.mtu
+        stream_id = self.next_stream_id
+        self.next_stream_id += 1
+        frame = []
+        frame_size = 0
+        sequence = 0
+        for payload in payloads:
+            size = payload_size(payload)
+            if frame and frame_size + size > mtu:
+                self.send_frame(DataFramePayload(destination_id, self.componentinstancenumber, stream_id, sequence, frame, frame_size, False, flow_id))
+                sequence += 1
+                frame = []
+                frame_size = 0
+            frame.append(payload)
+            frame_size += size
+        self.send_frame(DataFramePayload(destination_id, self.componentinstancenumber, stream_id, sequence, frame, frame_size, True, flow_id))
+        return stream_id
+
+    def send_frame(self, frame: DataFramePayload):
+        self.throughput.sent(len(frame.payloads), frame.size)
+        self.process_data_packet(GenericMessage(GenericMessageHeader("Message", self.componentinstancenumber, None), frame))
+
+    def process_data_packet(self, message: GenericMessage):
+        '''
+        Delivers a data packet (ArbitraryMessagePayload or DataFramePayload) addressed to this node,
+        or forwards it. Forwarding only readdresses the header of the same message object, the
+        payload is neither copied nor re-encoded, so a hop costs the same for any payload size.
+        '''
+        payload = message.payload
+        destination_id = payload.destination_id
+        if destination_id != self.componentinstancenumber:
+            self.forward(message)
+        elif isinstance(payload, DataFramePayload):
+            self.process_data_frame(payload)
         else:
-            min_neighbour = self.find_minimum_neighbor_height()
-            print(f"Node {self.componentinstancenumber} is forwarding the message to node {min_neighbour.i}")
-            header = GenericMessageHeader("Message", self.componentinstancenumber, min_neighbour.i)
-            packet = GenericMessage(header, ArbitraryMessagePayload(destination_id, message))
-            self.send_down(Event(self, EventTypes.MFRT, packet))
+            self.throughput.received(1, payload.size)
+            if self.log_data_plane:
+                print(f"NODE {self.componentinstancenumber} RECEIVED MESSAGE OF LENGTH {payload.size} BYTES")
+
+    def process_data_frame(self, frame: DataFramePayload):
+        self.throughput.received(len(frame.payloads), frame.size)
+        if self.log_data_plane:
+            print(f"NODE {self.componentinstancenumber} RECEIVED FRAME {frame.sequence} OF STREAM {frame.stream_id} FROM {frame.source_id} ({frame.size} BYTES)")
+        key = (frame.source_id, frame.stream_id)
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = StreamReassembly()
+        stream.add(frame)
+
+    def forward(self, message: GenericMessage) -> bool:
+        # Sends a data packet to the next hop towards its destination, returns False without a route
+        payload = message.payload
+        destination_id = payload.destination_id
+        next_hops = self.forwarding_table.get(destination_id)
+        if next_hops is None:
+            next_hops = self.next_hops(destination_id)
+            if not next_hops:
+                if self.metrics is not None:
+                    self.metrics.count("data.no_route")
+                if self.log_data_plane:
+                    print(f"Node {self.componentinstancenumber} cannot find route to destination {destination_id}")
+                return False
+        if len(next_hops) == 1 or self.forwarding_mode == ForwardingModes.SINGLE_PATH:
+            next_hop = next_hops[0]
+        else:
+            next_hop = self.select_next_hop(destination_id, next_hops, payload.source_id, payload.flow_id)
+        if self.log_data_plane:
+            print(f"Node {self.componentinstancenumber} is forwarding the message to node {next_hop}")
+        header = message.header
+        header.messagefrom = self.componentinstancenumber
+        header.messageto = next_hop
+        self.recorder.messages_sent += 1
+        self.link_utilization[next_hop] = self.link_utilization.get(next_hop, 0) + 1
+        self.send_down(Event(self, EventTypes.MFRT, message))
+        return True
+
+    def next_hops(self, destination_id: int) -> Tuple[int, ...]:
+        '''
+        Returns the downstream neighbors for destination_id, lowest height first (empty without a route).
+        The answer is cached in the forwarding table until a height of this destination changes.
+        '''
+        next_hops = self.forwarding_table.get(destination_id)
+        if next_hops is None:
+            next_hops = tuple(self.state(destination_id).downstream_neighbors())
+            if next_hops:
+                self.forwarding_table[destination_id] = next_hops
+        return next_hops
+
+    def next_hop(self, destination_id: int) -> int:
+        next_hops = self.next_hops(destination_id)
+        return next_hops[0] if next_hops else None
+
+    def select_next_hop(self, destination_id: int, next_hops: Tuple[int, ...], source_id: int, flow_id: int) -> int:
+        # Every downstream neighbor is lower than this node, so any choice keeps the route loop-free
+        if self.forwarding_mode == ForwardingModes.ROUND_ROBIN:
+            turn = self.round_robin.get(destination_id, 0)
+            self.round_robin[destination_id] = turn + 1
+            return next_hops[turn % len(next_hops)]
+        elif self.forwarding_mode == ForwardingModes.FLOW_HASH:
+            return next_hops[hash((source_id, destination_id, flow_id)) % len(next_hops)]
+        elif self.forwarding_mode == ForwardingModes.LEAST_USED:
+            return min(next_hops, key=lambda neighbor: self.link_utilization.get(neighbor, 0))
+        return next_hops[0]
 
     def process_query_message(self, destination_id: int, source_id: int):
         ''' Excerpt from the paper:
@@ -174,24 +600,29 @@ class ApplicationLayerTORA(GenericModel):
             otherwise, it broadcasts an UPD packet. If a node has the route-required flag set when a new link is 
             established, it broadcasts a QRY packet.
         '''
-        downstream_links = self.find_downstream_links()
+        state = self.state(destination_id)
 
-        if len(downstream_links) == 0:
-            if self.route_required == False:
-                broadcaster = self.Broadcaster(self, TORAControlMessageTypes.QRY, self.componentinstancenumber, destination_id)
-                broadcaster.broadcast()
+        if state.downstream_count() == 0:
+            if state.route_required == False:
+                if self.flood_control is None or source_id == self.componentinstancenumber:
+                    self.broadcaster.broadcast(TORAControlMessageTypes.QRY, destination_id)
+                else:
+                    # The flood control decides if and when the QRY is rebroadcast (see TORAFloodControl)
+                    state.route_required = True
+                    self.flood_control.query_received(self, destination_id, source_id)
             else:
-                pass
-        elif self.height.delta is None:
-            min_height = self.find_minimum_neighbor_height()
-            self.height = TORAHeight(min_height.tau,min_height.oid,min_height.r,min_height.delta + 1,self.componentinstancenumber)
-            broadcaster = self.Broadcaster(self, TORAControlMessageTypes.UPD, self.componentinstancenumber, destination_id=destination_id, height=self.height, link_reversal=False)
-            broadcaster.broadcast()
-        elif source_id not in self.neighbor_heights or (source_id in self.neighbor_heights and self.neighbor_heights[source_id][1] > self.last_update):
-            broadcaster = self.Broadcaster(self, TORAControlMessageTypes.UPD, self.componentinstancenumber, destination_id=destination_id, height=self.height, link_reversal=False)
-            broadcaster.broadcast()
-        else:
-            pass
+                if self.flood_control is not None and source_id != self.componentinstancenumber:
+                    self.flood_control.duplicate_received(self, destination_id, source_id)
+                if self.metrics is not None:
+                    self.metrics.count("QRY.discarded")
+        elif state.height.is_null:
+            min_height = self.find_minimum_neighbor_height(destination_id)
+            state.height = TORAHeight(min_height.tau,min_height.oid,min_height.r,min_height.delta + 1,self.componentinstancenumber)
+            self.broadcaster.broadcast(TORAControlMessageTypes.UPD, destination_id, height=state.height, link_reversal=False)
+        elif source_id not in state.neighbor_heights or (source_id in state.neighbor_heights and state.neighbor_heights[source_id][1] > state.last_update):
+            self.broadcaster.broadcast(TORAControlMessageTypes.UPD, destination_id, height=state.height, link_reversal=False)
+        elif self.metrics is not None:
+            self.metrics.count("QRY.discarded")
 
     def process_update_message(self, destination_id: int, source_id: int, height: TORAHeight, link_reversal: bool):
         '''Excerpt from paper:
@@ -206,48 +637,37 @@ class ApplicationLayerTORA(GenericModel):
         (b) If the route-required flag is not set, node i simply updates the entry LSi, j in its link-state array.
         
         '''
-        self.update_neighbor_height(source_id, height)
-        downstream_links = self.find_downstream_links()
+        state = self.state(destination_id)
+        self.update_neighbor_height(source_id, height, destination_id)
 
         if link_reversal:
             
-            if len(downstream_links):
+            if state.downstream_count():
                 return
 
-            upstream_links: List[Tuple[TORAHeight, int]] = list(self.find_upstream_links().items())
-            reference_level: TORAHeight = TORAHeight(-1, None, None, None, None)
-            same_reference_level = True
-
-            for t in upstream_links:
-                upstream_link = t[0]
-                if reference_level == (-1, None, None):
-                    reference_level = upstream_link
-                elif upstream_link.tau != reference_level.tau or upstream_link.oid != reference_level.oid or upstream_link.r != reference_level.r:
-                    same_reference_level = False
-
-                if (reference_level.tau, reference_level.oid, reference_level.r) >= (upstream_link.tau, upstream_link.oid, upstream_link.r):
-                    reference_level.tau = upstream_link.tau
-                    reference_level.oid = upstream_link.oid
-                    reference_level.r = upstream_link.r
-                    reference_level.delta = min(reference_level.delta, upstream_link.delta)
+            # All non-NULL neighbors are upstream now. The index is sorted, so its last entry carries the
+            # highest reference level and the first entry of that level has the smallest delta.
+            if not state.link_index:
+                return
+            highest_reference_level = state.link_index[-1].reference_level
 
-            if not same_reference_level:
+            if state.link_index[0].reference_level != highest_reference_level:
+                reference_level = state.link_index[bisect_left(state.link_index, highest_reference_level)]
                 self.maintenance_case_2(destination_id, reference_level)
-            elif reference_level[2] == 0:
-                self.maintenance_case_3(destination_id, reference_level)
-            elif self.componentinstancenumber == reference_level[1]:
-                self.maintenance_case_4(destination_id)
+            elif highest_reference_level.r == 0:
+                self.maintenance_case_3(destination_id, highest_reference_level)
+            elif self.componentinstancenumber == highest_reference_level.oid:
+                self.maintenance_case_4(destination_id, highest_reference_level)
             else:
                 self.maintenance_case_5(destination_id)
         else:
-            if self.route_required == True:
-                min_height = self.find_minimum_neighbor_height()
-                self.height = TORAHeight(min_height.tau,min_height.oid,min_height.r,min_height.delta + 1,self.componentinstancenumber)
-                self.route_required = False
-                broadcaster = self.Broadcaster(self, TORAControlMessageTypes.UPD, self.componentinstancenumber, destination_id=destination_id, height=self.height, link_reversal=False)
-                broadcaster.broadcast()
+            if state.route_required == True and state.downstream_count():
+                min_height = self.find_minimum_neighbor_height(destination_id)
+                state.height = TORAHeight(min_height.tau,min_height.oid,min_height.r,min_height.delta + 1,self.componentinstancenumber)
+                state.route_required = False
+                self.broadcaster.broadcast(TORAControlMessageTypes.UPD, destination_id, height=state.height, link_reversal=False)
             else:
-                if len(downstream_links) == 0 and self.componentinstancenumber != destination_id:
+                if state.downstream_count() == 0 and self.componentinstancenumber != destination_id:
                     self.maintenance_case_1(destination_id)
 
     def process_clear_message(self, destination_id: int, reference_level: ReferenceLevel):
@@ -265,132 +685,234 @@ class ApplicationLayerTORA(GenericModel):
             If (b) causes node i to lose its last downstream link, it reacts as in case 1 of maintaining routes.
         
         '''
-        if reference_level == (self.height.tau, self.height.oid, self.height.r):
-            self.height = TORAHeight(None, None, None, None, self.componentinstancenumber)
-
-        for neighbor in self.neighbor_heights:
+        state = self.state(destination_id)
+        self.clock.witness(reference_level.tau)
+        # Decide on the reference level before the height is erased
+        same_reference_level = not state.height.is_null and state.height.reference_level == reference_level
+        had_downstream_links = not state.height.is_null and state.downstream_count() > 0
+        if same_reference_level:
+            state.height = TORAHeight.null(self.componentinstancenumber)
+
+        for neighbor, (neighbor_height, activated) in list(state.neighbor_heights.items()):
             if neighbor == destination_id:
                 continue
-            if reference_level == (self.height.tau,self.height.oid,self.height.r) or reference_level == (self.neighbor_heights[neighbor][0].tau,self.neighbor_heights[neighbor][0].oid,self.neighbor_heights[neighbor][0].r):
-                self.neighbor_heights[neighbor] = (None,None,None,None,self.componentinstancenumber)
-        if reference_level == (self.height.tau, self.height.oid, self.height.r):
-            broadcaster = self.Broadcaster(self, TORAControlMessageTypes.CLR, self.componentinstancenumber, destination_id=destination_id, reference_level=reference_level)
-            broadcaster.broadcast()
+            if same_reference_level or (not neighbor_height.is_null and neighbor_height.reference_level == reference_level):
+                state.set_neighbor_height(neighbor, TORAHeight.null(neighbor), activated)
+        if same_reference_level:
+            self.broadcaster.broadcast(TORAControlMessageTypes.CLR, destination_id, reference_level=reference_level)
+        elif had_downstream_links and state.downstream_count() == 0 and self.componentinstancenumber != destination_id:
+            self.maintenance_case_1(destination_id)
 
     def maintenance_case_1(self, destination_id: int):
-        upstream_links = self.find_upstream_links()
-        if len(upstream_links) == 0:
-            self.height = TORAHeight(None, None, None, None, self.componentinstancenumber)
+        state = self.state(destination_id)
+        if self.metrics is not None:
+            self.metrics.count("maintenance_case_1")
+        if state.upstream_count() == 0:
+            state.height = TORAHeight.null(self.componentinstancenumber)
         else:
-            self.height = TORAHeight(time.time(),self.componentinstancenumber,0,0,self.componentinstancenumber)
-        broadcaster = self.Broadcaster(self, TORAControlMessageTypes.UPD, self.componentinstancenumber, destination_id=destination_id, height=self.height, link_reversal=True)
-        broadcaster.broadcast()
+            state.height = TORAHeight(self.clock.now(),self.componentinstancenumber,0,0,self.componentinstancenumber)
+        self.broadcaster.broadcast(TORAControlMessageTypes.UPD, destination_id, height=state.height, link_reversal=True)
 
     def maintenance_case_2(self, destination_id: int, reference_level: TORAHeight):
-        self.height = TORAHeight(reference_level.tau,reference_level.oid,reference_level.r,reference_level.delta - 1,self.componentinstancenumber)
-        broadcaster = self.Broadcaster(self, TORAControlMessageTypes.UPD, self.componentinstancenumber, destination_id=destination_id, height=self.height, link_reversal=True)
-        broadcaster.broadcast()
-
-    def maintenance_case_3(self, destination_id: int, reference_level: TORAHeight):
-        self.height = TORAHeight(reference_level.tau, reference_level.oid, 1, 0, self.componentinstancenumber)
-        broadcaster = self.Broadcaster(self, TORAControlMessageTypes.UPD, self.componentinstancenumber, destination_id=destination_id, height=self.height, link_reversal=True)
-        broadcaster.broadcast()
-
-    def maintenance_case_4(self, destination_id: int):
-        self.height = TORAHeight(None, None, None, None, self.componentinstancenumber)
-
-        for neighbor in self.neighbor_heights:
+        state = self.state(destination_id)
+        if self.metrics is not None:
+            self.metrics.count("maintenance_case_2")
+        state.height = TORAHeight(reference_level.tau,reference_level.oid,reference_level.r,reference_level.delta - 1,self.componentinstancenumber)
+        self.broadcaster.broadcast(TORAControlMessageTypes.UPD, destination_id, height=state.height, link_reversal=True)
+
+    def maintenance_case_3(self, destination_id: int, reference_level: ReferenceLevel):
+        state = self.state(destination_id)
+        if self.metrics is not None:
+            self.metrics.count("maintenance_case_3")
+        state.height = TORAHeight(reference_level.tau, reference_level.oid, 1, 0, self.componentinstancenumber)
+        self.broadcaster.broadcast(TORAControlMessageTypes.UPD, destination_id, height=state.height, link_reversal=True)
+
+    def maintenance_case_4(self, destination_id: int, reference_level: ReferenceLevel):
+        state = self.state(destination_id)
+        if self.metrics is not None:
+            self.metrics.count("maintenance_case_4")
+            self.metrics.count("partitions_detected")
+        state.height = TORAHeight.null(self.componentinstancenumber)
+
+        for neighbor, (_, activated) in list(state.neighbor_heights.items()):
             if neighbor == destination_id:
                 continue
-            self.neighbor_heights[neighbor] = (None,None,None,None,self.componentinstancenumber)
-        broadcaster = self.Broadcaster(self, TORAControlMessageTypes.CLR, self.componentinstancenumber, destination_id=destination_id, reference_level=(self.height.tau, self.height.oid, 1))
-        broadcaster.broadcast()
+            state.set_neighbor_height(neighbor, TORAHeight.null(neighbor), activated)
+        self.broadcaster.broadcast(TORAControlMessageTypes.CLR, destination_id, reference_level=reference_level)
 
     def maintenance_case_5(self, destination_id: int):
-        self.height = TORAHeight(time.time(),self.componentinstancenumber,0,0,self.componentinstancenumber)
-        broadcaster = self.Broadcaster(self, TORAControlMessageTypes.UPD, self.componentinstancenumber, destination_id=destination_id, height=self.height, link_reversal=True)
-        broadcaster.broadcast()
-
-    def find_minimum_neighbor_height(self) -> TORAHeight:
-        downstream_links = self.find_downstream_links()
-        min_height = downstream_links[list(downstream_links)[0]][0]
-        min_height_delta = min_height.delta
-
-        for i in list(downstream_links):
-            downstream_link = downstream_links[i]
-            if min_height_delta > downstream_link[0].delta + 1:
-                min_height = downstream_link[0]
-                min_height_delta = downstream_link[0].delta + 1
-
-        return min_height
-
-    def find_downstream_links(self):
-        height_delta = float('inf') if self.height.delta is None else self.height.delta
-        result = {}
-        for link in self.neighbor_heights.items():
-            if link[1][0].delta < height_delta:
-                result[link[0]] = link[1]
-        return result
-
-    def find_upstream_links(self):
-        height_delta = -1 if self.height.delta is None else self.height.delta
-        result = {}
-        for link in self.neighbor_heights.items():
-            if link[1][0].delta >= height_delta:
-                result[link[0]] = link[1]
-        return result
-
-    def set_height(self, height: TORAHeight):
-        self.height = height
+        state = self.state(destination_id)
+        if self.metrics is not None:
+            self.metrics.count("maintenance_case_5")
+        state.height = TORAHeight(self.clock.now(),self.componentinstancenumber,0,0,self.componentinstancenumber)
+        self.broadcaster.broadcast(TORAControlMessageTypes.UPD, destination_id, height=state.height, link_reversal=True)
+
+    def find_minimum_neighbor_height(self, destination_id: int = None) -> TORAHeight:
+        state = self.state(destination_id)
+        if state.downstream_count() == 0:
+            return None
+        return state.link_index[0]
+
+    def find_downstream_links(self, destination_id: int = None):
+        state = self.state(destination_id)
+        return {neighbor: state.neighbor_heights[neighbor] for neighbor in state.downstream_neighbors()}
+
+    def find_upstream_links(self, destination_id: int = None):
+        state = self.state(destination_id)
+        return {neighbor: state.neighbor_heights[neighbor] for neighbor in state.upstream_neighbors()}
+
+    def set_height(self, height: TORAHeight, destination_id: int = None):
+        # Without a destination, the node is setting its own height as the destination
+        if destination_id is None:
+            destination_id = self.componentinstancenumber
+        self.state(destination_id).height = height
         for neighbor in self.neighbors:
-            self.topology.nodes[neighbor].app_layer.update_neighbor_height(self.componentinstancenumber, height)
+            self.topology.nodes[neighbor].app_layer.update_neighbor_height(self.componentinstancenumber, height, destination_id)
 
-    def update_neighbor_height(self, component_id: int, height: TORAHeight):
-        self.neighbor_heights[component_id] = (height, time.time())
+    def update_neighbor_height(self, component_id: int, height: TORAHeight, destination_id: int = None):
+        if height.tau is not None:
+            self.clock.witness(height.tau)
+        self.state(destination_id).set_neighbor_height(component_id, height, self.clock.now())
 
-    def update_time(self):
-        global BENCHMARK_TIME
-        with BENCHMARK_TIME_LOCK:
-            if BENCHMARK_TIME < time.time() or BENCHMARK_TIME == INITIAL_TIME:
-                BENCHMARK_TIME = time.time()
+    def link_down(self, neighbor: int):
+        '''
+        Called when the link to neighbor fails. The neighbor is dropped for every destination and a
+        node that loses its last downstream link this way defines a new reference level (case 1).
+        '''
+        with self.lock:
+            self.neighbors = [i for i in self.neighbors if i != neighbor]
+            for destination_id, state in list(self.destinations.items()):
+                if neighbor not in state.neighbor_heights:
+                    continue
+                had_downstream_links = not state.height.is_null and state.downstream_count() > 0
+                state.remove_neighbor(neighbor)
+                if had_downstream_links and state.downstream_count() == 0 and self.componentinstancenumber != destination_id:
+                    self.maintenance_case_1(destination_id)
+
+    def link_up(self, neighbor: int):
+        '''
+        Called when a link to neighbor is established. The link becomes active with a NULL height
+        for every destination, then the node broadcasts a QRY if it needs a route, or an UPD so
+        that the new neighbor learns its height.
+        '''
+        with self.lock:
+            if neighbor not in self.neighbors:
+                self.neighbors = sorted([*self.neighbors, neighbor])
+            now = self.clock.now()
+            for destination_id, state in list(self.destinations.items()):
+                state.set_neighbor_height(neighbor, TORAHeight.null(neighbor), now)
+                if state.route_required:
+                    self.broadcaster.broadcast(TORAControlMessageTypes.QRY, destination_id)
+                elif not state.height.is_null:
+                    self.broadcaster.broadcast(TORAControlMessageTypes.UPD, destination_id, height=state.height, link_reversal=False)
+
+    def reset(self):
+        # Forgets all routing state, as after a restart of the node
+        with self.lock:
+            self.destinations = {}
+            self.default_destination_id = None
+            self.forwarding_table.clear()
+            if self.flood_control is not None:
+                self.flood_control.forget(self)
 
     # Subcomponent (inner class) for broadcasting messages
     class Broadcaster:
-        def __init__(self, tora_instance, message_type, source_id, destination_id=None, reference_level=None, link_reversal=None, height=None):
+        '''
+        Each node keeps a single Broadcaster. A broadcast is one message addressed to every neighbor,
+        which goes down the stack once and is fanned out by the channels, instead of one message per neighbor.
+        '''
+        def __init__(self, tora_instance):
             self.tora_instance = tora_instance
-            self.message_type = message_type
-            self.source_id = source_id
-            self.destination_id = destination_id
-            self.reference_level = reference_level
-            self.link_reversal = link_reversal
-            self.height = height
-        
-        def broadcast(self):
-            if self.message_type == TORAControlMessageTypes.QRY:
-                self.tora_instance.route_required = 1
-                payload = QueryMessagePayload(self.destination_id)
-            elif self.message_type == TORAControlMessageTypes.UPD:
-                self.tora_instance.last_update = time.time()
-                payload = UpdateMessagePayload(self.destination_id, self.height, self.link_reversal)
-            elif self.message_type == TORAControlMessageTypes.CLR:
-                payload = ClearMessagePayload(self.destination_id, self.reference_level)
+            self.source_id = tora_instance.componentinstancenumber
+
+        def broadcast(self, message_type, destination_id, reference_level=None, link_reversal=None, height=None):
+            state = self.tora_instance.state(destination_id)
+            advertiser = self.tora_instance.advertiser
+            if message_type == TORAControlMessageTypes.QRY:
+                state.route_required = 1
+                payload = QueryMessagePayload(destination_id)
+            elif message_type == TORAControlMessageTypes.UPD:
+                state.last_update = self.tora_instance.clock.now()
+                if advertiser is not None and advertiser.enqueue(self.tora_instance, destination_id, height, link_reversal):
+                    return
+                payload = UpdateMessagePayload(destination_id, height, link_reversal)
+            elif message_type == TORAControlMessageTypes.CLR:
+                payload = ClearMessagePayload(destination_id, reference_level)
             else:
                 raise Exception("Unknown message type for broadcasting")
+            if advertiser is not None:
+                # Pending UPDs go out first, a CLR or QRY must not overtake them
+                advertiser.flush(self.tora_instance)
+            self.send(message_type, payload, 1, 1 if link_reversal else 0)
+
+        def broadcast_batch(self, message_type, payloads: list):
+            # Broadcasts several packets of message_type as one message, which is a frame with a codec
+            link_reversals = sum(1 for payload in payloads if getattr(payload, "link_reversal", False))
+            if len(payloads) == 1:
+                self.send(message_type, payloads[0], 1, link_reversals)
+                return
+            messages = [(message_type, self.source_id, payload) for payload in payloads]
+            if self.tora_instance.codec is not None:
+                self.send(message_type, self.tora_instance.codec.encode_batch(messages), len(payloads), link_reversals)
+            else:
+                self.send(message_type, ControlBatchPayload(messages), len(payloads), link_reversals)
 
-            for neighbor in self.tora_instance.neighbors:
-                header = GenericMessageHeader(self.message_type, self.source_id, neighbor)
-                message = GenericMessage(header, payload)
-                self.tora_instance.send_down(Event(self.tora_instance, EventTypes.MFRT, message))
+        def send(self, message_type, payload, packet_count: int, link_reversals: int):
+            neighbor_count = len(self.tora_instance.neighbors)
+            if neighbor_count == 0:
+                return
+            header = GenericMessageHeader(message_type, self.source_id, MessageDestinationIdentifiers.NETWORKLAYERBROADCAST)
+            if self.tora_instance.codec is not None:
+                if not isinstance(payload, bytes):
+                    payload = self.tora_instance.codec.encode(message_type, self.source_id, payload)
+                self.tora_instance.recorder.bytes_sent += len(payload) * neighbor_count
+            self.tora_instance.recorder.messages_sent += neighbor_count
+            metrics = self.tora_instance.metrics
+            if metrics is not None:
+                metrics.count(f"{message_type.name}.sent", packet_count * neighbor_count)
+                if link_reversals:
+                    metrics.count("link_reversals", link_reversals)
+            self.tora_instance.send_down(Event(self.tora_instance, EventTypes.MFRT, GenericMessage(header, payload)))
+
+
+# The generic network layer drops broadcasts because they have no next hop, TORA broadcasts to its neighbors
+class TORANetworkLayer(GenericNetworkLayer):
+    def __init__(self, componentname, componentinstancenumber, context=None, configurationparameters=None, num_worker_threads=1, topology=None):
+        # GenericNetworkLayer.__init__ computes all-pairs shortest paths for every node, TORA only sends to
+        # neighbors, so paths to other nodes are computed on first use, from this node only
+        GenericModel.__init__(self, componentname, componentinstancenumber, context, configurationparameters, num_worker_threads, topology)
+        self.fw_table = None
+
+    def get_next_hop(self, fromId, toId):
+        if self.topology.G.has_edge(fromId, toId):
+            return toId
+        if self.fw_table is None:
+            self.fw_table = {fromId: nx.single_source_shortest_path(self.topology.G, fromId)}
+        return super().get_next_hop(fromId, toId)
+
+    def on_message_from_top(self, eventobj: Event):
+        applmsg = eventobj.eventcontent
+        if applmsg.header.messageto != MessageDestinationIdentifiers.NETWORKLAYERBROADCAST:
+            super().on_message_from_top(eventobj)
+            return
+        hdr = NetworkLayerMessageHeader(NetworkLayerMessageTypes.NETMSG, self.componentinstancenumber, MessageDestinationIdentifiers.NETWORKLAYERBROADCAST, MessageDestinationIdentifiers.LINKLAYERBROADCAST)
+        self.send_down(Event(self, EventTypes.MFRT, GenericMessage(hdr, applmsg)))
 
 
 class TORANode(GenericModel):
     def __init__(self, componentname, componentid, topology: Topology):
-        super().__init__(componentname, componentid, topology=topology)
+        # A TORATopology starts worker threads lazily, on the first event of a component
+        num_worker_threads = 0 if getattr(topology, "lazy_workers", False) else 1
+        super().__init__(componentname, componentid, num_worker_threads=num_worker_threads, topology=topology)
 
         # SUBCOMPONENTS
-        self.app_layer = ApplicationLayerTORA("ApplicationLayer", componentid, topology)
-        self.net_layer = GenericNetworkLayer("NetworkLayer", componentid, topology=topology)
-        self.link_layer = GenericLinkLayer("LinkLayer", componentid, topology=topology)
+        self.app_layer = ApplicationLayerTORA("ApplicationLayer", componentid, topology, num_worker_threads=num_worker_threads)
+        self.net_layer = TORANetworkLayer("NetworkLayer", componentid, num_worker_threads=num_worker_threads, topology=topology)
+        self.link_layer = GenericLinkLayer("LinkLayer", componentid, num_worker_threads=num_worker_threads, topology=topology)
+        # Registered so that INIT and EXIT reach the subcomponents and their worker threads stop on exit
+        self.components.append(self.app_layer)
+        self.components.append(self.net_layer)
+        self.components.append(self.link_layer)
 
         # CONNECTIONS AMONG SUBCOMPONENTS
         self.app_layer.connect_me_to_component(ConnectorTypes.DOWN, self.net_layer)
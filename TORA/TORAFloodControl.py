@@ -0,0 +1,146 @@
+import itertools
+import random
+from typing import Callable, Dict, Tuple
+
+from adhoccomputing.Experimentation.Topology import Topology
+
+from TORA.TORAComponent import ApplicationLayerTORA, TORAControlMessageTypes
+
+'''
+Flood control for QRY packets.
+Without flood control, a node without downstream links rebroadcasts the first QRY it gets for
+a destination at once (process_query_message, case a). With a FloodControl set on the node,
+the node still sets its route-required flag, but the FloodControl decides whether the QRY is
+rebroadcast:
+    FloodControl                always, the behavior without flood control
+    ProbabilisticFloodControl   with probability p (gossip), nodes with few neighbors always
+    CounterFloodControl         unless the node heard threshold copies of the QRY meanwhile
+    CoverageFloodControl        unless the neighbors that sent the copies already reach all its
+                                neighbors (self-pruning on two-hop neighborhoods)
+
+With a delay, the decision waits a random assessment delay of up to delay seconds. Copies that
+arrive meanwhile are coalesced into the pending request and inform the decision, and a node
+that got a route in the meantime (through an UPD) drops the request. A node that restarts
+(ApplicationLayerTORA.reset) forgets its pending requests, their timers are ignored. Delays need a scheduler,
+e.g. FloodControl(schedule=simulation.scheduler.schedule) for a TORASimulation. Without one
+the decision is taken on the first copy, which also works on a threaded Topology.
+
+The QRY of the node that requests the route is always broadcast. Suppressed QRYs are counted
+as QRY.suppressed in the metrics (see TORAMetrics). Coverage based suppression still reaches
+every node. Counter and probabilistic suppression do not guarantee that, a QRY suppressed at a
+cut vertex never reaches the destination (tests/benchmarkFloodControl.py reports the runs that
+still found a route).
+'''
+class FloodControl:
+    def __init__(self, delay: float = 0.0, schedule: Callable = None, seed: int = None):
+        self.delay = delay
+        self.schedule = schedule
+        self.random = random.Random(seed)
+        # (node, destination) -> token of the timer and assessment of the pending rebroadcast
+        self.pending: Dict[Tuple[int, int], Tuple[int, object]] = {}
+        self._tokens = itertools.count()
+        # First QRYs handed over, each one is rebroadcast, suppressed or dropped by a restart
+        self.requests: int = 0
+        self.rebroadcasts: int = 0
+        self.suppressed: int = 0
+        self.dropped: int = 0
+
+    def query_received(self, app_layer: ApplicationLayerTORA, destination_id: int, source_id: int):
+        # First QRY for destination_id at a node without downstream links
+        self.requests += 1
+        token = next(self._tokens)
+        self.pending[(app_layer.componentinstancenumber, destination_id)] = (token, self.start(app_layer, source_id))
+        if self.delay > 0 and self.schedule is not None:
+            self.schedule(self.random.uniform(0, self.delay), self.decide, app_layer, destination_id, token)
+        else:
+            self.decide(app_layer, destination_id, token)
+
+    def duplicate_received(self, app_layer: ApplicationLayerTORA, destination_id: int, source_id: int):
+        key = (app_layer.componentinstancenumber, destination_id)
+        if key in self.pending:
+            token, assessment = self.pending[key]
+            self.pending[key] = (token, self.update(assessment, app_layer, source_id))
+
+    def forget(self, app_layer: ApplicationLayerTORA):
+        # Drops the pending requests of a node that restarts
+        node_id = app_layer.componentinstancenumber
+        for key in [key for key in self.pending if key[0] == node_id]:
+            del self.pending[key]
+            self.dropped += 1
+
+    def decide(self, app_layer: ApplicationLayerTORA, destination_id: int, token: int):
+        key = (app_layer.componentinstancenumber, destination_id)
+        # The timer of a request forgotten by a restart, the node may have a newer request by now
+        if key not in self.pending or self.pending[key][0] != token:
+            return
+        _, assessment = self.pending.pop(key)
+        state = app_layer.state(destination_id)
+        if state.route_required and state.downstream_count() == 0 and self.should_rebroadcast(app_layer, assessment):
+            self.rebroadcasts += 1
+            app_layer.broadcaster.broadcast(TORAControlMessageTypes.QRY, destination_id)
+            return
+        self.suppressed += 1
+        if app_layer.metrics is not None:
+            app_layer.metrics.count("QRY.suppressed")
+
+    # Overridden by the strategies, the assessment is whatever start returns
+    def start(self, app_layer: ApplicationLayerTORA, source_id: int):
+        return None
+
+    def update(self, assessment, app_layer: ApplicationLayerTORA, source_id: int):
+        return assessment
+
+    def should_rebroadcast(self, app_layer: ApplicationLayerTORA, assessment) -> bool:
+        return True
+
+
+class ProbabilisticFloodControl(FloodControl):
+    def __init__(self, p: float = 0.65, min_degree: int = 3, delay: float = 0.0, schedule: Callable = None, seed: int = None):
+        super().__init__(delay, schedule, seed)
+        self.p = p
+        # Nodes with at most min_degree neighbors are often the only way on (trees, cycles), they always rebroadcast
+        self.min_degree = min_degree
+
+    def should_rebroadcast(self, app_layer: ApplicationLayerTORA, assessment) -> bool:
+        return len(app_layer.neighbors) <= self.min_degree or self.random.random() < self.p
+
+
+class CounterFloodControl(FloodControl):
+    def __init__(self, threshold: int = 3, delay: float = 0.002, schedule: Callable = None, seed: int = None):
+        super().__init__(delay, schedule, seed)
+        self.threshold = threshold
+
+    def start(self, app_layer: ApplicationLayerTORA, source_id: int) -> int:
+        return 1
+
+    def update(self, copies: int, app_layer: ApplicationLayerTORA, source_id: int) -> int:
+        return copies + 1
+
+    def should_rebroadcast(self, app_layer: ApplicationLayerTORA, copies: int) -> bool:
+        return copies < self.threshold
+
+
+class CoverageFloodControl(FloodControl):
+    '''
+    Neighbor lists are read from the neighbors' application layers. A node could learn them from
+    its neighbors' beacons (see TORANeighborSensing), the simulation reads them directly.
+    '''
+    def neighbors_of(self, app_layer: ApplicationLayerTORA, node_id: int):
+        return app_layer.topology.nodes[node_id].app_layer.neighbors
+
+    def start(self, app_layer: ApplicationLayerTORA, source_id: int) -> set:
+        return self.update(set(app_layer.neighbors), app_layer, source_id)
+
+    def update(self, uncovered: set, app_layer: ApplicationLayerTORA, source_id: int) -> set:
+        uncovered.discard(source_id)
+        uncovered.difference_update(self.neighbors_of(app_layer, source_id))
+        return uncovered
+
+    def should_rebroadcast(self, app_layer: ApplicationLayerTORA, uncovered: set) -> bool:
+        return bool(uncovered)
+
+
+def use_flood_control(topo: Topology, flood_control: FloodControl = None):
+    # One FloodControl serves all nodes of topo, None restores the plain flood
+    for node in topo.nodes:
+        topo.nodes[node].app_layer.flood_control = flood_control
@@ -0,0 +1,154 @@
+import json
+import math
+from typing import Dict
+
+from adhoccomputing.Experimentation.Topology import Topology
+
+'''
+Metrics for ApplicationLayerTORA.
+A MetricsRegistry hands every node its own NodeMetrics, which only that node writes to, so
+recording needs no lock. Nodes without metrics (the default) skip recording with a single
+`is not None` check. snapshot() merges the per-node metrics for export.
+
+Recorded metrics:
+    <TYPE>.sent / <TYPE>.received       control packets per type (QRY, UPD, CLR), sent counts one per neighbor
+    QRY.discarded                       QRY packets dropped in cases (b) and (d) of process_query_message
+    QRY.suppressed                      QRY rebroadcasts left out by flood control (see TORAFloodControl)
+    UPD.merged                          UPDs merged into a later UPD of the same node (see TORAAdvertisement)
+    maintenance_case_<n>                route maintenance cases taken
+    link_reversals                      UPD broadcasts that reverse the links of a node
+    partitions_detected                 partitions detected (case 4)
+    handler.<TYPE>                      histogram of the time (s) spent handling one packet
+    data.no_route                       data packets dropped because the node had no route
+'''
+class Histogram:
+    '''
+    Histogram with power of two buckets: bucket e counts the values in [2**(e-1), 2**e).
+    '''
+    __slots__ = ("count", "total", "minimum", "maximum", "buckets")
+
+    def __init__(self):
+        self.count: int = 0
+        self.total: float = 0.0
+        self.minimum: float = float('inf')
+        self.maximum: float = float('-inf')
+        self.buckets: Dict[int, int] = {}
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        exponent = math.frexp(value)[1]
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    def merge(self, other: "Histogram"):
+        self.count += other.count
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        for exponent, count in other.buckets.items():
+            self.buckets[exponent] = self.buckets.get(exponent, 0) + count
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-quantile
+        if self.count == 0:
+            return float('nan')
+        rank = q * self.count
+        seen = 0
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= rank:
+                return min(2.0 ** exponent, self.maximum)
+        return self.maximum
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.total / self.count if self.count else float('nan'),
+            'min': self.minimum,
+            'max': self.maximum,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'buckets': {2.0 ** exponent: count for exponent, count in sorted(self.buckets.items())},
+        }
+
+
+class NodeMetrics:
+    __slots__ = ("node_id", "counters", "histograms")
+
+    def __init__(self, node_id: int):
+        self.node_id = node_id
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, value: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.nodes: Dict[int, NodeMetrics] = {}
+
+    def node(self, node_id: int) -> NodeMetrics:
+        metrics = self.nodes.get(node_id)
+        if metrics is None:
+            metrics = self.nodes[node_id] = NodeMetrics(node_id)
+        return metrics
+
+    def reset(self):
+        for node_id in list(self.nodes):
+            self.nodes[node_id] = NodeMetrics(node_id)
+
+    def snapshot(self, per_node: bool = False) -> dict:
+        '''
+        Returns the counters and histograms summed over all nodes.
+        With per_node, the counters of every node are included as well.
+        '''
+        counters: Dict[str, int] = {}
+        histograms: Dict[str, Histogram] = {}
+        for metrics in list(self.nodes.values()):
+            for name, value in list(metrics.counters.items()):
+                counters[name] = counters.get(name, 0) + value
+            for name, histogram in list(metrics.histograms.items()):
+                histograms.setdefault(name, Histogram()).merge(histogram)
+        snapshot = {
+            'counters': dict(sorted(counters.items())),
+            'histograms': {name: histogram.to_dict() for name, histogram in sorted(histograms.items())},
+        }
+        if per_node:
+            snapshot['nodes'] = {node_id: dict(sorted(metrics.counters.items())) for node_id, metrics in sorted(self.nodes.items())}
+        return snapshot
+
+    def export_json(self, path: str, per_node: bool = False):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(per_node), f, indent=2)
+
+    def format_table(self) -> str:
+        snapshot = self.snapshot()
+        lines = [f"{name:<24}{value:>12}" for name, value in snapshot['counters'].items()]
+        for name, histogram in snapshot['histograms'].items():
+            lines.append(f"{name:<24}{histogram['count']:>12}  mean {histogram['mean'] * 1e6:.1f}us  p95 <= {histogram['p95'] * 1e6:.1f}us  total {histogram['sum']:.4f}s")
+        return "\n".join(lines)
+
+
+def enable_metrics(topo: Topology, registry: MetricsRegistry = None) -> MetricsRegistry:
+    # Passing registry=None creates a new registry, use disable_metrics to turn recording off
+    if registry is None:
+        registry = MetricsRegistry()
+    for node in topo.nodes:
+        topo.nodes[node].app_layer.metrics = registry.node(node)
+    return registry
+
+def disable_metrics(topo: Topology):
+    for node in topo.nodes:
+        topo.nodes[node].app_layer.metrics = None
@@ -0,0 +1,245 @@
+import math
+from typing import Callable, Dict, List
+
+from TORA.TORASimulation import TORASimulation
+
+'''
+Neighbor sensing for simulated TORA nodes.
+Without it, TORASimulation.remove_link and add_link tell both ends about a link change at once.
+With NeighborSensing attached, link changes only change the graph, and the nodes find out
+themselves:
+    - every node broadcasts a HELLO beacon that carries its current beacon interval
+    - any packet from an unknown neighbor is a new link: ApplicationLayerTORA.link_up, which
+      sends a QRY if a route is required
+    - a neighbor that stays silent for timeout_factor of its advertised interval is a lost link:
+      ApplicationLayerTORA.link_down, which starts route maintenance (case 1)
+    - beacons carry a restart counter, a neighbor that restarted (TORASimulation.recover_node)
+      is handled as a lost and a new link, since it lost its routing state
+
+Beacon intervals adapt like Trickle timers: the interval doubles while the neighborhood of a
+node is stable, up to max_interval, and drops to min_interval when a link appears or is lost.
+To bound the load on dense graphs, a node never beacons more often than max_beacon_rate /
+degree times per second, so a node of a graph with similar degrees hears about max_beacon_rate
+beacons per second whatever its degree. A node that broadcast a control packet since its
+last beacon skips the next one, its neighbors just heard from it.
+
+All timers (beacons and neighbor timeouts) live in one TimerWheel, which the simulation
+advances every tick. HELLO beacons are not control packets: they are not counted in
+delivered_messages and do not reach the application layer.
+'''
+class Timer:
+    __slots__ = ("tick", "callback", "args", "cancelled")
+
+    def __init__(self, tick: int, callback: Callable, args: tuple):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerWheel:
+    '''
+    Hashed timing wheel: a timer due at tick t waits in slot t % slots. Scheduling and
+    cancelling are O(1), advancing by one tick only looks at the timers of one slot.
+    Timers more than a full turn ahead stay in their slot until their tick comes.
+    '''
+    def __init__(self, tick: float, slots: int = 512, now: float = 0.0):
+        self.tick = tick
+        self.slots: List[List[Timer]] = [[] for _ in range(slots)]
+        self.current_tick = math.floor(now / tick)
+        self.active: int = 0
+
+    def schedule(self, deadline: float, callback: Callable, *args) -> Timer:
+        # Fires at the first tick at or after deadline, but never in the current tick
+        tick = max(math.ceil(deadline / self.tick), self.current_tick + 1)
+        timer = Timer(tick, callback, args)
+        self.slots[tick % len(self.slots)].append(timer)
+        self.active += 1
+        return timer
+
+    def cancel(self, timer: Timer):
+        # The timer is dropped when its slot comes around
+        if not timer.cancelled:
+            timer.cancelled = True
+            self.active -= 1
+
+    def advance(self, now: float) -> int:
+        # Fires every timer due up to now, returns how many fired
+        fired = 0
+        target = math.floor(now / self.tick)
+        while self.current_tick < target:
+            self.current_tick += 1
+            index = self.current_tick % len(self.slots)
+            timers = self.slots[index]
+            self.slots[index] = []
+            for timer in timers:
+                if timer.cancelled:
+                    continue
+                if timer.tick > self.current_tick:
+                    self.slots[index].append(timer)
+                    continue
+                self.active -= 1
+                timer.cancelled = True
+                timer.callback(*timer.args)
+                fired += 1
+        return fired
+
+
+class NodeSensing:
+    # Neighbor table and beacon state of one node
+    __slots__ = ("interval", "changed", "messages_sent", "last_heard", "timeouts", "epochs", "epoch", "beacon_timer")
+
+    def __init__(self, interval: float, epoch: int = 0):
+        self.interval = interval
+        # Counts the restarts of the node, a neighbor that sees it change knows the node lost its state
+        self.epoch = epoch
+        # A link appeared or was lost since the last beacon
+        self.changed = False
+        # Control packets the node had sent at its last beacon
+        self.messages_sent: int = 0
+        self.last_heard: Dict[int, float] = {}
+        # Time a silent neighbor is considered lost, from its advertised interval
+        self.timeouts: Dict[int, float] = {}
+        self.epochs: Dict[int, int] = {}
+        self.beacon_timer: Timer = None
+
+
+class NeighborSensing:
+    def __init__(self, simulation: TORASimulation, min_interval: float = 0.5, max_interval: float = 8.0, max_beacon_rate: float = 20.0, timeout_factor: float = 3.0, jitter: float = 0.1, tick: float = 0.05, slots: int = 512):
+        self.simulation = simulation
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_beacon_rate = max_beacon_rate
+        self.timeout_factor = timeout_factor
+        self.jitter = jitter
+        self.wheel = TimerWheel(tick, slots, simulation.scheduler.now)
+        self.nodes: Dict[int, NodeSensing] = {}
+        self.beacons_sent: int = 0
+        self.beacons_received: int = 0
+        self.beacons_skipped: int = 0
+        self.links_gained: int = 0
+        self.links_lost: int = 0
+
+    def start(self):
+        # Every node knows its neighbors at the start and sends its first beacon at a random time
+        simulation = self.simulation
+        now = simulation.scheduler.now
+        simulation.sensing = self
+        for node_id, node in simulation.nodes.items():
+            sensing = self.nodes[node_id] = NodeSensing(self.min_interval)
+            for neighbor in node.app_layer.neighbors:
+                sensing.last_heard[neighbor] = now
+                sensing.timeouts[neighbor] = self.timeout(self.max_interval)
+                self.wheel.schedule(now + sensing.timeouts[neighbor], self.check_neighbor, node_id, neighbor, sensing)
+            sensing.beacon_timer = self.wheel.schedule(now + simulation.random.uniform(0, self.min_interval), self.beacon, node_id)
+        simulation.scheduler.schedule(self.wheel.tick, self.advance)
+
+    def stop(self):
+        self.simulation.sensing = None
+
+    def advance(self):
+        if self.simulation.sensing is not self:
+            return
+        self.wheel.advance(self.simulation.scheduler.now)
+        self.simulation.scheduler.schedule(self.wheel.tick, self.advance)
+
+    def timeout(self, interval: float) -> float:
+        return self.timeout_factor * interval * (1 + self.jitter) + self.simulation.max_delay
+
+    def next_interval(self, node_id: int, sensing: NodeSensing) -> float:
+        if sensing.changed:
+            interval = self.min_interval
+        else:
+            interval = min(sensing.interval * 2, self.max_interval)
+        degree = len(self.simulation.nodes[node_id].app_layer.neighbors)
+        return max(interval, degree / self.max_beacon_rate)
+
+    def beacon(self, node_id: int):
+        simulation = self.simulation
+        sensing = self.nodes[node_id]
+        now = simulation.scheduler.now
+        recorder = simulation.nodes[node_id].app_layer.recorder
+        if recorder.messages_sent != sensing.messages_sent and not sensing.changed:
+            # The neighbors heard a control packet since the last beacon, the interval stays as advertised
+            self.beacons_skipped += 1
+        else:
+            sensing.interval = self.next_interval(node_id, sensing)
+            sensing.changed = False
+            for neighbor in simulation.G.neighbors(node_id):
+                delivery_time = now + simulation.random.uniform(simulation.min_delay, simulation.max_delay)
+                simulation.scheduler.schedule_at(delivery_time, self.receive_beacon, node_id, neighbor, sensing.interval, sensing.epoch)
+            self.beacons_sent += 1
+        sensing.messages_sent = recorder.messages_sent
+        delay = sensing.interval * (1 + simulation.random.uniform(-self.jitter, self.jitter))
+        sensing.beacon_timer = self.wheel.schedule(now + delay, self.beacon, node_id)
+
+    def receive_beacon(self, source_id: int, node_id: int, interval: float, epoch: int):
+        if not self.simulation.G.has_edge(source_id, node_id):
+            return
+        self.beacons_received += 1
+        sensing = self.nodes[node_id]
+        if sensing.epochs.get(source_id, epoch) != epoch and source_id in sensing.last_heard:
+            # The neighbor restarted while the link seemed up, its old heights are gone
+            self.lose_neighbor(node_id, source_id)
+        sensing.epochs[source_id] = epoch
+        self.heard(node_id, source_id, interval)
+
+    def heard(self, node_id: int, neighbor: int, interval: float = None):
+        # Called for every beacon and control packet node_id receives from neighbor
+        sensing = self.nodes[node_id]
+        now = self.simulation.scheduler.now
+        known = neighbor in sensing.last_heard
+        sensing.last_heard[neighbor] = now
+        if interval is not None:
+            sensing.timeouts[neighbor] = self.timeout(interval)
+        if known:
+            return
+        sensing.timeouts.setdefault(neighbor, self.timeout(self.max_interval))
+        self.wheel.schedule(now + sensing.timeouts[neighbor], self.check_neighbor, node_id, neighbor, sensing)
+        self.links_gained += 1
+        self.neighborhood_changed(node_id, sensing)
+        self.simulation.nodes[node_id].app_layer.link_up(neighbor)
+
+    def check_neighbor(self, node_id: int, neighbor: int, sensing: NodeSensing = None):
+        if sensing is not None and sensing is not self.nodes[node_id]:
+            # Timer of the node before a restart
+            return
+        sensing = self.nodes[node_id]
+        last_heard = sensing.last_heard.get(neighbor)
+        if last_heard is None:
+            return
+        now = self.simulation.scheduler.now
+        deadline = last_heard + sensing.timeouts[neighbor]
+        if deadline > now:
+            # Heard from since the timer was set, one timer per neighbor is rescheduled instead of one per packet
+            self.wheel.schedule(deadline, self.check_neighbor, node_id, neighbor, sensing)
+            return
+        self.lose_neighbor(node_id, neighbor)
+
+    def lose_neighbor(self, node_id: int, neighbor: int):
+        sensing = self.nodes[node_id]
+        del sensing.last_heard[neighbor]
+        del sensing.timeouts[neighbor]
+        self.links_lost += 1
+        self.neighborhood_changed(node_id, sensing)
+        self.simulation.nodes[node_id].app_layer.link_down(neighbor)
+
+    def restart(self, node_id: int):
+        # The node comes back without routing state and without neighbors, it learns them from their beacons
+        previous = self.nodes[node_id]
+        sensing = self.nodes[node_id] = NodeSensing(self.min_interval, previous.epoch + 1)
+        self.wheel.cancel(previous.beacon_timer)
+        self.simulation.nodes[node_id].app_layer.neighbors = []
+        sensing.beacon_timer = self.wheel.schedule(self.simulation.scheduler.now, self.beacon, node_id)
+
+    def neighborhood_changed(self, node_id: int, sensing: NodeSensing):
+        # Beacon soon, so that the neighbors learn about the change and the intervals shrink
+        sensing.changed = True
+        now = self.simulation.scheduler.now
+        if sensing.beacon_timer is not None and sensing.beacon_timer.tick * self.wheel.tick > now + self.min_interval:
+            self.wheel.cancel(sensing.beacon_timer)
+            sensing.beacon_timer = self.wheel.schedule(now + self.simulation.random.uniform(0, self.min_interval), self.beacon, node_id)
+
+    def beacon_rate(self, duration: float) -> float:
+        # Mean beacons received per node and second over duration
+        return self.beacons_received / max(len(self.nodes), 1) / duration
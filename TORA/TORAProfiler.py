@@ -0,0 +1,266 @@
+import datetime
+import json
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from adhoccomputing.Experimentation.Topology import Topology
+from adhoccomputing.Generics import EventTypes
+
+'''
+Opt-in profiling of TORA runs.
+
+HandlerProfiler wraps the handlers of every node with deterministic timers. Calls nest per
+thread, so each call is recorded under its full handler stack, e.g.
+    TORANode.on_message_from_bottom;GenericLinkLayer.on_message_from_bottom;...
+For every stack it keeps the call count, the total time and the self time (without nested
+handlers). Event handlers also record how long their event waited in the component queue
+("<queued>"), which shows the time spent in AHC queueing and thread switching.
+
+StackSampler samples the Python stacks of all threads instead, which covers code that is not
+wrapped (AHC internals, networkx) at the price of a sampling interval.
+
+Both write collapsed stacks (flamegraph.pl, inferno) and speedscope JSON files.
+'''
+APPLICATION_HANDLERS = [
+    "process_control_message",
+    "process_query_message",
+    "process_update_message",
+    "process_clear_message",
+    "process_arbitrary_message",
+    "maintenance_case_1",
+    "maintenance_case_2",
+    "maintenance_case_3",
+    "maintenance_case_4",
+    "maintenance_case_5",
+    "find_minimum_neighbor_height",
+    "find_downstream_links",
+    "find_upstream_links",
+    "update_neighbor_height",
+]
+EVENT_HANDLERS = {
+    EventTypes.MFRB: "on_message_from_bottom",
+    EventTypes.MFRT: "on_message_from_top",
+}
+QUEUED = "<queued>"
+
+class StackStatistics:
+    __slots__ = ("calls", "total", "self_time")
+
+    def __init__(self):
+        self.calls: int = 0
+        self.total: float = 0.0
+        self.self_time: float = 0.0
+
+
+def write_collapsed(path: str, stacks: Dict[Tuple[str, ...], float], unit: float = 1e6):
+    # One "frame;frame;frame weight" line per stack, weights in microseconds by default
+    with open(path, "w") as f:
+        for stack, weight in sorted(stacks.items()):
+            if weight > 0:
+                f.write(f"{';'.join(stack)} {round(weight * unit)}\n")
+
+def write_speedscope(path: str, stacks: Dict[Tuple[str, ...], float], name: str, unit: str = "seconds"):
+    frames: List[dict] = []
+    frame_index: Dict[str, int] = {}
+    samples = []
+    weights = []
+    for stack, weight in sorted(stacks.items()):
+        if weight <= 0:
+            continue
+        sample = []
+        for frame in stack:
+            if frame not in frame_index:
+                frame_index[frame] = len(frames)
+                frames.append({"name": frame})
+            sample.append(frame_index[frame])
+        samples.append(sample)
+        weights.append(weight)
+    document = {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": unit,
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+        "name": name,
+        "exporter": "TORAProfiler",
+    }
+    with open(path, "w") as f:
+        json.dump(document, f)
+
+
+class HandlerProfiler:
+    def __init__(self):
+        self.stacks: Dict[Tuple[str, ...], StackStatistics] = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def attach(self, topo: Topology):
+        '''
+        Wraps the handlers of every node of topo. Works on Topology (TORANode with its layers)
+        and on TORASimulation (bare application layers).
+        '''
+        for node_id in topo.nodes:
+            node = topo.nodes[node_id]
+            components = [node] + list(getattr(node, "components", []))
+            if node.app_layer not in components:
+                components.append(node.app_layer)
+            for component in components:
+                self.wrap_event_handlers(component)
+            self.wrap_methods(node.app_layer, APPLICATION_HANDLERS)
+            self.wrap_methods(node.app_layer.broadcaster, ["broadcast"], "ApplicationLayerTORA.Broadcaster")
+
+    def wrap_event_handlers(self, component):
+        if not hasattr(component, "eventhandlers"):
+            # Simulated application layers are called directly, without their event table
+            self.wrap_methods(component, list(EVENT_HANDLERS.values()))
+            return
+        prefix = type(component).__name__
+        for event_type, name in EVENT_HANDLERS.items():
+            handler = component.eventhandlers.get(event_type)
+            if handler is not None and not getattr(handler, "profiled", False):
+                wrapped = self.wrap(handler, f"{prefix}.{name}", event_handler=True)
+                component.eventhandlers[event_type] = wrapped
+                setattr(component, name, wrapped)
+
+    def wrap_methods(self, owner, names: List[str], prefix: str = None):
+        prefix = prefix or type(owner).__name__
+        for name in names:
+            method = getattr(owner, name, None)
+            if method is not None and not getattr(method, "profiled", False):
+                setattr(owner, name, self.wrap(method, f"{prefix}.{name}"))
+
+    def wrap(self, method, frame: str, event_handler: bool = False):
+        profiler = self
+
+        def profiled(*args, **kwargs):
+            local = profiler.local
+            stack = getattr(local, "stack", None)
+            if stack is None:
+                stack = local.stack = []
+                local.children = []
+            if event_handler and not stack:
+                eventobj = kwargs.get("eventobj", args[0] if args else None)
+                if eventobj is not None and getattr(eventobj, "time", None) is not None:
+                    waited = (datetime.datetime.now() - eventobj.time).total_seconds()
+                    profiler.record((frame, QUEUED), waited, waited)
+            stack.append(frame)
+            local.children.append(0.0)
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                children = local.children.pop()
+                key = tuple(stack)
+                stack.pop()
+                if local.children:
+                    local.children[-1] += elapsed
+                profiler.record(key, elapsed, elapsed - children)
+
+        profiled.profiled = True
+        return profiled
+
+    def record(self, stack: Tuple[str, ...], elapsed: float, self_time: float):
+        with self.lock:
+            statistics = self.stacks.get(stack)
+            if statistics is None:
+                statistics = self.stacks[stack] = StackStatistics()
+            statistics.calls += 1
+            statistics.total += elapsed
+            statistics.self_time += self_time
+
+    def cost_table(self) -> List[dict]:
+        '''
+        Cost per handler over all stacks it appears in, most expensive (self time) first.
+        Total time is only counted for the outermost call of a handler, so recursion is not
+        counted twice.
+        '''
+        handlers: Dict[str, dict] = {}
+        with self.lock:
+            stacks = list(self.stacks.items())
+        for stack, statistics in stacks:
+            frame = stack[-1] if stack[-1] != QUEUED else stack[0] + " " + QUEUED
+            entry = handlers.setdefault(frame, {'handler': frame, 'calls': 0, 'total': 0.0, 'self': 0.0})
+            entry['calls'] += statistics.calls
+            entry['self'] += statistics.self_time
+            if stack.count(stack[-1]) == 1:
+                entry['total'] += statistics.total
+        for entry in handlers.values():
+            entry['mean'] = entry['total'] / entry['calls'] if entry['calls'] else 0.0
+        return sorted(handlers.values(), key=lambda entry: entry['self'], reverse=True)
+
+    def format_table(self) -> str:
+        lines = [f"{'handler':<64}{'calls':>10}{'total (s)':>12}{'self (s)':>12}{'mean (us)':>12}"]
+        for entry in self.cost_table():
+            lines.append(f"{entry['handler']:<64}{entry['calls']:>10}{entry['total']:>12.4f}{entry['self']:>12.4f}{entry['mean'] * 1e6:>12.1f}")
+        return "\n".join(lines)
+
+    def self_times(self) -> Dict[Tuple[str, ...], float]:
+        with self.lock:
+            return {stack: statistics.self_time for stack, statistics in self.stacks.items()}
+
+    def write_collapsed(self, path: str):
+        write_collapsed(path, self.self_times())
+
+    def write_speedscope(self, path: str, name: str = "TORA"):
+        write_speedscope(path, self.self_times(), name)
+
+
+class StackSampler:
+    '''
+    Samples the stacks of all other threads every `interval` seconds while running.
+    '''
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.samples: Dict[Tuple[str, ...], int] = {}
+        self.running = threading.Event()
+        self.thread: threading.Thread = None
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.sample_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def sample_loop(self):
+        own_id = threading.get_ident()
+        while self.running.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = tuple(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+            time.sleep(self.interval)
+
+    def weights(self) -> Dict[Tuple[str, ...], float]:
+        return {stack: count * self.interval for stack, count in self.samples.items()}
+
+    def write_collapsed(self, path: str):
+        write_collapsed(path, self.weights())
+
+    def write_speedscope(self, path: str, name: str = "TORA"):
+        write_speedscope(path, self.weights(), name)
@@ -0,0 +1,177 @@
+from typing import Dict, List, Tuple
+
+import networkx as nx
+import numpy as np
+
+from adhoccomputing.Experimentation.Topology import Topology
+
+from TORA.TORAComponent import TORAHeight
+
+'''
+Vectorized reference solver for TORA.
+After route creation from a destination with height (tau, oid, r, 0, d), the nodes of the
+connected component of d have heights (tau, oid, r, delta, i) and every link points from the
+higher to the lower end. The reference solution takes delta as the hop distance to d (BFS),
+which is the smallest delta the QRY/UPD flood can produce. It is computed with array
+operations on a CSR copy of the graph, one level of the BFS per step.
+
+A solution can be used to
+    - validate a distributed run (validate), the heights must form a destination-oriented DAG,
+      every node must see the current heights of its neighbors and, if the QRY flood reached
+      everything, every reachable node must have a height
+    - seed the heights of all nodes (seed_heights) before a failure experiment, instead of
+      running the full route creation
+'''
+def adjacency_arrays(G: nx.Graph) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Returns (nodes, indptr, indices): the neighbors of nodes[p] are
+    nodes[indices[indptr[p]:indptr[p + 1]]], indices are positions in nodes.
+    '''
+    nodes = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+    edges = np.array(G.edges, dtype=np.int64).reshape(-1, 2)
+    order = np.argsort(nodes, kind="stable")
+    positions = order[np.searchsorted(nodes, edges, sorter=order)]
+    sources = np.concatenate([positions[:, 0], positions[:, 1]])
+    targets = np.concatenate([positions[:, 1], positions[:, 0]])
+    by_source = np.lexsort((targets, sources))
+    indices = targets[by_source]
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(nodes)), out=indptr[1:])
+    return nodes, indptr, indices
+
+def gather_neighbors(indptr: np.ndarray, indices: np.ndarray, frontier: np.ndarray) -> np.ndarray:
+    # Concatenated neighbor lists of all frontier positions
+    starts = indptr[frontier]
+    counts = indptr[frontier + 1] - starts
+    total = counts.sum()
+    if total == 0:
+        return indices[:0]
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return indices[offsets + np.arange(total)]
+
+def bfs_distances(indptr: np.ndarray, indices: np.ndarray, source: int) -> np.ndarray:
+    # Hop distance of every position from source, -1 for unreachable positions
+    distances = np.full(len(indptr) - 1, -1, dtype=np.int64)
+    distances[source] = 0
+    frontier = np.array([source], dtype=np.int64)
+    level = 0
+    while len(frontier):
+        level += 1
+        reached = gather_neighbors(indptr, indices, frontier)
+        reached = np.unique(reached[distances[reached] < 0])
+        distances[reached] = level
+        frontier = reached
+    return distances
+
+
+class ReferenceSolution:
+    def __init__(self, G: nx.Graph, destination_id: int, tau: float = 0, oid: int = 0, r: int = 0):
+        self.destination_id = destination_id
+        self.reference_level = (tau, oid, r)
+        self.nodes, self.indptr, self.indices = adjacency_arrays(G)
+        self.position: Dict[int, int] = {node: position for position, node in enumerate(self.nodes.tolist())}
+        self.delta = bfs_distances(self.indptr, self.indices, self.position[destination_id])
+
+        # Directed links of the DAG, from the higher to the lower height. Heights on one reference
+        # level compare on (delta, i).
+        sources = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+        targets = self.indices
+        reachable = self.delta[sources] >= 0
+        lower = (self.delta[targets] < self.delta[sources]) | ((self.delta[targets] == self.delta[sources]) & (self.nodes[targets] < self.nodes[sources]))
+        downstream = reachable & lower
+        self.edge_sources = self.nodes[sources[downstream]]
+        self.edge_targets = self.nodes[targets[downstream]]
+
+    @property
+    def reachable(self) -> np.ndarray:
+        return self.nodes[self.delta >= 0]
+
+    def height(self, node: int) -> TORAHeight:
+        delta = int(self.delta[self.position[node]])
+        if delta < 0:
+            return TORAHeight.null(node)
+        return TORAHeight(*self.reference_level, delta, node)
+
+    def heights(self) -> Dict[int, TORAHeight]:
+        return {node: self.height(node) for node in self.nodes.tolist()}
+
+    def edges(self) -> List[Tuple[int, int]]:
+        # Same form as all_edges: (node, downstream neighbor)
+        return list(zip(self.edge_sources.tolist(), self.edge_targets.tolist()))
+
+    def validate(self, topo: Topology, complete: bool = False, maintained: bool = False) -> dict:
+        '''
+        Checks the state of a run (Topology, TORATopology or TORASimulation) that created routes to
+        this destination. Returns a report, report['valid'] is True when all checks pass:
+            missing         reachable nodes without a height, only a failure with complete, since
+                            route creation stops at nodes that already know a route
+            unexpected      unreachable nodes with a height
+            no_downstream   nodes other than the destination without downstream link (the DAG is not destination-oriented)
+            stale           links where a node holds another height for its neighbor than the neighbor has
+            below_reference nodes on the reference level of the destination with a delta below the hop distance,
+                            not a failure with maintained: once links changed (see TORAWorkload), nodes that
+                            keep a downstream link keep their delta although their distance grew
+        optimal counts the nodes whose delta is the hop distance.
+        '''
+        count = len(self.nodes)
+        has_height = np.zeros(count, dtype=bool)
+        on_reference_level = np.zeros(count, dtype=bool)
+        delta = np.full(count, -1, dtype=np.int64)
+        downstream = np.zeros(count, dtype=np.int64)
+        stale = []
+        own_heights = {}
+        for position, node in enumerate(self.nodes.tolist()):
+            state = topo.nodes[node].app_layer.state(self.destination_id)
+            height = state.height
+            own_heights[node] = height
+            if not height.is_null:
+                has_height[position] = True
+                on_reference_level[position] = tuple(height.reference_level) == self.reference_level
+                delta[position] = height.delta
+                downstream[position] = state.downstream_count()
+        for position, node in enumerate(self.nodes.tolist()):
+            neighbor_heights = topo.nodes[node].app_layer.state(self.destination_id).neighbor_heights
+            for neighbor in self.nodes[self.indices[self.indptr[position]:self.indptr[position + 1]]].tolist():
+                seen = neighbor_heights.get(neighbor)
+                actual = own_heights[neighbor]
+                if (seen[0] if seen is not None else TORAHeight.null(neighbor)) != actual:
+                    stale.append((node, neighbor))
+
+        reachable = self.delta >= 0
+        destination = self.nodes == self.destination_id
+        missing = self.nodes[reachable & ~has_height]
+        unexpected = self.nodes[~reachable & has_height]
+        no_downstream = self.nodes[has_height & ~destination & (downstream == 0)]
+        below_reference = self.nodes[on_reference_level & reachable & (delta < self.delta)]
+        report = {
+            'nodes': count,
+            'reachable': int(reachable.sum()),
+            'missing': missing.tolist(),
+            'unexpected': unexpected.tolist(),
+            'no_downstream': no_downstream.tolist(),
+            'stale': stale,
+            'below_reference': below_reference.tolist(),
+            'optimal': int((has_height & reachable & (delta == self.delta)).sum()),
+        }
+        report['valid'] = not ((complete and report['missing']) or report['unexpected'] or report['no_downstream'] or report['stale'] or (not maintained and report['below_reference']))
+        return report
+
+    def seed_heights(self, topo: Topology):
+        '''
+        Gives every node of topo its reference height and the heights of its neighbors, as if the
+        route creation had finished. Nodes that can not reach the destination keep a NULL height.
+        '''
+        heights = self.heights()
+        for node in self.nodes.tolist():
+            app_layer = topo.nodes[node].app_layer
+            now = app_layer.clock.now()
+            state = app_layer.state(self.destination_id)
+            state.height = heights[node]
+            state.route_required = False
+            state.last_update = now
+            for neighbor in app_layer.neighbors:
+                state.set_neighbor_height(neighbor, heights[neighbor], now)
+
+
+def solve(G: nx.Graph, destination_id: int, tau: float = 0, oid: int = 0, r: int = 0) -> ReferenceSolution:
+    return ReferenceSolution(G, destination_id, tau, oid, r)
@@ -0,0 +1,339 @@
+import math
+import multiprocessing
+import os
+import queue
+import struct
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+
+import networkx as nx
+
+from adhoccomputing.Generics import ConnectorTypes, GenericMessage, GenericMessageHeader
+
+import numpy as np
+
+from TORA.TORACheckpoint import Checkpoint
+from TORA.TORAComponent import ApplicationLayerTORA, TORAHeight
+from TORA.TORASimulation import TORASimulation, SimulatedChannel, SimulatedTORANode
+from TORA.TORAWireFormat import TORAWireCodec, FRAME_HEADER, FRAME_MARKER, MESSAGE_TYPES
+
+'''
+Process-sharded TORA execution.
+The graph is cut into shards by BFS order, and every shard runs the TORASimulation of its own
+nodes in a separate process, so route creation on large graphs uses all cores instead of one.
+A route creation is a wave through the graph and keeps few shards busy at a time, routes to
+several destinations at once (create_routes) keep all of them busy.
+Messages between shards are encoded control packets or frames of packets (TORAWireFormat),
+each prefixed with the id of the receiving node, its size and its delivery time, and are
+shipped in bulk over multiprocessing queues. Data packets can not cross shards, sending one
+raises TypeError.
+The shards advance in lockstep windows no longer than the minimum link delay: a packet sent
+in a window is delivered in a later one, so every shard processes its events in the same
+timestamp order as a single TORASimulation would. The coordinator skips to the earliest
+pending event after every window and is done when no shard has one left.
+'''
+RECEIVER = struct.Struct("!IId")
+
+# Commands put on the inbox of a shard
+FRAME = "FRAME"
+SET_HEIGHT = "SET_HEIGHT"
+QUERY = "QUERY"
+STEP = "STEP"
+COLLECT = "COLLECT"
+CHECKPOINT = "CHECKPOINT"
+STOP = "STOP"
+
+# Seconds the coordinator waits for a shard before it checks that all shards are still alive
+SHARD_TIMEOUT = 1.0
+
+def partition_graph(G: nx.Graph, parts: int) -> Dict[int, int]:
+    '''
+    Assigns every node to one of `parts` shards of equal size. Every shard is grown by a BFS
+    over the unassigned nodes, from where the previous shard stopped (the first one from a
+    minimum degree node), so a shard is a connected region and few links cross shards.
+    '''
+    chunk = max(1, math.ceil(G.number_of_nodes() / parts))
+    assignment: Dict[int, int] = {}
+    starts = sorted(G.nodes, key=G.degree)
+    frontier: Iterable[int] = ()
+    part = 0
+    size = 0
+    while len(assignment) < G.number_of_nodes():
+        # A shard whose region is enclosed by other shards goes on from another unassigned node
+        start = next((node for node in frontier if node not in assignment), None)
+        if start is None:
+            start = next(node for node in starts if node not in assignment)
+        pending = deque([start])
+        while pending and size < chunk:
+            node = pending.popleft()
+            if node in assignment:
+                continue
+            assignment[node] = part
+            size += 1
+            pending.extend(neighbor for neighbor in G.neighbors(node) if neighbor not in assignment)
+        frontier = pending
+        if size == chunk:
+            part += 1
+            size = 0
+    return assignment
+
+
+class ShardSimulation(TORASimulation):
+    '''
+    TORASimulation of the nodes of one shard. Deliveries to nodes of other shards are
+    collected per shard and sent as one frame at the end of every window.
+    '''
+    def __init__(self, shard_id: int, assignment: Dict[int, int], shard_count: int, seed: int = None,
+                 min_delay: float = 0.001, max_delay: float = 0.002):
+        super().__init__(seed=seed, min_delay=min_delay, max_delay=max_delay)
+        self.shard_id = shard_id
+        self.assignment = assignment
+        self.outboxes: List[bytearray] = [bytearray() for _ in range(shard_count)]
+        self.remote_sent: int = 0
+        self.remote_received: int = 0
+        self.frames_received: int = 0
+        # Earliest delivery time of the packets in the outboxes
+        self.earliest_remote: float = math.inf
+        # CPU time spent handling commands, the sum over the shards is the work, the maximum bounds the speedup
+        self.busy: float = 0.0
+
+    def construct_from_graph(self, G: nx.Graph, applicationtype=ApplicationLayerTORA):
+        self.G = G
+        codec = TORAWireCodec()
+        for i in G.nodes:
+            if self.assignment[i] != self.shard_id:
+                continue
+            app_layer = applicationtype("ApplicationLayer", i, self, num_worker_threads=0)
+            app_layer.connect_me_to_component(ConnectorTypes.DOWN, SimulatedChannel(self, i))
+            app_layer.codec = codec
+            app_layer.clock = self.clock
+            self.nodes[i] = SimulatedTORANode(i, app_layer)
+
+    def schedule_delivery(self, source_id: int, destination_id: int, message):
+        shard = self.assignment[destination_id]
+        if shard == self.shard_id:
+            super().schedule_delivery(source_id, destination_id, message)
+        else:
+            payload = message.payload
+            if not isinstance(payload, (bytes, bytearray, memoryview)):
+                raise TypeError(f"Only encoded control packets can be sent to another shard, not {type(payload).__name__} (from {source_id} to {destination_id})")
+            link = (source_id, destination_id)
+            delivery_time = self.scheduler.now + self.random.uniform(self.min_delay, self.max_delay)
+            delivery_time = max(delivery_time, self.link_busy_until.get(link, 0.0))
+            self.link_busy_until[link] = delivery_time
+            self.earliest_remote = min(self.earliest_remote, delivery_time)
+            outbox = self.outboxes[shard]
+            outbox += RECEIVER.pack(destination_id, len(payload), delivery_time)
+            outbox += payload
+            self.remote_sent += 1
+
+    def receive_frame(self, frame: bytes):
+        view = memoryview(frame)
+        offset = 0
+        while offset < len(view):
+            receiver, size, delivery_time = RECEIVER.unpack_from(view, offset)
+            offset += RECEIVER.size
+            # A frame holds packets of one type (see ApplicationLayerTORA.Broadcaster.broadcast_batch)
+            code = view[offset + FRAME_HEADER.size] if view[offset] == FRAME_MARKER else view[offset]
+            header = GenericMessageHeader(MESSAGE_TYPES[code], None, receiver)
+            # The application layer decodes the packet straight from the frame
+            self.scheduler.schedule_at(delivery_time, self.deliver, receiver, GenericMessage(header, view[offset:offset + size]))
+            offset += size
+            self.remote_received += 1
+        self.frames_received += 1
+
+    def flush(self, inboxes) -> List[int]:
+        # Returns the number of frames sent to every shard
+        sent = [0] * len(self.outboxes)
+        for shard, outbox in enumerate(self.outboxes):
+            if outbox:
+                inboxes[shard].put((FRAME, bytes(outbox)))
+                outbox.clear()
+                sent[shard] = 1
+        return sent
+
+    def step(self, until: float, inboxes) -> Tuple[List[int], float]:
+        '''
+        Processes the events up to `until` and sends the frames for the other shards.
+        Returns the frames sent to every shard and the time of the earliest pending event,
+        local or in one of the frames.
+        '''
+        self.run(until)
+        # The shards share one time base, the next window starts where this one ended
+        self.scheduler.now = max(self.scheduler.now, until)
+        queue = self.scheduler.queue
+        next_event = min(queue[0][0] if queue else math.inf, self.earliest_remote)
+        self.earliest_remote = math.inf
+        return self.flush(inboxes), next_event
+
+    def set_height(self, node_id: int, height: TORAHeight, destination_id: int):
+        # Same as ApplicationLayerTORA.set_height, restricted to the nodes of this shard
+        if node_id in self.nodes:
+            self.nodes[node_id].app_layer.state(destination_id).height = height
+        for neighbor in self.G.neighbors(node_id):
+            if neighbor in self.nodes:
+                self.nodes[neighbor].app_layer.update_neighbor_height(node_id, height, destination_id)
+
+    def collect(self, destination_id: int):
+        heights = {i: node.app_layer.state(destination_id).height for i, node in self.nodes.items()}
+        messages = sum(node.app_layer.recorder.messages_received for node in self.nodes.values())
+        return heights, messages
+
+    def checkpoint(self) -> Tuple[np.ndarray, np.ndarray]:
+        # A shard can be empty when there are more shards than nodes
+        checkpoint = Checkpoint.from_topology(self) if self.nodes else Checkpoint.empty()
+        return checkpoint.states, checkpoint.neighbors
+
+
+def shard_worker(shard_id: int, G: nx.Graph, assignment: Dict[int, int], inboxes, results, seed: int,
+                 min_delay: float, max_delay: float):
+    simulation = ShardSimulation(shard_id, assignment, len(inboxes), seed, min_delay, max_delay)
+    simulation.construct_from_graph(G)
+    inbox = inboxes[shard_id]
+    while True:
+        command = inbox.get()
+        started = time.process_time()
+        kind = command[0]
+        if kind == FRAME:
+            simulation.receive_frame(command[1])
+        elif kind == SET_HEIGHT:
+            simulation.set_height(*command[1:])
+        elif kind == QUERY:
+            _, destination_id, source_id = command
+            simulation.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
+        elif kind == STEP:
+            _, until, frames = command
+            # Frames of the previous window can still be on their way behind the command
+            while simulation.frames_received < frames:
+                simulation.receive_frame(inbox.get()[1])
+            results.put((STEP, shard_id) + simulation.step(until, inboxes))
+        elif kind == COLLECT:
+            results.put((COLLECT, shard_id, simulation.collect(command[1])))
+        elif kind == CHECKPOINT:
+            results.put((CHECKPOINT, shard_id, simulation.checkpoint(), simulation.busy))
+        elif kind == STOP:
+            # Frames for shards that stopped already are never read, they must not keep this process alive
+            for shard_inbox in inboxes:
+                shard_inbox.cancel_join_thread()
+            break
+        simulation.busy += time.process_time() - started
+
+
+class ShardedTORARunner:
+    def __init__(self, G: nx.Graph, shards: int = None, seed: int = None, min_delay: float = 0.001, max_delay: float = 0.002):
+        self.G = G
+        self.shards = shards or os.cpu_count()
+        self.seed = seed
+        self.assignment = partition_graph(G, self.shards)
+        self.inboxes = []
+        self.results = None
+        self.processes = []
+        # Simulated time all shards have reached, and the frames sent to every shard so far
+        self.now: float = 0.0
+        self.frames: List[int] = [0] * self.shards
+        # Length of a window, packets between shards take at least this long
+        self.window = min_delay
+        self.max_delay = max_delay
+        # CPU seconds per shard, set by checkpoint
+        self.busy: Dict[int, float] = {}
+
+    def cut_edges(self) -> int:
+        return sum(1 for u, v in self.G.edges if self.assignment[u] != self.assignment[v])
+
+    def start(self):
+        self.inboxes = [multiprocessing.Queue() for _ in range(self.shards)]
+        self.results = multiprocessing.Queue()
+        for shard_id in range(self.shards):
+            seed = None if self.seed is None else self.seed + shard_id
+            process = multiprocessing.Process(target=shard_worker, args=(shard_id, self.G, self.assignment, self.inboxes, self.results, seed, self.window, self.max_delay))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+    def exit(self):
+        for inbox in self.inboxes:
+            inbox.put((STOP,))
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def set_height(self, node_id: int, height: TORAHeight, destination_id: int = None):
+        if destination_id is None:
+            destination_id = node_id
+        # Every shard holding the node or one of its neighbors has to see the new height
+        for inbox in self.inboxes:
+            inbox.put((SET_HEIGHT, node_id, height, destination_id))
+
+    def process_query_message(self, destination_id: int, source_id: int):
+        self.inboxes[self.assignment[source_id]].put((QUERY, destination_id, source_id))
+
+    def wait_for_action_to_complete(self):
+        # The first window has no length, it only sends what the commands so far put in the outboxes
+        until = self.now
+        while True:
+            for shard_id, inbox in enumerate(self.inboxes):
+                inbox.put((STEP, until, self.frames[shard_id]))
+            next_event = math.inf
+            for _ in range(self.shards):
+                _, _, sent, shard_next_event = self.result()
+                self.frames = [frames + new for frames, new in zip(self.frames, sent)]
+                next_event = min(next_event, shard_next_event)
+            self.now = until
+            if next_event == math.inf:
+                return
+            until = max(next_event, self.now) + self.window
+
+    def collect(self, destination_id: int):
+        '''
+        Returns the heights of all nodes for destination_id and the number of handled messages.
+        '''
+        for inbox in self.inboxes:
+            inbox.put((COLLECT, destination_id))
+        heights: Dict[int, TORAHeight] = {}
+        messages = 0
+        for _ in range(self.shards):
+            _, _, (shard_heights, shard_messages) = self.result()
+            heights.update(shard_heights)
+            messages += shard_messages
+        return heights, messages
+
+    def checkpoint(self) -> Checkpoint:
+        '''
+        Gathers the state of all nodes, to restore it into a single TORASimulation (e.g. to
+        validate it with ReferenceSolution). Also sets busy, the CPU time of every shard so far.
+        '''
+        for inbox in self.inboxes:
+            inbox.put((CHECKPOINT,))
+        parts = {}
+        for _ in range(self.shards):
+            _, shard_id, arrays, busy = self.result()
+            parts[shard_id] = arrays
+            self.busy[shard_id] = busy
+        # The shards share one time base, so the timestamps fit together
+        states = np.concatenate([parts[shard_id][0] for shard_id in sorted(parts)])
+        neighbors = np.concatenate([parts[shard_id][1] for shard_id in sorted(parts)])
+        return Checkpoint(states, neighbors, 0.0)
+
+    def result(self):
+        # Next answer of a shard, raises RuntimeError if a shard died meanwhile (e.g. a TypeError in schedule_delivery)
+        while True:
+            try:
+                return self.results.get(timeout=SHARD_TIMEOUT)
+            except queue.Empty:
+                dead = [shard_id for shard_id, process in enumerate(self.processes) if not process.is_alive()]
+                if dead:
+                    raise RuntimeError(f"Shards {dead} stopped, see their traceback")
+
+    def create_route(self, source_id: int, destination_id: int):
+        self.set_height(destination_id, TORAHeight(0, 0, 0, 0, destination_id))
+        self.process_query_message(destination_id, source_id)
+        self.wait_for_action_to_complete()
+        return self.collect(destination_id)
+
+    def create_routes(self, routes: Iterable[Tuple[int, int]]):
+        # Creates the routes of all (source, destination) pairs at once
+        for source_id, destination_id in routes:
+            self.set_height(destination_id, TORAHeight(0, 0, 0, 0, destination_id))
+            self.process_query_message(destination_id, source_id)
+        self.wait_for_action_to_complete()
@@ -0,0 +1,205 @@
+import heapq
+import itertools
+import random
+from typing import Callable, Dict, List, Tuple
+
+import networkx as nx
+
+from adhoccomputing.Generics import ConnectorTypes, Event, EventTypes, MessageDestinationIdentifiers
+
+from TORA.TORAClock import SimulatedClock
+from TORA.TORAComponent import ApplicationLayerTORA
+
+'''
+Discrete-event simulation mode for TORA.
+Instead of the AHC stack (one worker thread per layer, per channel pipe), every node
+is a bare ApplicationLayerTORA without worker threads. A single scheduler keeps a
+priority queue of timestamped deliveries and calls on_message_from_bottom directly.
+Link delays are drawn from a seeded random generator and the nodes read the simulated time
+(SimulatedClock) for their reference levels, so a run is reproducible.
+'''
+class DiscreteEventScheduler:
+    def __init__(self):
+        self.now: float = 0.0
+        self.queue: List[Tuple[float, int, Callable, tuple]] = []
+        self.processed_events: int = 0
+        self._sequence = itertools.count()
+
+    def schedule(self, delay: float, callback: Callable, *args):
+        # The sequence number breaks ties, so events with equal timestamps run in FIFO order
+        heapq.heappush(self.queue, (self.now + delay, next(self._sequence), callback, args))
+
+    def schedule_at(self, timestamp: float, callback: Callable, *args):
+        self.schedule(max(timestamp - self.now, 0.0), callback, *args)
+
+    def pending(self) -> int:
+        return len(self.queue)
+
+    def run(self, until: float = float('inf'), max_events: int = None) -> int:
+        '''
+        Processes events in timestamp order until the queue is empty, the next event is
+        later than `until` or `max_events` events were processed. Returns the number of
+        processed events.
+        '''
+        processed = 0
+        queue = self.queue
+        while queue and queue[0][0] <= until:
+            if max_events is not None and processed >= max_events:
+                break
+            timestamp, _, callback, args = heapq.heappop(queue)
+            self.now = timestamp
+            callback(*args)
+            processed += 1
+        self.processed_events += processed
+        return processed
+
+
+class SimulatedChannel:
+    '''
+    Stands in for the network layer below a simulated ApplicationLayerTORA.
+    Everything the application layer sends down is handed to the simulation.
+    '''
+    def __init__(self, simulation, node_id: int):
+        self.componentname = "SimulatedChannel"
+        self.componentinstancenumber = node_id
+        self.simulation = simulation
+
+    def trigger_event(self, eventobj: Event):
+        self.simulation.transmit(self.componentinstancenumber, eventobj.eventcontent)
+
+
+class SimulatedTORANode:
+    __slots__ = ("componentinstancenumber", "app_layer")
+
+    def __init__(self, componentinstancenumber: int, app_layer: ApplicationLayerTORA):
+        self.componentinstancenumber = componentinstancenumber
+        self.app_layer = app_layer
+
+
+class TORASimulation:
+    '''
+    Drop-in replacement for Topology when running TORA as a discrete-event simulation.
+    It exposes the parts of the Topology interface used by TORA (nodes, G, get_neighbors),
+    so helpers such as heights() and all_edges() work on it unchanged.
+    '''
+    def __init__(self, seed: int = None, min_delay: float = 0.001, max_delay: float = 0.002):
+        self.G: nx.Graph = None
+        self.nodes: Dict[int, SimulatedTORANode] = {}
+        self.scheduler = DiscreteEventScheduler()
+        self.clock = SimulatedClock(self.scheduler)
+        self.random = random.Random(seed)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delivered_messages: int = 0
+        # Time of the last delivery scheduled on each directed link, keeps the links FIFO
+        self.link_busy_until: Dict[Tuple[int, int], float] = {}
+        # Messages in flight on a link that fails are lost
+        self.lost_messages: int = 0
+        # When set, collects the ids of the nodes messages are delivered to (see TORAWorkload)
+        self.touched: set = None
+        # Links of failed nodes, restored when the node recovers
+        self.failed_nodes: Dict[int, List[int]] = {}
+        # Control packets scheduled but not yet delivered or lost, and the time of the last delivery
+        self.in_flight: int = 0
+        self.last_delivery: float = 0.0
+        # NeighborSensing, when set the nodes detect link changes themselves
+        self.sensing = None
+
+    def construct_from_graph(self, G: nx.Graph, applicationtype=ApplicationLayerTORA):
+        self.G = G
+        for i in G.nodes:
+            app_layer = applicationtype("ApplicationLayer", i, self, num_worker_threads=0)
+            app_layer.connect_me_to_component(ConnectorTypes.DOWN, SimulatedChannel(self, i))
+            app_layer.clock = self.clock
+            self.nodes[i] = SimulatedTORANode(i, app_layer)
+
+    def get_neighbors(self, nodeId):
+        return sorted([neighbor for neighbor in self.G.neighbors(nodeId)])
+
+    def transmit(self, source_id: int, message):
+        destination_id = message.header.messageto
+        if destination_id == MessageDestinationIdentifiers.NETWORKLAYERBROADCAST:
+            # Every neighbor gets the same message object
+            for neighbor in self.G.neighbors(source_id):
+                self.schedule_delivery(source_id, neighbor, message)
+        elif self.G.has_edge(source_id, destination_id):
+            self.schedule_delivery(source_id, destination_id, message)
+
+    def schedule_delivery(self, source_id: int, destination_id: int, message):
+        link = (source_id, destination_id)
+        delivery_time = self.scheduler.now + self.random.uniform(self.min_delay, self.max_delay)
+        delivery_time = max(delivery_time, self.link_busy_until.get(link, 0.0))
+        self.link_busy_until[link] = delivery_time
+        self.in_flight += 1
+        self.scheduler.schedule_at(delivery_time, self.deliver_over_link, source_id, destination_id, message)
+
+    def deliver_over_link(self, source_id: int, destination_id: int, message):
+        self.in_flight -= 1
+        if not self.G.has_edge(source_id, destination_id):
+            self.lost_messages += 1
+            return
+        if self.sensing is not None:
+            self.sensing.heard(destination_id, source_id)
+        self.deliver(destination_id, message)
+
+    def deliver(self, destination_id: int, message):
+        self.delivered_messages += 1
+        self.last_delivery = self.scheduler.now
+        if self.touched is not None:
+            self.touched.add(destination_id)
+        self.nodes[destination_id].app_layer.on_message_from_bottom(Event(None, EventTypes.MFRB, message))
+
+    def remove_link(self, u: int, v: int):
+        '''
+        Both ends notice the failure at once, or through NeighborSensing if it is attached.
+        Changes self.G, which is the graph passed to construct_from_graph.
+        '''
+        if not self.G.has_edge(u, v):
+            return
+        self.G.remove_edge(u, v)
+        self.link_busy_until.pop((u, v), None)
+        self.link_busy_until.pop((v, u), None)
+        if self.sensing is not None:
+            return
+        self.nodes[u].app_layer.link_down(v)
+        self.nodes[v].app_layer.link_down(u)
+
+    def add_link(self, u: int, v: int):
+        if self.G.has_edge(u, v) or u in self.failed_nodes or v in self.failed_nodes:
+            return
+        self.G.add_edge(u, v)
+        if self.sensing is not None:
+            return
+        self.nodes[u].app_layer.link_up(v)
+        self.nodes[v].app_layer.link_up(u)
+
+    def fail_node(self, node_id: int):
+        # The node loses all links and its routing state, recover_node brings the links back
+        if node_id in self.failed_nodes:
+            return
+        neighbors = list(self.G.neighbors(node_id))
+        for neighbor in neighbors:
+            self.remove_link(node_id, neighbor)
+        self.failed_nodes[node_id] = neighbors
+        self.nodes[node_id].app_layer.reset()
+
+    def recover_node(self, node_id: int):
+        neighbors = self.failed_nodes.pop(node_id, None)
+        if neighbors is None:
+            return
+        if self.sensing is not None:
+            self.sensing.restart(node_id)
+        for neighbor in neighbors:
+            self.add_link(node_id, neighbor)
+
+    def start(self):
+        # Nothing to start, there are no threads. Kept for symmetry with Topology.
+        pass
+
+    def run(self, until: float = float('inf'), max_events: int = None) -> float:
+        '''
+        Runs the simulation until no message is in flight (or the limits are hit)
+        and returns the simulated time of the last processed event.
+        '''
+        self.scheduler.run(until, max_events)
+        return self.scheduler.now
@@ -0,0 +1,172 @@
+import gc
+from array import array
+from threading import Lock, Thread
+from typing import Dict
+
+import networkx as nx
+
+from adhoccomputing.Experimentation.Topology import Topology
+from adhoccomputing.GenericModel import GenericModel
+from adhoccomputing.Generics import ConnectorTypes, Event, EventTypes
+
+from TORA.TORAComponent import TORANode
+
+'''
+Fast construction of large TORA topologies.
+Topology.construct_from_graph computes all-pairs shortest paths (twice, once more in start),
+starts a worker thread for every component (four per node, four per GenericChannel) and
+sorts the neighbors of every node. TORATopology instead:
+    - keeps the adjacency once as CSR arrays, get_neighbors returns read-only views of them
+    - computes shortest paths only for the nodes that ask for a next hop
+    - connects nodes with TORAChannel, a single stage channel without threads
+    - starts the worker thread of a component when its first event arrives, so components
+      that never receive traffic never get a thread
+    - does not run the garbage collector while building
+'''
+class CSRAdjacency:
+    '''
+    Compressed sparse row adjacency: the neighbors of the node at position p are
+    indices[indptr[p]:indptr[p + 1]], in ascending order. Node ids must be integers.
+    '''
+    def __init__(self, nodes, indptr: array, indices: array):
+        self.position: Dict[int, int] = {node: position for position, node in enumerate(nodes)}
+        self.indptr = indptr
+        self.indices = indices
+        self.view = memoryview(indices).toreadonly()
+
+    @classmethod
+    def from_graph(cls, G: nx.Graph) -> "CSRAdjacency":
+        nodes = list(G.nodes)
+        indptr = array('q', [0])
+        indices = array('q')
+        adjacency = G.adj
+        for node in nodes:
+            indices.extend(sorted(adjacency[node]))
+            indptr.append(len(indices))
+        return cls(nodes, indptr, indices)
+
+    def neighbors(self, node: int) -> memoryview:
+        position = self.position[node]
+        return self.view[self.indptr[position]:self.indptr[position + 1]]
+
+    def degree(self, node: int) -> int:
+        position = self.position[node]
+        return self.indptr[position + 1] - self.indptr[position]
+
+
+def start_workers_lazily(component: GenericModel, num_worker_threads: int = 1):
+    '''
+    Defers the worker threads of a component that was created with num_worker_threads=0 until
+    its first event. The instance level trigger_event is removed once the threads run, so later
+    events take the normal GenericModel path.
+    '''
+    lock = Lock()
+
+    def trigger_event(eventobj: Event):
+        with lock:
+            if "trigger_event" in component.__dict__:
+                for _ in range(num_worker_threads):
+                    thread = Thread(target=component.queue_handler, args=[component.inputqueue], daemon=True)
+                    thread.start()
+                    component.t.append(thread)
+                del component.trigger_event
+        component.inputqueue.put_nowait(eventobj)
+
+    component.trigger_event = trigger_event
+
+def workers_started(component: GenericModel) -> bool:
+    return "trigger_event" not in component.__dict__
+
+
+class TORAChannel(GenericModel):
+    '''
+    Broadcast channel between the two ends of an edge. It has no pipeline stages and no
+    thread: a message is handed to the other end in the thread of the sender.
+    '''
+    def __init__(self, componentname, componentinstancenumber, context=None, configurationparameters=None, num_worker_threads=0, topology=None):
+        super().__init__(componentname, componentinstancenumber, context, configurationparameters, num_worker_threads, topology)
+
+    def trigger_event(self, eventobj: Event):
+        if eventobj.event == EventTypes.MFRT:
+            self.on_message_from_top(eventobj)
+
+    def on_message_from_top(self, eventobj: Event):
+        myevent = Event(self, EventTypes.MFRB,
+                        eventobj.eventcontent, fromchannel=self.componentinstancenumber,
+                        eventid=eventobj.eventid, eventsource_componentname=eventobj.eventsource_componentname, eventsource_componentinstancenumber=eventobj.eventsource_componentinstancenumber)
+        myevent.eventsource = None
+        self.send_up_from_channel(myevent, loopback=False)
+
+
+class TORATopology(Topology):
+    def __init__(self, name=None):
+        super().__init__(name)
+        # Per instance, Topology keeps these in class attributes shared by all topologies
+        self.nodes = {}
+        self.channels = {}
+        self.adjacency: CSRAdjacency = None
+        self.paths: Dict[int, Dict[int, list]] = {}
+        self.lazy_workers = True
+
+    def construct_from_graph(self, G: nx.Graph, nodetype=TORANode, channeltype=TORAChannel, context=None):
+        # Construction only allocates, collections in between would scan the growing topology again and again
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self.build(G, nodetype, channeltype)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def build(self, G: nx.Graph, nodetype, channeltype):
+        self.G = G
+        self.adjacency = CSRAdjacency.from_graph(G)
+        for i in G.nodes:
+            node = nodetype(nodetype.__name__, i, topology=self)
+            self.nodes[i] = node
+            for component in [node] + node.components:
+                start_workers_lazily(component)
+
+        for k in G.edges:
+            ch = channeltype(channeltype.__name__ + "-" + str(k[0]) + "-" + str(k[1]), str(k[0]) + "-" + str(k[1]))
+            self.channels[k] = ch
+            self.nodes[k[0]].connect_me_to_component(ConnectorTypes.DOWN, ch)
+            self.nodes[k[1]].connect_me_to_component(ConnectorTypes.DOWN, ch)
+            ch.connect_me_to_component(ConnectorTypes.UP, self.nodes[k[0]])
+            ch.connect_me_to_component(ConnectorTypes.UP, self.nodes[k[1]])
+
+    def get_neighbors(self, nodeId):
+        return self.adjacency.neighbors(nodeId)
+
+    def compute_forwarding_table(self):
+        # Paths are computed per source node in get_next_hop
+        pass
+
+    def get_next_hop(self, fromId, toId):
+        if self.G.has_edge(fromId, toId):
+            return toId
+        paths = self.paths.get(fromId)
+        if paths is None:
+            paths = self.paths[fromId] = nx.single_source_shortest_path(self.G, fromId)
+        path = paths.get(toId)
+        if path is None:
+            return float('inf')
+        return path[1] if len(path) > 1 else fromId
+
+    def start(self):
+        # TORA components do nothing on INIT, so no INIT events are sent and no thread is started here
+        for i in self.G.nodes:
+            self.nodes[i].initeventgenerated = True
+
+    def exit(self):
+        for i in self.G.nodes:
+            node = self.nodes[i]
+            for component in [node] + node.components:
+                if workers_started(component):
+                    component.trigger_event(Event(None, EventTypes.EXIT, None))
+                else:
+                    component.terminated = True
+            node.terminatestarted = True
+
+    def started_components(self) -> int:
+        return sum(workers_started(component) for i in self.G.nodes for component in [self.nodes[i]] + self.nodes[i].components)
@@ -0,0 +1,162 @@
+import struct
+from typing import Iterable, Iterator, List, Tuple
+
+from adhoccomputing.Experimentation.Topology import Topology
+
+from TORA.TORAComponent import TORAControlMessageTypes, TORAHeight, ReferenceLevel, QueryMessagePayload, UpdateMessagePayload, ClearMessagePayload
+
+'''
+Fixed-layout binary encoding of the TORA control packets.
+
+Every packet starts with a 10 byte header: packet type, flags, source id and destination id.
+    QRY: header only                                            (10 bytes)
+    UPD: header + height (tau, oid, r, delta, i)                (31 bytes)
+    CLR: header + reference level (tau, oid, r)                 (23 bytes)
+A frame packs several packets behind a 3 byte frame header (frame marker, packet count),
+so a frame holds at most MAX_FRAME_PACKETS packets.
+Packets have a fixed size per type, so no length fields are needed. Decoding works on
+memoryviews with struct.unpack_from and never copies the buffer.
+'''
+HEADER = struct.Struct("!BBII")
+HEIGHT = struct.Struct("!diBiI")
+REFERENCE_LEVEL = struct.Struct("!diB")
+FRAME_HEADER = struct.Struct("!BH")
+
+FRAME_MARKER = 0xFF
+MAX_FRAME_PACKETS = 0xFFFF
+FLAG_NULL = 0x01
+FLAG_LINK_REVERSAL = 0x02
+
+PACKET_TYPES = {
+    TORAControlMessageTypes.QRY: 1,
+    TORAControlMessageTypes.UPD: 2,
+    TORAControlMessageTypes.CLR: 3,
+}
+MESSAGE_TYPES = {code: messagetype for messagetype, code in PACKET_TYPES.items()}
+
+PACKET_SIZES = {
+    TORAControlMessageTypes.QRY: HEADER.size,
+    TORAControlMessageTypes.UPD: HEADER.size + HEIGHT.size,
+    TORAControlMessageTypes.CLR: HEADER.size + REFERENCE_LEVEL.size,
+}
+
+def encoded_size(messagetype: TORAControlMessageTypes) -> int:
+    return PACKET_SIZES[messagetype]
+
+def packet_size_at(buffer, offset: int = 0) -> int:
+    # Size of the packet starting at offset, read from its type byte
+    return PACKET_SIZES[MESSAGE_TYPES[buffer[offset]]]
+
+def encode_into(buffer, offset: int, messagetype: TORAControlMessageTypes, source_id: int, payload) -> int:
+    '''
+    Writes one packet into buffer at offset and returns the offset right after it.
+    '''
+    flags = 0
+    if messagetype == TORAControlMessageTypes.UPD:
+        height: TORAHeight = payload.height
+        if height.is_null:
+            flags |= FLAG_NULL
+        if payload.link_reversal:
+            flags |= FLAG_LINK_REVERSAL
+        HEADER.pack_into(buffer, offset, PACKET_TYPES[messagetype], flags, source_id, payload.destination_id)
+        if height.is_null:
+            HEIGHT.pack_into(buffer, offset + HEADER.size, 0.0, 0, 0, 0, height.i)
+        else:
+            HEIGHT.pack_into(buffer, offset + HEADER.size, height.tau, height.oid, height.r, height.delta, height.i)
+    elif messagetype == TORAControlMessageTypes.CLR:
+        reference_level = payload.reference_level
+        HEADER.pack_into(buffer, offset, PACKET_TYPES[messagetype], flags, source_id, payload.destination_id)
+        REFERENCE_LEVEL.pack_into(buffer, offset + HEADER.size, reference_level[0], reference_level[1], reference_level[2])
+    elif messagetype == TORAControlMessageTypes.QRY:
+        HEADER.pack_into(buffer, offset, PACKET_TYPES[messagetype], flags, source_id, payload.destination_id)
+    else:
+        raise Exception(f"Cannot encode message type {messagetype}")
+    return offset + PACKET_SIZES[messagetype]
+
+def encode_control_message(messagetype: TORAControlMessageTypes, source_id: int, payload) -> bytes:
+    buffer = bytearray(PACKET_SIZES[messagetype])
+    encode_into(buffer, 0, messagetype, source_id, payload)
+    return bytes(buffer)
+
+def decode_control_message(buffer, offset: int = 0):
+    '''
+    Reads one packet from buffer at offset.
+    Returns (messagetype, source_id, payload, offset right after the packet).
+    '''
+    code, flags, source_id, destination_id = HEADER.unpack_from(buffer, offset)
+    messagetype = MESSAGE_TYPES[code]
+    body = offset + HEADER.size
+    if messagetype == TORAControlMessageTypes.UPD:
+        tau, oid, r, delta, i = HEIGHT.unpack_from(buffer, body)
+        height = TORAHeight.null(i) if flags & FLAG_NULL else TORAHeight(tau, oid, r, delta, i)
+        payload = UpdateMessagePayload(destination_id, height, bool(flags & FLAG_LINK_REVERSAL))
+    elif messagetype == TORAControlMessageTypes.CLR:
+        payload = ClearMessagePayload(destination_id, ReferenceLevel(*REFERENCE_LEVEL.unpack_from(buffer, body)))
+    else:
+        payload = QueryMessagePayload(destination_id)
+    return messagetype, source_id, payload, offset + PACKET_SIZES[messagetype]
+
+def encode_batch(messages: Iterable[Tuple[TORAControlMessageTypes, int, object]]) -> bytes:
+    '''
+    Packs (messagetype, source_id, payload) triples into a single frame.
+    Raises ValueError for more than MAX_FRAME_PACKETS packets.
+    '''
+    messages = list(messages)
+    if len(messages) > MAX_FRAME_PACKETS:
+        raise ValueError(f"A frame holds at most {MAX_FRAME_PACKETS} packets, not {len(messages)}")
+    size = FRAME_HEADER.size + sum(PACKET_SIZES[messagetype] for messagetype, _, _ in messages)
+    buffer = bytearray(size)
+    FRAME_HEADER.pack_into(buffer, 0, FRAME_MARKER, len(messages))
+    offset = FRAME_HEADER.size
+    for messagetype, source_id, payload in messages:
+        offset = encode_into(buffer, offset, messagetype, source_id, payload)
+    return bytes(buffer)
+
+def decode_packets(buffer) -> Iterator[Tuple[TORAControlMessageTypes, int, object]]:
+    '''
+    Yields (messagetype, source_id, payload) for every packet in buffer,
+    which holds either a single packet or a frame.
+    '''
+    view = memoryview(buffer)
+    if view[0] == FRAME_MARKER:
+        _, count = FRAME_HEADER.unpack_from(view, 0)
+        offset = FRAME_HEADER.size
+    else:
+        count = 1
+        offset = 0
+    for _ in range(count):
+        messagetype, source_id, payload, offset = decode_control_message(view, offset)
+        yield messagetype, source_id, payload
+
+def decode_batch(buffer) -> List[Tuple[TORAControlMessageTypes, int, object]]:
+    return list(decode_packets(buffer))
+
+
+class TORAWireCodec:
+    '''
+    Codec handed to ApplicationLayerTORA. With a codec set, control packets travel
+    between layers as bytes instead of live payload objects.
+    '''
+    def encode(self, messagetype: TORAControlMessageTypes, source_id: int, payload) -> bytes:
+        return encode_control_message(messagetype, source_id, payload)
+
+    def encode_batch(self, messages: Iterable[Tuple[TORAControlMessageTypes, int, object]]) -> bytes:
+        return encode_batch(messages)
+
+    def decode(self, buffer) -> Iterator[Tuple[TORAControlMessageTypes, int, object]]:
+        return decode_packets(buffer)
+
+
+def use_wire_format(topo: Topology, codec: TORAWireCodec = None):
+    # Passing no codec switches the topology back to payload objects
+    for node in topo.nodes:
+        topo.nodes[node].app_layer.codec = codec
+
+def control_overhead(topo: Topology):
+    '''
+    Returns the control bytes put on the links so far (one copy per receiving neighbor)
+    and that number per edge of the topology.
+    '''
+    total = sum(topo.nodes[node].app_layer.recorder.bytes_sent for node in topo.nodes)
+    edges = topo.G.number_of_edges()
+    return total, (total / edges if edges else 0.0)
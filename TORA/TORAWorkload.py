@@ -0,0 +1,288 @@
+import random
+from enum import Enum
+from typing import Dict, List, NamedTuple, Tuple
+
+import networkx as nx
+import numpy as np
+
+from TORA.TORASimulation import TORASimulation
+
+'''
+Workloads for route maintenance experiments.
+A Workload is a list of timestamped topology changes (link breaks and additions, node failures
+and recoveries) that is played into a running TORASimulation. The changes can be scheduled one
+by one, drawn at random, or generated by a mobility model: nodes move in a plane and are linked
+while they are closer than a radio range.
+
+For every change, or set of changes at the same time, the workload records a Repair:
+    messages        control packets delivered from the change until the next change
+    latency         simulated time from the change to the last of these deliveries
+    nodes_touched   nodes that received at least one of these packets
+    spread          largest hop distance of a touched node from the ends of the changed link(s)
+    converged       False if packets were still in flight when the next change happened, the
+                    next repair then also counts them
+'''
+class WorkloadEventTypes(Enum):
+    LINK_DOWN = "LINK_DOWN"
+    LINK_UP = "LINK_UP"
+    NODE_DOWN = "NODE_DOWN"
+    NODE_UP = "NODE_UP"
+
+class WorkloadEvent(NamedTuple):
+    time: float
+    kind: WorkloadEventTypes
+    u: int
+    v: int = None
+
+
+class Repair:
+    # Events that happen at the same time (e.g. one step of a mobility model) are repaired together
+    __slots__ = ("events", "kind", "messages", "latency", "nodes_touched", "spread", "converged")
+
+    def __init__(self, events: List[WorkloadEvent]):
+        self.events = events
+        kinds = {event.kind for event in events}
+        self.kind: str = kinds.pop().name if len(kinds) == 1 else "MIXED"
+        self.messages: int = 0
+        self.latency: float = 0.0
+        self.nodes_touched: int = 0
+        self.spread: int = 0
+        self.converged: bool = True
+
+    @property
+    def time(self) -> float:
+        return self.events[0].time
+
+
+class Workload:
+    def __init__(self):
+        self.events: List[WorkloadEvent] = []
+
+    def link_down(self, time: float, u: int, v: int):
+        self.events.append(WorkloadEvent(time, WorkloadEventTypes.LINK_DOWN, u, v))
+
+    def link_up(self, time: float, u: int, v: int):
+        self.events.append(WorkloadEvent(time, WorkloadEventTypes.LINK_UP, u, v))
+
+    def node_down(self, time: float, node_id: int):
+        self.events.append(WorkloadEvent(time, WorkloadEventTypes.NODE_DOWN, node_id))
+
+    def node_up(self, time: float, node_id: int):
+        self.events.append(WorkloadEvent(time, WorkloadEventTypes.NODE_UP, node_id))
+
+    def random_link_failures(self, G: nx.Graph, count: int, interval: float, start: float = 0.0, recover_after: float = None, seed: int = None):
+        # Breaks count distinct random links of G, one every interval, and restores each one recover_after later
+        rng = random.Random(seed)
+        for k, (u, v) in enumerate(rng.sample(sorted(G.edges), count)):
+            time = start + k * interval
+            self.link_down(time, u, v)
+            if recover_after is not None:
+                self.link_up(time + recover_after, u, v)
+
+    def random_node_churn(self, G: nx.Graph, count: int, interval: float, downtime: float, start: float = 0.0, exclude=(), seed: int = None):
+        # Fails count distinct random nodes, one every interval, each for downtime
+        rng = random.Random(seed)
+        candidates = sorted(node for node in G.nodes if node not in exclude)
+        for k, node_id in enumerate(rng.sample(candidates, count)):
+            time = start + k * interval
+            self.node_down(time, node_id)
+            self.node_up(time + downtime, node_id)
+
+    def add_mobility(self, model: "MobilityModel", radius: float, duration: float, interval: float, start: float = 0.0) -> nx.Graph:
+        '''
+        Moves model for duration, sampling it every interval, and schedules a link event for every
+        link that appears or disappears between two samples. Returns the graph at start, which
+        the simulation has to be constructed from.
+        '''
+        initial = model.graph(radius)
+        links = set(initial.edges)
+        time = start
+        while time + interval <= start + duration:
+            time += interval
+            model.step(interval)
+            current = set(unit_disk_edges(model.nodes, model.positions, radius))
+            for u, v in sorted(links - current):
+                self.link_down(time, u, v)
+            for u, v in sorted(current - links):
+                self.link_up(time, u, v)
+            links = current
+        return initial
+
+    def apply(self, simulation: TORASimulation, event: WorkloadEvent):
+        if event.kind == WorkloadEventTypes.LINK_DOWN:
+            simulation.remove_link(event.u, event.v)
+        elif event.kind == WorkloadEventTypes.LINK_UP:
+            simulation.add_link(event.u, event.v)
+        elif event.kind == WorkloadEventTypes.NODE_DOWN:
+            simulation.fail_node(event.u)
+        elif event.kind == WorkloadEventTypes.NODE_UP:
+            simulation.recover_node(event.u)
+
+    def run(self, simulation: TORASimulation, settle: float = float('inf')) -> List[Repair]:
+        '''
+        Plays the events into simulation in time order, the simulation runs in between. Event times
+        are simulated seconds, the same clock as the link delays. The routes to the destinations
+        must exist before (route creation or ReferenceSolution.seed_heights).
+        The simulation runs for settle seconds after the last event, which has to be finite with
+        NeighborSensing, whose beacons never stop.
+        '''
+        batches: Dict[float, List[WorkloadEvent]] = {}
+        for event in sorted(self.events, key=lambda event: event.time):
+            batches.setdefault(event.time, []).append(event)
+        times = list(batches)
+        repairs = []
+        scheduler = simulation.scheduler
+        for k, time in enumerate(times):
+            scheduler.run(until=time)
+            if simulation.in_flight and repairs:
+                repairs[-1].converged = False
+            scheduler.now = max(scheduler.now, time)
+
+            repair = Repair(batches[time])
+            sources = set()
+            for event in repair.events:
+                if event.kind == WorkloadEventTypes.NODE_DOWN:
+                    # The failed node is cut off, distances are taken from its former neighbors
+                    sources.update(simulation.G.neighbors(event.u))
+                else:
+                    sources.update(node for node in (event.u, event.v) if node is not None)
+            delivered = simulation.delivered_messages
+            simulation.touched = set()
+            for event in repair.events:
+                self.apply(simulation, event)
+            scheduler.run(until=times[k + 1] if k + 1 < len(times) else time + settle)
+
+            repair.messages = simulation.delivered_messages - delivered
+            if repair.messages:
+                repair.latency = simulation.last_delivery - time
+            repair.nodes_touched = len(simulation.touched)
+            repair.spread = spread(simulation.G, sources, simulation.touched)
+            simulation.touched = None
+            repairs.append(repair)
+        return repairs
+
+
+def spread(G: nx.Graph, sources: set, touched: set) -> int:
+    if not touched or not sources:
+        return 0
+    distances = nx.multi_source_dijkstra_path_length(G, sources)
+    return max((distances[node] for node in touched if node in distances), default=0)
+
+def summarize(repairs: List[Repair]) -> Dict[str, dict]:
+    # Statistics of the repairs per event type, repairs of different event types at once are MIXED
+    summary = {}
+    for kind in [kind.name for kind in WorkloadEventTypes] + ["MIXED"]:
+        selected = [repair for repair in repairs if repair.kind == kind]
+        if not selected:
+            continue
+        latencies = np.array([repair.latency for repair in selected])
+        summary[kind] = {
+            'repairs': len(selected),
+            'converged': sum(repair.converged for repair in selected),
+            'messages_mean': float(np.mean([repair.messages for repair in selected])),
+            'messages_max': max(repair.messages for repair in selected),
+            'latency_mean': float(latencies.mean()),
+            'latency_p95': float(np.percentile(latencies, 95)),
+            'nodes_touched_mean': float(np.mean([repair.nodes_touched for repair in selected])),
+            'spread_mean': float(np.mean([repair.spread for repair in selected])),
+            'spread_max': max(repair.spread for repair in selected),
+        }
+    return summary
+
+def format_table(repairs: List[Repair]) -> str:
+    lines = [f"{'event':<12}{'repairs':>9}{'converged':>11}{'messages':>10}{'latency (ms)':>14}{'p95 (ms)':>10}{'touched':>9}{'spread':>8}{'max':>6}"]
+    for kind, entry in summarize(repairs).items():
+        lines.append(f"{kind:<12}{entry['repairs']:>9}{entry['converged']:>11}{entry['messages_mean']:>10.1f}{entry['latency_mean'] * 1e3:>14.2f}{entry['latency_p95'] * 1e3:>10.2f}{entry['nodes_touched_mean']:>9.1f}{entry['spread_mean']:>8.2f}{entry['spread_max']:>6}")
+    return "\n".join(lines)
+
+
+def unit_disk_edges(nodes: np.ndarray, positions: np.ndarray, radius: float) -> List[Tuple[int, int]]:
+    # Pairs of nodes closer than radius, (smaller id, larger id). Compares all pairs, one row at a time.
+    edges = []
+    for k in range(len(nodes) - 1):
+        distances = np.hypot(*(positions[k + 1:] - positions[k]).T)
+        for other in nodes[k + 1:][distances < radius].tolist():
+            u, v = int(nodes[k]), other
+            edges.append((u, v) if u < v else (v, u))
+    return edges
+
+
+class MobilityModel:
+    '''
+    Positions of nodes in a width x height plane. Subclasses move them in step(dt).
+    nodes are the node ids, positions[k] is the (x, y) position of nodes[k].
+    '''
+    def __init__(self, nodes, width: float = 1.0, height: float = 1.0, seed: int = None):
+        self.nodes = np.array(list(nodes), dtype=np.int64)
+        self.size = np.array([width, height])
+        self.rng = np.random.default_rng(seed)
+        self.positions = self.rng.uniform(0, 1, (len(self.nodes), 2)) * self.size
+
+    def step(self, dt: float):
+        raise NotImplementedError
+
+    def graph(self, radius: float) -> nx.Graph:
+        G = nx.Graph()
+        G.add_nodes_from(self.nodes.tolist())
+        G.add_edges_from(unit_disk_edges(self.nodes, self.positions, radius))
+        return G
+
+
+class RandomWaypoint(MobilityModel):
+    '''
+    Every node moves in a straight line to a random waypoint at a random speed, waits there for
+    pause seconds and picks the next waypoint.
+    '''
+    def __init__(self, nodes, width: float = 1.0, height: float = 1.0, speed: Tuple[float, float] = (0.01, 0.05), pause: float = 0.0, seed: int = None):
+        super().__init__(nodes, width, height, seed)
+        self.speed_range = speed
+        self.pause = pause
+        count = len(self.nodes)
+        self.waypoints = self.rng.uniform(0, 1, (count, 2)) * self.size
+        self.speeds = self.rng.uniform(*speed, count)
+        self.paused = np.zeros(count)
+
+    def step(self, dt: float):
+        self.paused = np.maximum(self.paused - dt, 0.0)
+        moving = self.paused == 0.0
+        offset = self.waypoints - self.positions
+        distance = np.hypot(offset[:, 0], offset[:, 1])
+        travel = self.speeds * dt
+        arrived = moving & (distance <= travel)
+        walking = moving & ~arrived
+        self.positions[walking] += offset[walking] * (travel[walking] / distance[walking])[:, None]
+        self.positions[arrived] = self.waypoints[arrived]
+
+        count = int(arrived.sum())
+        if count:
+            self.waypoints[arrived] = self.rng.uniform(0, 1, (count, 2)) * self.size
+            self.speeds[arrived] = self.rng.uniform(*self.speed_range, count)
+            self.paused[arrived] = self.pause
+
+
+class GroupMobility(MobilityModel):
+    '''
+    Reference point group mobility: the nodes are split into groups whose reference points move
+    as random waypoints, and every node wanders around its reference point within group_radius.
+    '''
+    def __init__(self, nodes, groups: int, width: float = 1.0, height: float = 1.0, speed: Tuple[float, float] = (0.01, 0.05), pause: float = 0.0, group_radius: float = 0.1, seed: int = None):
+        super().__init__(nodes, width, height, seed)
+        self.group_radius = group_radius
+        self.group = np.arange(len(self.nodes)) % groups
+        self.centers = RandomWaypoint(range(groups), width, height, speed, pause, seed=self.rng.integers(1 << 32))
+        self.offsets = self.random_offsets(len(self.nodes))
+        self.positions = self.centers.positions[self.group] + self.offsets
+
+    def random_offsets(self, count: int) -> np.ndarray:
+        angle = self.rng.uniform(0, 2 * np.pi, count)
+        distance = self.group_radius * np.sqrt(self.rng.uniform(0, 1, count))
+        return np.stack([distance * np.cos(angle), distance * np.sin(angle)], axis=1)
+
+    def step(self, dt: float):
+        self.centers.step(dt)
+        # Members drift by up to half the group radius per step and stay within the group radius
+        self.offsets += self.random_offsets(len(self.nodes)) * 0.5
+        distance = np.hypot(self.offsets[:, 0], self.offsets[:, 1])
+        outside = distance > self.group_radius
+        self.offsets[outside] *= (self.group_radius / distance[outside])[:, None]
+        self.positions = np.clip(self.centers.positions[self.group] + self.offsets, 0, self.size)
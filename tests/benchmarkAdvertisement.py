@@ -0,0 +1,72 @@
+import argparse
+import random
+
+import networkx as nx
+import numpy as np
+
+from TORA.TORAAdvertisement import AdvertisementScheduler, use_advertisement_scheduler
+from TORA.TORAMetrics import enable_metrics
+from TORA.TORAReference import solve
+from TORA.TORASimulation import TORASimulation
+from TORA.TORAWireFormat import TORAWireCodec, use_wire_format
+from TORA.TORAWorkload import RandomWaypoint, Workload
+
+'''
+UPD broadcasts during route maintenance, with and without an AdvertisementScheduler.
+Every run seeds the routes to several destinations (ReferenceSolution.seed_heights) and plays
+the same workload into a TORASimulation, once per window: random link failures on a small
+world graph, or a random waypoint mobility model. A window of 0 broadcasts every UPD at once.
+A run counts as routed when the heights of every destination pass ReferenceSolution.validate.
+'''
+def advertisement_run(scenario, size, destinations, window, seed, codec=False):
+    workload = Workload()
+    if scenario == "link_failures":
+        graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+        workload.random_link_failures(graph, 30, 1.0, start=1.0, recover_after=0.5, seed=seed)
+    else:
+        graph = workload.add_mobility(RandomWaypoint(range(size), speed=(0.01, 0.03), seed=seed), radius=0.15, duration=20, interval=0.5)
+    destination_ids = random.Random(seed).sample(sorted(graph.nodes), destinations)
+
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(graph.copy())
+    for destination_id in destination_ids:
+        solve(graph, destination_id).seed_heights(simulation)
+    registry = enable_metrics(simulation)
+    if codec:
+        use_wire_format(simulation, TORAWireCodec())
+    advertiser = AdvertisementScheduler(window, simulation.scheduler.schedule)
+    use_advertisement_scheduler(simulation, advertiser)
+    repairs = workload.run(simulation)
+
+    counters = registry.snapshot()['counters']
+    return {
+        'messages': simulation.delivered_messages,
+        'upd': counters.get('UPD.sent', 0),
+        'requested': advertiser.requested,
+        'saved': advertiser.saved,
+        'latency': float(np.mean([repair.latency for repair in repairs])),
+        'routed': all(solve(simulation.G, destination_id).validate(simulation, maintained=True)['valid'] for destination_id in destination_ids),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares UPD aggregation windows in messages per workload")
+    parser.add_argument("size", type=int)
+    parser.add_argument("--scenarios", nargs="+", default=["link_failures", "mobility"], choices=["link_failures", "mobility"])
+    parser.add_argument("--destinations", type=int, default=5)
+    parser.add_argument("--windows", nargs="+", type=float, default=[0.0, 0.002, 0.005, 0.02])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--wire-format", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{'scenario':<16}{'window (ms)':>12}{'messages':>10}{'UPD packets':>13}{'requested':>11}{'saved':>9}{'latency (ms)':>14}{'routed':>8}")
+    for scenario in args.scenarios:
+        for window in args.windows:
+            results = [advertisement_run(scenario, args.size, args.destinations, window, args.seed + run_no, args.wire_format) for run_no in range(args.runs)]
+            mean = {key: sum(result[key] for result in results) / len(results) for key in ('messages', 'upd', 'requested', 'saved', 'latency')}
+            routed = sum(result['routed'] for result in results)
+            print(f"{scenario:<16}{window * 1e3:>12.1f}{mean['messages']:>10.1f}{mean['upd']:>13.1f}{mean['requested']:>11.1f}{mean['saved']:>9.1f}{mean['latency'] * 1e3:>14.2f}{routed:>5}/{len(results)}")
+
+
+if __name__ == "__main__":
+    main()
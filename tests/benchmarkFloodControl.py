@@ -0,0 +1,69 @@
+import argparse
+
+from TORA.TORAComponent import TORAHeight
+from TORA.TORAFloodControl import FloodControl, ProbabilisticFloodControl, CounterFloodControl, CoverageFloodControl, use_flood_control
+from TORA.TORAMetrics import enable_metrics
+from TORA.TORAReference import solve
+from TORA.TORASimulation import TORASimulation
+
+from benchmarkResults import describe
+from benchmarkTORA import GRAPH_TYPES
+from topologyTORATest import TOTAL_RUNS, generate_source_destination, nx_graph
+
+'''
+Messages per route creation with and without QRY flood control, on the benchmark graph types.
+Every run is a TORASimulation with its own seed. A run counts as routed when the source got a
+route and the heights pass ReferenceSolution.validate.
+'''
+STRATEGIES = {
+    "flood": lambda simulation, seed: None,
+    "flood+delay": lambda simulation, seed: FloodControl(delay=0.002, schedule=simulation.scheduler.schedule, seed=seed),
+    "probabilistic": lambda simulation, seed: ProbabilisticFloodControl(seed=seed),
+    "counter": lambda simulation, seed: CounterFloodControl(schedule=simulation.scheduler.schedule, seed=seed),
+    "coverage": lambda simulation, seed: CoverageFloodControl(),
+    "coverage+delay": lambda simulation, seed: CoverageFloodControl(delay=0.002, schedule=simulation.scheduler.schedule, seed=seed),
+}
+
+def flood_control_run(graph_type, size, strategy, seed):
+    graph = nx_graph(graph_type, size, seed)
+    source_id, destination_id = generate_source_destination(graph.number_of_nodes(), seed)
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(graph)
+    registry = enable_metrics(simulation)
+    use_flood_control(simulation, STRATEGIES[strategy](simulation, seed))
+
+    simulation.nodes[destination_id].app_layer.set_height(TORAHeight(0, 0, 0, 0, destination_id))
+    simulation.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
+    simulation.run()
+
+    counters = registry.snapshot()['counters']
+    routed = not simulation.nodes[source_id].app_layer.state(destination_id).height.is_null
+    return {
+        'messages': simulation.delivered_messages,
+        'qry': counters.get('QRY.sent', 0),
+        'upd': counters.get('UPD.sent', 0),
+        'routed': routed and solve(graph, destination_id).validate(simulation)['valid'],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares QRY flood control strategies in messages per route creation")
+    parser.add_argument("size", type=int)
+    parser.add_argument("--graph-types", nargs="+", default=GRAPH_TYPES)
+    parser.add_argument("--strategies", nargs="+", default=list(STRATEGIES), choices=list(STRATEGIES))
+    parser.add_argument("--runs", type=int, default=TOTAL_RUNS)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'graph type':<16}{'strategy':<16}{'messages':>10}{'95% CI ±':>10}{'QRY':>8}{'UPD':>8}{'routed':>8}")
+    for graph_type in args.graph_types:
+        for strategy in args.strategies:
+            results = [flood_control_run(graph_type, args.size, strategy, args.seed + run_no) for run_no in range(args.runs)]
+            messages = describe([result['messages'] for result in results])
+            qry = sum(result['qry'] for result in results) / len(results)
+            upd = sum(result['upd'] for result in results) / len(results)
+            routed = sum(result['routed'] for result in results)
+            print(f"{graph_type:<16}{strategy:<16}{messages['mean']:>10.1f}{messages['mean'] - messages['ci_low']:>10.1f}{qry:>8.1f}{upd:>8.1f}{routed:>5}/{len(results)}")
+
+
+if __name__ == "__main__":
+    main()
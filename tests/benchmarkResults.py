@@ -0,0 +1,210 @@
+import math
+import os
+import pickle
+import sqlite3
+import statistics
+import subprocess
+import time
+from typing import Dict, List
+
+'''
+Benchmark results store.
+Every run is one row of a SQLite table, with the metadata needed to reproduce and compare it
+(seed, source, destination, edge count, message count, git commit). SQLite serializes the
+writers, so several benchmark drivers can append to the same file.
+summary() aggregates the runs per graph type and size: mean, median, p95, 95% confidence
+interval of the mean and messages per edge.
+'''
+COLUMNS = [
+    ("created", "REAL"),
+    ("commit_id", "TEXT"),
+    ("graph_type", "TEXT"),
+    ("size", "INTEGER"),
+    ("run", "INTEGER"),
+    ("seed", "INTEGER"),
+    ("source", "INTEGER"),
+    ("destination", "INTEGER"),
+    ("nodes", "INTEGER"),
+    ("edge_count", "INTEGER"),
+    ("messages", "INTEGER"),
+    ("construction_time", "REAL"),
+    ("routing_time", "REAL"),
+    ("total_time", "REAL"),
+]
+COLUMN_NAMES = [name for name, _ in COLUMNS]
+
+# Two-sided 95% quantiles of Student's t distribution by degrees of freedom
+T_QUANTILES = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262,
+    10: 2.228, 12: 2.179, 15: 2.131, 20: 2.086, 25: 2.060, 30: 2.042, 60: 2.000, 120: 1.980,
+}
+
+def t_quantile(degrees_of_freedom: int) -> float:
+    # Closest tabulated value at or below degrees_of_freedom, which errs on the wide side
+    if degrees_of_freedom > 120:
+        return 1.960
+    return T_QUANTILES[max(dof for dof in T_QUANTILES if dof <= degrees_of_freedom)]
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    if len(values) == 1:
+        return values[0]
+    position = (len(values) - 1) * p / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def describe(values: List[float]) -> Dict[str, float]:
+    n = len(values)
+    mean = statistics.fmean(values)
+    margin = t_quantile(n - 1) * statistics.stdev(values) / math.sqrt(n) if n > 1 else float('nan')
+    return {
+        'n': n,
+        'mean': mean,
+        'median': statistics.median(values),
+        'p95': percentile(values, 95),
+        'ci_low': mean - margin,
+        'ci_high': mean + margin,
+    }
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchmarkStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, {', '.join(f'{name} {kind}' for name, kind in COLUMNS)})")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS runs_by_graph ON runs (graph_type, size, commit_id)")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def add_run(self, result: dict, commit_id: str = None):
+        row = dict(result)
+        row.setdefault('created', time.time())
+        row.setdefault('commit_id', commit_id)
+        self.connection.execute(f"INSERT INTO runs ({', '.join(COLUMN_NAMES)}) VALUES ({', '.join('?' * len(COLUMN_NAMES))})",
+                                [row.get(name) for name in COLUMN_NAMES])
+        self.connection.commit()
+
+    def import_pickle(self, pickle_path: str, graph_type: str):
+        '''
+        Imports a benchmark_dict.pkl written by the old topologyTORATest.py.
+        Those only hold total times, the other columns stay empty.
+        '''
+        with open(pickle_path, "rb") as f:
+            benchmark_dict = pickle.load(f)
+        for size, entry in benchmark_dict.items():
+            for run_no, total_time in enumerate(entry['times']):
+                self.add_run({'graph_type': graph_type, 'size': size, 'nodes': size, 'run': run_no, 'total_time': total_time})
+
+    def runs(self, graph_type: str = None, commit_id: str = None) -> List[dict]:
+        query = f"SELECT {', '.join(COLUMN_NAMES)} FROM runs WHERE 1=1"
+        parameters = []
+        if graph_type is not None:
+            query += " AND graph_type = ?"
+            parameters.append(graph_type)
+        if commit_id is not None:
+            query += " AND commit_id = ?"
+            parameters.append(commit_id)
+        return [dict(zip(COLUMN_NAMES, row)) for row in self.connection.execute(query + " ORDER BY graph_type, size, run", parameters)]
+
+    def graph_types(self) -> List[str]:
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT graph_type FROM runs ORDER BY graph_type")]
+
+    def commits(self, graph_type: str = None) -> List[str]:
+        # Commits with stored runs, oldest first
+        query = "SELECT commit_id FROM runs WHERE commit_id IS NOT NULL"
+        parameters = []
+        if graph_type is not None:
+            query += " AND graph_type = ?"
+            parameters.append(graph_type)
+        return [row[0] for row in self.connection.execute(query + " GROUP BY commit_id ORDER BY MIN(created)", parameters)]
+
+    def summary(self, graph_type: str = None, commit_id: str = None, metric: str = 'total_time', all_commits: bool = False) -> List[dict]:
+        '''
+        Aggregates metric per (graph_type, size). Each entry holds n, mean, median, p95,
+        ci_low/ci_high (95% confidence interval of the mean) and messages_per_edge.
+        Without commit_id, only the runs of the latest commit with runs (of graph_type) are used,
+        so that different code versions are not mixed. all_commits pools the runs of all commits.
+        '''
+        if commit_id is None and not all_commits:
+            commits = self.commits(graph_type)
+            # Stores with runs without commit only (e.g. imported pickles) are summarized as a whole
+            commit_id = commits[-1] if commits else None
+        groups: Dict[tuple, List[dict]] = {}
+        for run in self.runs(graph_type, commit_id):
+            if run[metric] is not None:
+                groups.setdefault((run['graph_type'], run['size']), []).append(run)
+        summary = []
+        for (group_graph_type, size), runs in sorted(groups.items()):
+            entry = {'graph_type': group_graph_type, 'size': size}
+            entry.update(describe([run[metric] for run in runs]))
+            overhead = [run['messages'] / run['edge_count'] for run in runs if run['messages'] is not None and run['edge_count']]
+            entry['messages_per_edge'] = statistics.fmean(overhead) if overhead else None
+            summary.append(entry)
+        return summary
+
+    def compare(self, baseline_commit: str, commit_id: str, metric: str = 'total_time') -> List[dict]:
+        '''
+        Median of metric per (graph_type, size) for two commits and their ratio.
+        Entries whose confidence intervals do not overlap are marked significant.
+        '''
+        baseline = {(entry['graph_type'], entry['size']): entry for entry in self.summary(commit_id=baseline_commit, metric=metric)}
+        comparison = []
+        for entry in self.summary(commit_id=commit_id, metric=metric):
+            before = baseline.get((entry['graph_type'], entry['size']))
+            if before is None:
+                continue
+            comparison.append({
+                'graph_type': entry['graph_type'],
+                'size': entry['size'],
+                'baseline_median': before['median'],
+                'median': entry['median'],
+                'ratio': entry['median'] / before['median'] if before['median'] else float('inf'),
+                'significant': entry['ci_low'] > before['ci_high'] or entry['ci_high'] < before['ci_low'],
+            })
+        return comparison
+
+
+def print_summary(summary: List[dict]):
+    print(f"{'graph_type':<16}{'size':>6}{'n':>4}{'median':>12}{'p95':>12}{'ci95':>26}{'msg/edge':>10}")
+    for entry in summary:
+        messages_per_edge = "-" if entry['messages_per_edge'] is None else f"{entry['messages_per_edge']:.2f}"
+        interval = f"[{entry['ci_low']:.4f}, {entry['ci_high']:.4f}]"
+        print(f"{entry['graph_type']:<16}{entry['size']:>6}{entry['n']:>4}{entry['median']:>12.4f}{entry['p95']:>12.4f}"
+              f"{interval:>26}{messages_per_edge:>10}")
+
+def main():
+    import argparse
+    from topologyTORATest import benchmark_dir
+
+    parser = argparse.ArgumentParser(description="Summarizes the stored TORA benchmark runs")
+    parser.add_argument("--results", default=f"{benchmark_dir}/results.sqlite")
+    parser.add_argument("--graph-type")
+    parser.add_argument("--commit")
+    parser.add_argument("--compare", metavar="BASELINE_COMMIT")
+    parser.add_argument("--metric", default="total_time")
+    parser.add_argument("--all-commits", action="store_true", help="pools the runs of all commits, instead of the latest one")
+    args = parser.parse_args()
+
+    store = BenchmarkStore(args.results)
+    if args.compare:
+        for entry in store.compare(args.compare, args.commit or current_commit(), args.metric):
+            marker = " *" if entry['significant'] else ""
+            print(f"{entry['graph_type']:<16}{entry['size']:>6}{entry['baseline_median']:>12.4f}{entry['median']:>12.4f}{entry['ratio']:>8.2f}x{marker}")
+    else:
+        print_summary(store.summary(args.graph_type, args.commit, args.metric, args.all_commits))
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import os
+import random
+import time
+
+import networkx as nx
+
+from TORA.TORAComponent import TORAHeight
+from TORA.TORAReference import solve
+from TORA.TORASharding import ShardedTORARunner
+from TORA.TORASimulation import TORASimulation
+
+'''
+Route creation to several destinations at once, in one TORASimulation and with the
+ShardedTORARunner, on a small world graph. Every row is the mean over the runs.
+    wall        seconds from the first QRY until all shards are idle
+    speedup     wall time of the single process run over the wall time of the sharded run
+    cpu bound   single process wall time over the CPU time of the busiest shard, the speedup
+                when every shard has a core of its own. On a machine with fewer cores than
+                shards the wall speedup stays below it.
+The sharded routes are checked with ReferenceSolution.validate.
+'''
+def single_run(graph, routes, seed):
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(graph)
+    start_time = time.perf_counter()
+    for source_id, destination_id in routes:
+        simulation.nodes[destination_id].app_layer.set_height(TORAHeight(0, 0, 0, 0, destination_id))
+        simulation.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
+    simulation.run()
+    return time.perf_counter() - start_time
+
+def sharded_run(graph, routes, shards, seed):
+    runner = ShardedTORARunner(graph, shards=shards, seed=seed)
+    runner.start()
+    try:
+        start_time = time.perf_counter()
+        runner.create_routes(routes)
+        wall = time.perf_counter() - start_time
+        checkpoint = runner.checkpoint()
+    finally:
+        runner.exit()
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(graph)
+    checkpoint.restore(simulation)
+    valid = all(solve(graph, destination_id).validate(simulation)['valid'] for _, destination_id in routes)
+    return wall, max(runner.busy.values()), runner.cut_edges(), valid
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares sharded and single process route creation")
+    parser.add_argument("size", type=int)
+    parser.add_argument("--shards", nargs="+", type=int, default=[2, 4, 8])
+    parser.add_argument("--destinations", type=int, default=8)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cores")
+    print(f"{'shards':>8}{'cut links':>11}{'wall (s)':>10}{'speedup':>9}{'cpu bound':>11}{'valid':>8}")
+    rows = {shards: [] for shards in [1] + args.shards}
+    for run_no in range(args.runs):
+        seed = args.seed + run_no
+        graph = nx.connected_watts_strogatz_graph(args.size, 4, 0.1, seed=seed)
+        nodes = random.Random(seed).sample(sorted(graph.nodes), 2 * args.destinations)
+        routes = list(zip(nodes[:args.destinations], nodes[args.destinations:]))
+        single = single_run(graph, routes, seed)
+        rows[1].append((single, single, 0, True))
+        for shards in args.shards:
+            wall, busiest, cut, valid = sharded_run(graph, routes, shards, seed)
+            rows[shards].append((wall, busiest, cut, valid))
+    single = sum(row[0] for row in rows[1]) / args.runs
+    for shards, results in rows.items():
+        wall = sum(result[0] for result in results) / args.runs
+        busiest = sum(result[1] for result in results) / args.runs
+        cut = sum(result[2] for result in results) / args.runs
+        valid = sum(result[3] for result in results)
+        print(f"{shards:>8}{cut:>11.0f}{wall:>10.3f}{single / wall:>9.2f}{single / busiest:>11.2f}{valid:>5}/{args.runs}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from TORA.TORAProfiler import HandlerProfiler
+
+from benchmarkResults import BenchmarkStore, current_commit, print_summary
+from topologyTORATest import TOTAL_RUNS, benchmark_dir, generate_source_destination, nx_graph, timed_tora_run, save_graph_figures
+
+'''
+Parallel replacement for benchmarkTORA.sh.
+The (graph type, size, run) matrix is spread over a process pool. Every worker imports
+networkx and AHC once and then runs many topologies, and every run gets its own seed,
+so the graph and the source/destination pair can be reproduced later.
+Only the main process writes results, one row per run, to the BenchmarkStore.
+Graphs are drawn (--save-graphs) after all timed runs are done.
+With --profile DIR, every run is profiled with a HandlerProfiler: DIR gets a collapsed stack and
+a speedscope file per run and handler_costs.csv, the handler cost table keyed by graph type and size.
+Profiled runs are slower, so they are not stored with the benchmark results.
+'''
+GRAPH_TYPES = [
+    "complete_graph",
+    "random_tree",
+    "star_graph",
+    "cycle_graph",
+    "wheel_graph",
+    "ladder_graph",
+]
+
+def benchmark_matrix(graph_types, max_size, runs=TOTAL_RUNS, step=5, base_seed=0):
+    # Start from at least 5 nodes and only count by 5
+    for graph_type in graph_types:
+        for size in range(step, max_size + 1, step):
+            for run_no in range(runs):
+                yield graph_type, size, run_no, base_seed + size * runs + run_no
+
+def benchmark_run(graph_type, size, run_no, seed, profile_dir=None):
+    graph = nx_graph(graph_type, size, seed)
+    source_id, destination_id = generate_source_destination(graph.number_of_nodes(), seed)
+    profiler = HandlerProfiler() if profile_dir else None
+    result = timed_tora_run(graph, destination_id, source_id, profiler)
+    if profiler is not None:
+        name = f"{graph_type}_size{size}_run{run_no}"
+        profiler.write_collapsed(f"{profile_dir}/{name}.collapsed")
+        profiler.write_speedscope(f"{profile_dir}/{name}.speedscope.json", name)
+        result['handler_costs'] = profiler.cost_table()
+    result.update({
+        'graph_type': graph_type,
+        'size': size,
+        'run': run_no,
+        'seed': seed,
+        'source': source_id,
+        'destination': destination_id,
+        'nodes': graph.number_of_nodes(),
+        'edge_count': graph.number_of_edges(),
+        'total_time': result['construction_time'] + result['routing_time'],
+    })
+    return result
+
+def write_handler_costs(path, handler_costs):
+    fields = ['graph_type', 'size', 'run', 'handler', 'calls', 'total', 'self', 'mean']
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for entry in sorted(handler_costs, key=lambda entry: (entry['graph_type'], entry['size'], entry['run'], -entry['self'])):
+            writer.writerow(entry)
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the TORA benchmark matrix on a process pool")
+    parser.add_argument("max_size", type=int)
+    parser.add_argument("--graph-types", nargs="+", default=GRAPH_TYPES)
+    parser.add_argument("--runs", type=int, default=TOTAL_RUNS)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--results", default=f"{benchmark_dir}/results.sqlite")
+    parser.add_argument("--save-graphs", action="store_true")
+    parser.add_argument("--profile", metavar="DIR")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+    matrix = list(benchmark_matrix(args.graph_types, args.max_size, args.runs, base_seed=args.seed))
+    to_draw = []
+    store = BenchmarkStore(args.results)
+    commit_id = current_commit()
+    handler_costs = []
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(benchmark_run, *job, args.profile) for job in matrix]
+        for future in as_completed(futures):
+            result = future.result()
+            if args.profile:
+                for entry in result['handler_costs']:
+                    handler_costs.append(dict(entry, graph_type=result['graph_type'], size=result['size'], run=result['run']))
+            else:
+                store.add_run(result, commit_id)
+            print(f"{result['graph_type']} size {result['size']} run {result['run']}: {result['total_time']:.4f}s")
+            if args.save_graphs and result['run'] == 0:
+                to_draw.append(result)
+    print(f"{len(matrix)} runs done in {time.time() - start_time:.2f}s")
+    if args.profile:
+        write_handler_costs(f"{args.profile}/handler_costs.csv", handler_costs)
+    else:
+        print_summary([entry for entry in store.summary(commit_id=commit_id) if entry['graph_type'] in args.graph_types])
+    store.close()
+
+    for result in to_draw:
+        graph = nx_graph(result['graph_type'], result['size'], result['seed'])
+        save_graph_figures(graph, result, f"{benchmark_dir}/{result['graph_type']}/size_{result['size']}")
+
+
+if __name__ == "__main__":
+    main()
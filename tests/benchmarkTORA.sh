@@ -25,17 +25,5 @@ graph_types=(
     # "ladder_graph"
 )
 
-# Start from at least 5 nodes and only count by 5
-for graph_type in ${graph_types[@]}
-do
-    for (( i=5; i<=n; i++ ))
-    do
-        if (( i % 5 == 0 )); then
-            for (( j=0; j<5; j++ ))
-            do
-                # echo "Running test with $i nodes for $graph_type"
-            python3 topologyTORATest.py $i $graph_type $j
-            done
-        fi
-    done
-done
\ No newline at end of file
+# The runs are spread over a process pool, see benchmarkTORA.py
+python3 "$(dirname "$0")/benchmarkTORA.py" $n --graph-types ${graph_types[@]}
\ No newline at end of file
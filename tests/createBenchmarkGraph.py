@@ -1,8 +1,9 @@
 import os
-import pickle
 import matplotlib.pyplot as plt
 import numpy as np
 
+from benchmarkResults import BenchmarkStore
+
 def main():
     proj_dir = os.getcwd()
     
@@ -17,24 +18,29 @@ def main():
 
     plt.figure(figsize=(10, 6))
 
+    os.makedirs(f"{proj_dir}/tests/benchmark_results", exist_ok=True)
+    store = BenchmarkStore(f"{proj_dir}/tests/benchmark_results/results.sqlite")
+    topology_sizes = []
     for graph_type in graph_types:
-        results_dir = f"{proj_dir}/tests/benchmark_results/{graph_type}"
-        bench_dict_dir = f"{results_dir}/benchmark_dict.pkl"
-
-        if os.path.exists(bench_dict_dir):
-            with open(bench_dict_dir, "rb") as f:
-                benchmark_dict = pickle.load(f)
-
-            # topology_sizes = list(range(5, (len(benchmark_times) * 5) + 5, 5))
-            topology_sizes = benchmark_dict.keys()
-            benchmark_times = []
-            for k in benchmark_dict.keys():
-                benchmark_times.append(benchmark_dict[k]['average'])
-            plt.plot(topology_sizes, benchmark_times, marker='o', label=graph_type)
+        # Results of the old pickle based benchmark are imported once
+        bench_dict_dir = f"{proj_dir}/tests/benchmark_results/{graph_type}/benchmark_dict.pkl"
+        if os.path.exists(bench_dict_dir) and not store.runs(graph_type):
+            store.import_pickle(bench_dict_dir, graph_type)
+
+        summary = store.summary(graph_type)
+        if summary:
+            sizes = [entry['size'] for entry in summary]
+            medians = [entry['median'] for entry in summary]
+            # Error bars span the 95% confidence interval of the mean, single runs have none
+            lower = [max(entry['median'] - entry['ci_low'], 0) if entry['n'] > 1 else 0 for entry in summary]
+            upper = [max(entry['ci_high'] - entry['median'], 0) if entry['n'] > 1 else 0 for entry in summary]
+            plt.errorbar(sizes, medians, yerr=[lower, upper], marker='o', capsize=3, label=graph_type)
+            topology_sizes.extend(sizes)
+    store.close()
 
     plt.title('Benchmark Times vs Topology Sizes')
     plt.xlabel('Topology Size (Number of Nodes)')
-    plt.ylabel('Time Taken (s)')
+    plt.ylabel('Median Time Taken (s)')
     plt.grid(True)
     plt.legend()
 
@@ -1,15 +1,35 @@
 import networkx as nx
+import json
 import time
 import sys, os
+import random
+import tempfile
 import threading
 from adhoccomputing.Networking.LogicalChannels.GenericChannel import GenericChannel
 from matplotlib import pyplot as plt
 
 from adhoccomputing.GenericModel import Topology
+from adhoccomputing.Generics import Event, EventTypes, GenericMessage, GenericMessageHeader
 
-from TORA.TORAComponent import TORANode, TORAHeight, heights, all_edges, wait_for_action_to_complete
+from TORA.TORAComponent import TORANode, TORAHeight, ForwardingModes, heights, all_edges, count_messages, goodput, link_utilization, set_forwarding_mode, wait_for_action_to_complete
+from TORA.TORASimulation import TORASimulation
+from TORA.TORATopology import TORATopology
+from TORA.TORAReference import solve
+from TORA.TORAWorkload import Workload, RandomWaypoint, GroupMobility, format_table
+from TORA.TORANeighborSensing import NeighborSensing
+from TORA.TORAAdvertisement import AdvertisementScheduler, use_advertisement_scheduler
+from TORA.TORAFloodControl import FloodControl, ProbabilisticFloodControl, CounterFloodControl, CoverageFloodControl, use_flood_control
+from TORA.TORACheckpoint import save_checkpoint, restore_checkpoint
+from TORA.TORAMetrics import enable_metrics
+from TORA.TORAProfiler import HandlerProfiler, QUEUED
+from TORA.TORAClock import LamportClock, SimulatedClock
+from TORA.TORASharding import ShardedTORARunner, ShardSimulation
+from TORA.TORAComponent import TORAControlMessageTypes, UpdateMessagePayload, ArbitraryMessagePayload, QueryMessagePayload, ClearMessagePayload, ReferenceLevel
+from TORA.TORAWireFormat import TORAWireCodec, FRAME_HEADER, FRAME_MARKER, encoded_size, encode_control_message, decode_control_message, encode_batch, decode_batch, decode_packets, use_wire_format, control_overhead, MAX_FRAME_PACKETS
 
-def deterministic_test1():
+from topologyTORATest import timed_tora_run
+
+def deterministic_graph():
     graph = nx.Graph()
 
     graph.add_edge(0, 1)
@@ -19,6 +39,10 @@ def deterministic_test1():
     graph.add_edge(6, 5)
     graph.add_edge(6, 4)
     graph.add_edge(4, 2)
+    return graph
+
+def deterministic_test1():
+    graph = deterministic_graph()
 
     # nx.draw(G, with_labels=True, font_weight="bold")
     # plt.draw()
@@ -39,7 +63,7 @@ def deterministic_test1():
     t = time.time()
     topology.nodes[destination_id].app_layer.set_height(destination_height)
     topology.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
-    print(wait_for_action_to_complete() - t)
+    print(wait_for_action_to_complete(topology) - t)
     # topology.nodes[source_id].app_layer.process_arbitrary_message(destination_id, "Test message")
 
 
@@ -55,14 +79,36 @@ def deterministic_test1():
     # plt.show()
     plt.savefig("FinalGraph.png")
 
-def random_test_by_graph_size(size, destination_id=7, source_id=0):
-    graph = nx.random_tree(size)
+def profiler_test(destination_id=7, source_id=0):
+    # Profiles the route creation of deterministic_test1 on the threaded topology
+    profiler = HandlerProfiler()
+    timed_tora_run(deterministic_graph(), destination_id, source_id, profiler)
+    with tempfile.TemporaryDirectory() as directory:
+        profiler.write_collapsed(os.path.join(directory, "tora.collapsed"))
+        profiler.write_speedscope(os.path.join(directory, "tora.speedscope.json"), "deterministic")
+        with open(os.path.join(directory, "tora.collapsed")) as f:
+            stacks = [line.rsplit(" ", 1)[0].split(";") for line in f]
+        with open(os.path.join(directory, "tora.speedscope.json")) as f:
+            document = json.load(f)
+    print(profiler.format_table())
+    handlers = ["ApplicationLayerTORA.on_message_from_bottom", "ApplicationLayerTORA.process_control_message", "ApplicationLayerTORA.process_update_message"]
+    assert handlers in [stack[:3] for stack in stacks]
+    assert any(stack[-1] == QUEUED for stack in stacks)
+
+    profile = document["profiles"][0]
+    frames = [frame["name"] for frame in document["shared"]["frames"]]
+    assert set(handlers + [QUEUED]) <= set(frames)
+    assert len(profile["samples"]) == len(profile["weights"]) == len(stacks)
+    assert profile["endValue"] == sum(profile["weights"]) > 0
+
+def random_test_by_graph_size(size, destination_id=7, source_id=0, seed=1):
+    graph = nx.random_labeled_tree(size, seed=seed)
 
     time_list = []
     graph_construction_time = time.time()
     print("Graph size: ", graph.number_of_nodes())
-    topology = Topology()
-    topology.construct_from_graph(graph, TORANode, GenericChannel)
+    topology = TORATopology()
+    topology.construct_from_graph(graph)
     print("Constructed topology with time: ", time.time() - graph_construction_time)
     time_list.append(time.time() - graph_construction_time)
     
@@ -73,17 +119,520 @@ def random_test_by_graph_size(size, destination_id=7, source_id=0):
     topology.nodes[destination_id].app_layer.set_height(destination_height)
     topology.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
     print("Waiting for action to complete")
-    end_time = wait_for_action_to_complete()
+    end_time = wait_for_action_to_complete(topology)
     print(f"Routing done. Time to complete: {end_time - start_time}")
     time_list.append(end_time - start_time)
     
     topology.nodes[source_id].app_layer.process_arbitrary_message(destination_id, "Test message")
-    wait_for_action_to_complete()
+    wait_for_action_to_complete(topology)
+
+def simulation_test(size=10000, destination_id=7, source_id=0, seed=1, metrics=False):
+    graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+
+    # The same seed has to produce the same DAG
+    dags = []
+    for _ in range(2):
+        graph_construction_time = time.time()
+        simulation = TORASimulation(seed=seed)
+        simulation.construct_from_graph(graph)
+        print("Constructed simulation with time: ", time.time() - graph_construction_time)
+        registry = enable_metrics(simulation) if metrics else None
+
+        destination_height: TORAHeight = TORAHeight(0, 0, 0, 0, destination_id)
+
+        start_time = time.time()
+        simulation.nodes[destination_id].app_layer.set_height(destination_height)
+        simulation.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
+        simulated_time = simulation.run()
+        print(f"Routing done. Simulated time: {simulated_time}, wall-clock time: {time.time() - start_time}, messages: {simulation.delivered_messages}")
+        if registry is not None:
+            print(registry.format_table())
+        assert solve(graph, destination_id).validate(simulation, complete=True)['valid']
+        dags.append(sorted(all_edges(simulation)))
+    assert dags[0] == dags[1]
+    return dags[0]
+
+def multipath_test(size=40, packets=1000, flows=20):
+    # A ladder has two downstream links at most nodes, compare how the data traffic spreads
+    graph = nx.ladder_graph(size)
+    source_id, destination_id = 0, 2 * size - 1
+    for mode in ForwardingModes:
+        simulation = TORASimulation(seed=1)
+        simulation.construct_from_graph(graph)
+        simulation.nodes[destination_id].app_layer.set_height(TORAHeight(0, 0, 0, 0, destination_id))
+        simulation.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
+        simulation.run()
+
+        set_forwarding_mode(simulation, mode)
+        for flow_id in range(packets):
+            simulation.nodes[source_id].app_layer.process_arbitrary_message(destination_id, "Test message", flow_id=flow_id)
+        simulation.run()
+        utilization = link_utilization(simulation)
+        print(f"{mode.name}: {len(utilization)} links used, busiest link carried {max(utilization.values())} packets")
+        assert simulation.nodes[destination_id].app_layer.throughput.payloads_received == packets
+        # Nodes that sent data over more than one of their downstream links
+        spreading = [node for node in simulation.nodes if len(simulation.nodes[node].app_layer.link_utilization) > 1]
+        if mode == ForwardingModes.SINGLE_PATH:
+            assert not spreading
+        else:
+            assert spreading
+
+        if mode == ForwardingModes.FLOW_HASH:
+            # Every packet of a flow takes the same path, different flows take different paths
+            paths = set()
+            for flow_id in range(flows):
+                flow_paths = []
+                for _ in range(3):
+                    before = link_utilization(simulation)
+                    simulation.nodes[source_id].app_layer.process_arbitrary_message(destination_id, "Test message", flow_id=flow_id)
+                    simulation.run()
+                    after = link_utilization(simulation)
+                    flow_paths.append(frozenset(link for link in after if after[link] != before.get(link, 0)))
+                assert len(set(flow_paths)) == 1
+                paths.add(flow_paths[0])
+            assert len(paths) > 1
+
+def stream_test(size=2000, payloads=50000, payload_size=100, mtu=1500, destination_id=7, source_id=0):
+    graph = nx.connected_watts_strogatz_graph(size, 6, 0.1, seed=1)
+    for mode in (ForwardingModes.SINGLE_PATH, ForwardingModes.ROUND_ROBIN):
+        simulation = TORASimulation(seed=1)
+        simulation.construct_from_graph(graph)
+        simulation.nodes[destination_id].app_layer.set_height(TORAHeight(0, 0, 0, 0, destination_id))
+        simulation.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
+        simulation.run()
+        set_forwarding_mode(simulation, mode)
+
+        # Numbered payloads, so that the order of the reassembled stream can be checked
+        data = [index.to_bytes(4, "big") + bytes(payload_size - 4) for index in range(payloads)]
+        stream_id = simulation.nodes[source_id].app_layer.send_stream(destination_id, iter(data), mtu=mtu)
+        simulation.run()
+        stream = simulation.nodes[destination_id].app_layer.streams[(source_id, stream_id)]
+        delivered, seconds, rate = goodput(simulation)
+        print(f"{mode.name}: stream complete: {stream.complete}, payloads: {len(stream.payloads)}, goodput: {rate / 1e6:.2f} MB/s ({delivered} bytes in {seconds:.3f}s)")
+        sender = simulation.nodes[source_id].app_layer.throughput
+        assert stream.complete and not stream.pending
+        assert stream.next_sequence == sender.frames_sent
+        assert stream.payloads == data
+        assert delivered == sender.bytes_sent == payloads * payload_size
+
+def payload_size_test(hops=200, packets=50, sizes=(1 << 10, 1 << 20, 1 << 24)):
+    # Data packets are forwarded without copies, the cost of a hop must not grow with the payload
+    graph = nx.path_graph(hops + 1)
+    source_id, destination_id = 0, hops
+    simulation = TORASimulation(seed=1)
+    simulation.construct_from_graph(graph)
+    simulation.nodes[destination_id].app_layer.set_height(TORAHeight(0, 0, 0, 0, destination_id))
+    simulation.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
+    simulation.run()
+
+    per_hop = []
+    for size in sizes:
+        payload = memoryview(bytearray(size))
+        start_time = time.perf_counter()
+        for _ in range(packets):
+            simulation.nodes[source_id].app_layer.process_arbitrary_message(destination_id, payload)
+        simulation.run()
+        per_hop.append((time.perf_counter() - start_time) / (packets * hops))
+        print(f"Payload of {size} bytes: {per_hop[-1] * 1e6:.2f}us per hop")
+    # Timing noise aside, the largest payload costs about as much per hop as the smallest one
+    assert max(per_hop) < 5 * min(per_hop)
+
+    # The destination gets the payload object that was sent
+    payload = memoryview(bytearray(sizes[-1]))
+    stream_id = simulation.nodes[source_id].app_layer.send_stream(destination_id, [payload])
+    simulation.run()
+    assert simulation.nodes[destination_id].app_layer.streams[(source_id, stream_id)].payloads[0] is payload
+
+def large_topology_test(size=50000, seed=1):
+    # Only the construction is timed, the threaded route creation does not scale to this size
+    graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+    start_time = time.time()
+    topology = TORATopology()
+    topology.construct_from_graph(graph)
+    topology.start()
+    print(f"Constructed {size} node topology with time: {time.time() - start_time}, started components: {topology.started_components()}")
+    topology.exit()
+
+def reference_test(size=10000, destination_id=7, source_id=0, seed=1):
+    # Checks a simulated route creation against the reference solution, then seeds a second run from it
+    graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+    start_time = time.time()
+    solution = solve(graph, destination_id)
+    print(f"Reference solution for {size} nodes with time: {time.time() - start_time}")
+
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(graph)
+    simulation.nodes[destination_id].app_layer.set_height(TORAHeight(0, 0, 0, 0, destination_id))
+    simulation.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
+    simulation.run()
+    report = solution.validate(simulation, complete=True)
+    print(f"Valid: {report['valid']}, nodes with shortest path heights: {report['optimal']} of {report['reachable']}")
+    assert report['valid']
+
+    seeded = TORASimulation(seed=seed)
+    seeded.construct_from_graph(graph)
+    solution.seed_heights(seeded)
+    assert solution.validate(seeded, complete=True)['valid']
+    assert sorted(all_edges(seeded, destination_id)) == sorted(solution.edges())
+    return report['valid']
+
+def workload_test(size=500, destination_id=7, seed=1):
+    # Route maintenance under link failures, node churn and mobility, starting from seeded heights
+    graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+    workload = Workload()
+    workload.random_link_failures(graph, 30, 1.0, start=1.0, recover_after=0.5, seed=seed)
+    workload.random_node_churn(graph, 5, 1.0, 0.5, start=40.0, exclude=[destination_id], seed=seed)
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(graph.copy())
+    solve(graph, destination_id).seed_heights(simulation)
+    print(format_table(workload.run(simulation)))
+    assert solve(simulation.G, destination_id).validate(simulation, maintained=True)['valid']
+
+    for model in (RandomWaypoint(range(150), speed=(0.01, 0.03), seed=seed), GroupMobility(range(150), groups=5, seed=seed)):
+        workload = Workload()
+        graph = workload.add_mobility(model, radius=0.15, duration=20, interval=0.5)
+        simulation = TORASimulation(seed=seed)
+        simulation.construct_from_graph(graph)
+        solve(graph, destination_id).seed_heights(simulation)
+        print(type(model).__name__)
+        print(format_table(workload.run(simulation)))
+        assert solve(simulation.G, destination_id).validate(simulation, maintained=True)['valid']
+
+def neighbor_sensing_test(size=500, degree=4, destination_id=7, seed=1):
+    # Link changes are only noticed through beacons and timeouts, the repair latency includes the detection
+    graph = nx.connected_watts_strogatz_graph(size, degree, 0.1, seed=seed)
+    workload = Workload()
+    workload.random_link_failures(graph, 20, 10.0, start=30.0, recover_after=60.0, seed=seed)
+    workload.random_node_churn(graph, 3, 10.0, 60.0, start=300.0, exclude=[destination_id], seed=seed)
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(graph.copy())
+    solve(graph, destination_id).seed_heights(simulation)
+    sensing = NeighborSensing(simulation)
+    sensing.start()
+    print(format_table(workload.run(simulation, settle=30.0)))
+    print(f"Beacons per node and second: {sensing.beacon_rate(simulation.scheduler.now):.2f}, links lost: {sensing.links_lost}, links gained: {sensing.links_gained}")
+    assert solve(simulation.G, destination_id).validate(simulation, maintained=True)['valid']
+
+def advertisement_test(size=300, destination_ids=(7, 42, 99), seed=1):
+    # The same link failures with and without UPD aggregation, routes to every destination must be repaired
+    messages = []
+    for window in (0.0, 0.005):
+        graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+        workload = Workload()
+        workload.random_link_failures(graph, 30, 1.0, start=1.0, recover_after=0.5, seed=seed)
+        simulation = TORASimulation(seed=seed)
+        simulation.construct_from_graph(graph.copy())
+        for destination_id in destination_ids:
+            solve(graph, destination_id).seed_heights(simulation)
+        advertiser = AdvertisementScheduler(window, simulation.scheduler.schedule)
+        use_advertisement_scheduler(simulation, advertiser)
+        workload.run(simulation)
+        messages.append(simulation.delivered_messages)
+        print(f"Window {window * 1e3:.0f} ms: {simulation.delivered_messages} messages, {advertiser.saved} broadcasts saved")
+        for destination_id in destination_ids:
+            assert solve(simulation.G, destination_id).validate(simulation, maintained=True)['valid']
+    assert messages[1] < messages[0]
+
+def metrics_test(size=300, destination_id=7, source_id=0, seed=1):
+    # Route creation and link failures with metrics, the counters must add up to what the nodes sent and received
+    graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+    workload = Workload()
+    workload.random_link_failures(graph, 60, 1.0, start=1.0, seed=seed)
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(graph.copy())
+    registry = enable_metrics(simulation)
+    simulation.nodes[destination_id].app_layer.set_height(TORAHeight(0, 0, 0, 0, destination_id))
+    simulation.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
+    simulation.run()
+    workload.run(simulation)
+    snapshot = registry.snapshot()
+    counters, histograms = snapshot['counters'], snapshot['histograms']
+    print(registry.format_table())
+
+    types = ("QRY", "UPD", "CLR")
+    sent, received = count_messages(simulation)
+    assert sent == sum(counters.get(f"{name}.sent", 0) for name in types)
+    assert received == sum(counters.get(f"{name}.received", 0) for name in types)
+    assert sent - received == simulation.lost_messages
+    for name in types:
+        assert histograms.get(f"handler.{name}", {'count': 0})['count'] == counters.get(f"{name}.received", 0)
+    assert counters["QRY.discarded"] > 0
+    assert counters["maintenance_case_1"] > 0 and counters["maintenance_case_2"] > 0
+    # Cases 1, 2, 3 and 5 each broadcast one UPD that reverses links
+    assert counters["link_reversals"] == sum(counters.get(f"maintenance_case_{case}", 0) for case in (1, 2, 3, 5))
+
+    # Cutting the last link to the destination partitions the path, the partition is detected (case 4)
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(nx.path_graph(5))
+    registry = enable_metrics(simulation)
+    simulation.nodes[4].app_layer.set_height(TORAHeight(0, 0, 0, 0, 4))
+    simulation.nodes[0].app_layer.process_query_message(4, 0)
+    simulation.run()
+    simulation.remove_link(3, 4)
+    simulation.run()
+    counters = registry.snapshot()['counters']
+    assert counters["partitions_detected"] == counters["maintenance_case_4"] > 0
+    assert counters["CLR.sent"] > 0
+    assert all(simulation.nodes[node].app_layer.state(4).height.is_null for node in range(4))
+
+def flood_control_test(size=500, destination_id=7, source_id=0, seed=1):
+    # Every first QRY is either rebroadcast or suppressed, strategies that reach every node must build the right DAG
+    strategies = {
+        "flood": (lambda simulation: FloodControl(), True),
+        "flood+delay": (lambda simulation: FloodControl(delay=0.002, schedule=simulation.scheduler.schedule, seed=seed), True),
+        "probabilistic": (lambda simulation: ProbabilisticFloodControl(seed=seed), False),
+        "probabilistic+delay": (lambda simulation: ProbabilisticFloodControl(delay=0.002, schedule=simulation.scheduler.schedule, seed=seed), False),
+        "counter": (lambda simulation: CounterFloodControl(delay=0.0, seed=seed), False),
+        "counter+delay": (lambda simulation: CounterFloodControl(schedule=simulation.scheduler.schedule, seed=seed), False),
+        "coverage": (lambda simulation: CoverageFloodControl(), True),
+        "coverage+delay": (lambda simulation: CoverageFloodControl(delay=0.002, schedule=simulation.scheduler.schedule, seed=seed), True),
+    }
+    graph = nx.connected_watts_strogatz_graph(size, 6, 0.1, seed=seed)
+    for name, (strategy, deterministic) in strategies.items():
+        simulation = TORASimulation(seed=seed)
+        simulation.construct_from_graph(graph.copy())
+        flood_control = strategy(simulation)
+        use_flood_control(simulation, flood_control)
+        simulation.nodes[destination_id].app_layer.set_height(TORAHeight(0, 0, 0, 0, destination_id))
+        simulation.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
+        simulation.run()
+        print(f"{name}: {simulation.delivered_messages} messages, {flood_control.rebroadcasts} rebroadcasts, {flood_control.suppressed} suppressed")
+        assert flood_control.requests > 0 and flood_control.dropped == 0 and not flood_control.pending
+        assert flood_control.rebroadcasts + flood_control.suppressed == flood_control.requests
+        if deterministic:
+            assert solve(graph, destination_id).validate(simulation)['valid']
+
+    # A node that restarts during the assessment delay forgets the request, the old timer is ignored
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(nx.path_graph(5))
+    flood_control = FloodControl(delay=0.01, schedule=simulation.scheduler.schedule, seed=seed)
+    use_flood_control(simulation, flood_control)
+    app_layer = simulation.nodes[2].app_layer
+    app_layer.process_query_message(4, 1)
+    app_layer.reset()
+    app_layer.process_query_message(4, 1)
+    simulation.run()
+    assert flood_control.dropped == 1 and not flood_control.pending
+    assert flood_control.rebroadcasts + flood_control.suppressed == flood_control.requests - 1
+
+def checkpoint_test(size=5000, destination_id=7, source_id=100, seed=1):
+    # Route creation runs once, the maintenance experiment starts from the restored state
+    graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(graph.copy())
+    start_time = time.perf_counter()
+    simulation.nodes[destination_id].app_layer.set_height(TORAHeight(0, 0, 0, 0, destination_id))
+    simulation.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
+    simulation.run()
+    print(f"Route creation for {size} nodes with time: {time.perf_counter() - start_time}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "checkpoint.tora")
+        print(f"Checkpoint size: {save_checkpoint(simulation, path)} bytes")
+        restored = TORASimulation(seed=seed)
+        restored.construct_from_graph(graph.copy())
+        start_time = time.perf_counter()
+        restore_checkpoint(restored, path)
+        print(f"Restore with time: {time.perf_counter() - start_time}")
+    for node in simulation.nodes:
+        assert restored.nodes[node].app_layer.state(destination_id).height == simulation.nodes[node].app_layer.state(destination_id).height
+    assert solve(graph, destination_id).validate(restored)['valid']
+
+    workload = Workload()
+    workload.random_link_failures(graph, 30, 1.0, start=1.0, recover_after=0.5, seed=seed)
+    print(format_table(workload.run(restored)))
+    assert solve(restored.G, destination_id).validate(restored, maintained=True)['valid']
+
+def maintained_checkpoint_test(size=400, destination_id=7, seeds=(1, 2, 3)):
+    # A checkpoint taken after route maintenance holds reference levels above 0, the restored
+    # simulation starts its clock at 0 and must still define higher reference levels
+    for seed in seeds:
+        graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+        workload = Workload()
+        workload.random_link_failures(graph, 40, 1.0, start=1.0, seed=seed)
+        simulation = TORASimulation(seed=seed)
+        simulation.construct_from_graph(graph.copy())
+        solve(graph, destination_id).seed_heights(simulation)
+        workload.run(simulation)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "checkpoint.tora")
+            save_checkpoint(simulation, path)
+            restored = TORASimulation(seed=seed)
+            restored.construct_from_graph(simulation.G.copy())
+            checkpoint = restore_checkpoint(restored, path)
+        assert checkpoint.max_tau > 0 and restored.clock.now() > checkpoint.max_tau
+        assert solve(restored.G, destination_id).validate(restored, maintained=True)['valid']
+
+        workload = Workload()
+        workload.random_link_failures(restored.G, 40, 1.0, start=1.0, seed=seed + 100)
+        workload.run(restored)
+        report = solve(restored.G, destination_id).validate(restored, maintained=True)
+        print(f"Seed {seed}: restored at tau {checkpoint.max_tau}, valid after 40 more link failures: {report['valid']}")
+        assert report['valid'], report['no_downstream']
+
+def clock_test(size=300, destination_id=7, seed=1):
+    # A Lamport clock reads above every tau it witnessed
+    clock = LamportClock()
+    witnessed = 0.0
+    for tau in random.Random(seed).choices(range(1000), k=200):
+        clock.witness(float(tau))
+        witnessed = max(witnessed, tau)
+        assert clock.now() > witnessed
+
+    # A simulated clock behind a received tau notices it, and can be moved past it
+    simulation = TORASimulation(seed=seed)
+    clock = SimulatedClock(simulation.scheduler)
+    clock.witness(0.0)
+    clock.witness(35.0)
+    assert clock.ahead == 1 and clock.latest_witnessed == 35.0
+    assert clock.advance_past(35.0) and clock.now() > 35.0
+
+    # The same seed stamps the same reference levels during route maintenance
+    reference_levels = []
+    for _ in range(2):
+        graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+        workload = Workload()
+        workload.random_link_failures(graph, 30, 1.0, start=1.0, seed=seed)
+        simulation = TORASimulation(seed=seed)
+        simulation.construct_from_graph(graph.copy())
+        solve(graph, destination_id).seed_heights(simulation)
+        workload.run(simulation)
+        levels = {node: simulation.nodes[node].app_layer.state(destination_id).height for node in simulation.nodes}
+        assert simulation.clock.ahead == 0
+        reference_levels.append(levels)
+    assert reference_levels[0] == reference_levels[1]
+    assert any(not height.is_null and height.tau > 0 for height in reference_levels[0].values())
+
+def sharding_test(size=2000, shards=4, destination_ids=(7, 900, 1700), seed=1):
+    # Routes created by the shards together must be the same DAGs a single simulation would build
+    graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+    runner = ShardedTORARunner(graph, shards=shards, seed=seed)
+    runner.start()
+    try:
+        runner.create_routes([(0, destination_id) for destination_id in destination_ids])
+        checkpoint = runner.checkpoint()
+    finally:
+        runner.exit()
+    print(f"{runner.cut_edges()} of {graph.number_of_edges()} links cross shards, CPU seconds per shard: {runner.busy}")
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(graph)
+    checkpoint.restore(simulation)
+    for destination_id in destination_ids:
+        assert solve(graph, destination_id).validate(simulation)['valid']
+
+    # Frames of batched UPDs cross shards, data packets are rejected
+    graph = nx.path_graph(4)
+    assignment = {0: 0, 1: 0, 2: 1, 3: 1}
+    left, right = ShardSimulation(0, assignment, 2), ShardSimulation(1, assignment, 2)
+    left.construct_from_graph(graph)
+    right.construct_from_graph(graph)
+    payloads = [UpdateMessagePayload(destination_id, TORAHeight(0, 0, 0, 1, 1), False) for destination_id in (0, 10)]
+    left.nodes[1].app_layer.broadcaster.broadcast_batch(TORAControlMessageTypes.UPD, payloads)
+    right.receive_frame(bytes(left.outboxes[1]))
+    right.run()
+    assert right.remote_received == 1
+    for destination_id in (0, 10):
+        assert right.nodes[2].app_layer.state(destination_id).neighbor_heights[1][0] == TORAHeight(0, 0, 0, 1, 1)
+    try:
+        left.schedule_delivery(1, 2, GenericMessage(GenericMessageHeader("Message", 1, 2), ArbitraryMessagePayload(3, "Test message")))
+        assert False, "a data packet crossed shards"
+    except TypeError:
+        pass
+
+def payload_fields(messagetype, source_id, payload):
+    # Payload objects have no equality, compare what goes on the wire
+    return messagetype, source_id, tuple(sorted(vars(payload).items()))
+
+def wire_format_test(seed=1):
+    QRY, UPD, CLR = TORAControlMessageTypes.QRY, TORAControlMessageTypes.UPD, TORAControlMessageTypes.CLR
+    packets = [
+        (QRY, 3, QueryMessagePayload(7)),
+        (UPD, 3, UpdateMessagePayload(7, TORAHeight(12.5, 4, 1, -2, 3), False)),
+        (UPD, 3, UpdateMessagePayload(7, TORAHeight(0.0, 0, 0, 6, 3), True)),
+        (UPD, 4, UpdateMessagePayload(7, TORAHeight.null(4), False)),
+        (UPD, 4, UpdateMessagePayload(7, TORAHeight.null(4), True)),
+        (CLR, 5, ClearMessagePayload(7, ReferenceLevel(12.5, 4, 1))),
+    ]
+    # Single packets
+    for messagetype, source_id, payload in packets:
+        packet = encode_control_message(messagetype, source_id, payload)
+        assert len(packet) == encoded_size(messagetype)
+        decoded_type, decoded_source, decoded_payload, offset = decode_control_message(packet)
+        assert offset == len(packet)
+        assert payload_fields(decoded_type, decoded_source, decoded_payload) == payload_fields(messagetype, source_id, payload)
+        assert [payload_fields(*message) for message in decode_packets(packet)] == [payload_fields(messagetype, source_id, payload)]
+    assert decode_control_message(encode_control_message(*packets[3]))[2].height.is_null
+
+    # Frames
+    frame = encode_batch(packets)
+    marker, count = FRAME_HEADER.unpack_from(frame, 0)
+    assert marker == FRAME_MARKER and frame[0] == FRAME_MARKER and count == len(packets)
+    assert len(frame) == FRAME_HEADER.size + sum(encoded_size(messagetype) for messagetype, _, _ in packets)
+    assert [payload_fields(*message) for message in decode_batch(frame)] == [payload_fields(*message) for message in packets]
+    assert [payload_fields(*message) for message in TORAWireCodec().decode(memoryview(frame))] == [payload_fields(*message) for message in packets]
+    # The packet count is 16 bits wide
+    frame = encode_batch([packets[0]] * MAX_FRAME_PACKETS)
+    assert FRAME_HEADER.unpack_from(frame, 0)[1] == MAX_FRAME_PACKETS and len(decode_batch(frame)) == MAX_FRAME_PACKETS
+    try:
+        encode_batch([packets[0]] * (MAX_FRAME_PACKETS + 1))
+        assert False, "the packet count overflowed"
+    except ValueError:
+        pass
+
+    # control_overhead counts every broadcast once per receiving neighbor
+    graph = nx.connected_watts_strogatz_graph(60, 4, 0.1, seed=seed)
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(graph)
+    use_wire_format(simulation, TORAWireCodec())
+    registry = enable_metrics(simulation)
+    simulation.nodes[7].app_layer.set_height(TORAHeight(0, 0, 0, 0, 7))
+    simulation.nodes[0].app_layer.process_query_message(7, 0)
+    simulation.run()
+    counters = registry.snapshot()['counters']
+    expected = sum(counters.get(f"{messagetype.name}.sent", 0) * encoded_size(messagetype) for messagetype in (QRY, UPD, CLR))
+    total, per_edge = control_overhead(simulation)
+    assert expected > 0 and total == expected and per_edge == total / graph.number_of_edges()
+    assert solve(graph, 7).validate(simulation)['valid']
+
+    # A batch of UPDs is one frame, its bytes count once per neighbor
+    app_layer = simulation.nodes[0].app_layer
+    before = app_layer.recorder.bytes_sent
+    app_layer.broadcaster.broadcast_batch(UPD, [payload for messagetype, _, payload in packets if messagetype == UPD])
+    assert app_layer.recorder.bytes_sent - before == (FRAME_HEADER.size + 4 * encoded_size(UPD)) * len(app_layer.neighbors)
+    print(f"Control overhead: {total} bytes, {per_edge:.1f} bytes per link")
+
+    # Encoded packets at a node without a codec are an error, not a silently handled message
+    simulation = TORASimulation(seed=seed)
+    simulation.construct_from_graph(nx.path_graph(2))
+    packet = encode_control_message(*packets[0])
+    try:
+        simulation.nodes[1].app_layer.on_message_from_bottom(Event(None, EventTypes.MFRB, GenericMessage(GenericMessageHeader(QRY, 0, 1), packet)))
+        assert False, "an encoded packet was handled without a codec"
+    except RuntimeError:
+        pass
+    assert simulation.nodes[1].app_layer.recorder.messages_received == 0
 
 def main():
     # setAHCLogLevel(DEBUG)
     deterministic_test1()
-    # random_test_by_graph_size(size=100, source_id=0, destination_id=99)
+    # The defaults of the larger tests are for benchmarking, these sizes keep a full run short
+    random_test_by_graph_size(size=100, source_id=0, destination_id=99)
+    profiler_test()
+    simulation_test(size=2000)
+    multipath_test()
+    stream_test(size=500, payloads=5000)
+    payload_size_test()
+    large_topology_test(size=2000)
+    reference_test(size=2000)
+    workload_test()
+    neighbor_sensing_test()
+    advertisement_test()
+    metrics_test()
+    flood_control_test()
+    checkpoint_test(size=2000)
+    maintained_checkpoint_test()
+    clock_test()
+    sharding_test()
+    wire_format_test()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,3 @@
-import pickle
 import networkx as nx
 import time
 import sys, os
@@ -10,29 +9,28 @@ from matplotlib import pyplot as plt
 from adhoccomputing.GenericModel import Topology
 import numpy as np
 
-from TORA.TORAComponent import TORANode, TORAHeight, heights, all_edges, set_benchmark_time, wait_for_action_to_complete
-
-topology_size = int(sys.argv[1])
-graph_type = sys.argv[2]
-run_no = int(sys.argv[3])
+from TORA.TORAComponent import TORANode, TORAHeight, heights, all_edges, count_messages, wait_for_action_to_complete
 
 TOTAL_RUNS = 5
 
 proj_dir = os.getcwd()
 # figures_dir = "/workspace/tests/topology_benchmark_figures"
-results_dir = f"{proj_dir}/tests/benchmark_results/{graph_type}"
+benchmark_dir = f"{proj_dir}/tests/benchmark_results"
 
-def generate_source_destination(max_value):
-    source = random.randint(0, max_value - 1)
+def generate_source_destination(max_value, seed=None):
+    rng = random.Random(seed)
+    source = rng.randint(0, max_value - 1)
     destination = source
     while destination == source:
-        destination = random.randint(0, max_value - 1)
+        destination = rng.randint(0, max_value - 1)
     return source, destination
 
 
-def nx_graph(graph_type, size):
+def nx_graph(graph_type, size, seed=None):
     if graph_type == 'random_tree':
-        graph = nx.random_tree(size)
+        # random_tree was removed in networkx 3.4
+        random_tree = getattr(nx, 'random_labeled_tree', None) or nx.random_tree
+        graph = random_tree(size, seed=seed)
     elif graph_type == 'complete_graph':
         graph = nx.complete_graph(size)
     elif graph_type == 'cycle_graph':
@@ -45,100 +43,95 @@ def nx_graph(graph_type, size):
         graph = nx.ladder_graph(size)
     return graph
 
-def run_tora_test(graph_type, size, destination_id=7, source_id=0, save_graph=False):
-    global results_dir
-
-    # graph = nx.random_tree(size)
-    graph = nx_graph(graph_type, size)
-    if save_graph:
-        nx.draw(graph, with_labels=True, font_weight="bold")
-        plt.draw()
-        plt.savefig(f"{results_dir}/size_{size}/InitialGraph.png")
-        plt.close()
-
-    time_list = []
+def timed_tora_run(graph, destination_id=7, source_id=0, profiler=None):
+    '''
+    Builds the topology for graph, creates a route from source_id to destination_id and
+    tears the topology down again. Nothing is drawn or written here, so the timings only
+    cover the construction and the routing. A profiler (see TORAProfiler) is attached
+    after the construction.
+    '''
     graph_construction_time = time.time()
-    # print("Graph size: ", graph.number_of_nodes())
     topology = Topology()
+    # Topology keeps nodes and channels in class attributes, give this run its own
+    topology.nodes = {}
+    topology.channels = {}
     topology.construct_from_graph(graph, TORANode, GenericChannel)
-    print("Constructed topology graph with time: ", time.time() - graph_construction_time)
-    time_list.append(time.time() - graph_construction_time)
-    
+    construction_time = time.time() - graph_construction_time
+    print("Constructed topology graph with time: ", construction_time)
+    if profiler is not None:
+        profiler.attach(topology)
+
     destination_height: TORAHeight = TORAHeight(0, 0, 0, 0, destination_id)
-    
+
     topology.start()
     start_time = time.time()
     topology.nodes[destination_id].app_layer.set_height(destination_height)
     topology.nodes[source_id].app_layer.process_query_message(destination_id, source_id)
     print("Waiting for action to complete")
-    end_time = wait_for_action_to_complete()
+    end_time = wait_for_action_to_complete(topology)
     print(f"Routing done. Time to complete: {end_time - start_time}")
-    time_list.append(end_time - start_time)
-    
 
+    result = {
+        'construction_time': construction_time,
+        'routing_time': end_time - start_time,
+        'messages': count_messages(topology)[1],
+        'heights': list(heights(topology)),
+        'edges': all_edges(topology),
+    }
+    topology.exit()
+    return result
+
+def save_graph_figures(graph, result, figures_dir):
+    if not os.path.exists(figures_dir):
+        os.makedirs(figures_dir)
+    nx.draw(graph, with_labels=True, font_weight="bold")
+    plt.draw()
+    plt.savefig(f"{figures_dir}/InitialGraph.png")
+    plt.close()
+
+    # DRAW Final DAG
     dag = nx.DiGraph()
-    for node, height in heights(topology):
+    for node, height in result['heights']:
         dag.add_node(node, label=height)
-    edges = all_edges(topology)
-    dag.add_edges_from(edges)
+    dag.add_edges_from(result['edges'])
 
-    if save_graph:
-        nx.draw(dag, with_labels=True, font_weight="bold", arrows=True)
-        plt.draw()
-        plt.savefig(f"{results_dir}/size_{size}/FinalGraph.png")
-        plt.close()
+    nx.draw(dag, with_labels=True, font_weight="bold", arrows=True)
+    plt.draw()
+    plt.savefig(f"{figures_dir}/FinalGraph.png")
+    plt.close()
 
-    return sum(time_list)
+def run_tora_test(graph_type, size, destination_id=7, source_id=0, save_graph=False, results_dir=None):
+    graph = nx_graph(graph_type, size)
+    result = timed_tora_run(graph, destination_id, source_id)
+    if save_graph:
+        save_graph_figures(graph, result, f"{results_dir}/size_{size}")
+    return result['construction_time'] + result['routing_time']
 
 def main():
+    # Single run from the command line, benchmarkTORA.py runs the whole matrix
+    from benchmarkResults import BenchmarkStore, current_commit, describe
+    from benchmarkTORA import benchmark_run
+
+    topology_size = int(sys.argv[1])
+    graph_type = sys.argv[2]
+    run_no = int(sys.argv[3])
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else topology_size * TOTAL_RUNS + run_no
+    results_dir = f"{benchmark_dir}/{graph_type}"
+
     # setAHCLogLevel(DEBUG)
-    # benchmark_times = []
-    benchmark_dict = {}
-    '''
-    dict = {
-        topo_size = {
-            'times': []
-            'average': float
-        }
-    }
-    '''
-    
-    # Load the benchmark times if they exist
-    if os.path.exists(f"{results_dir}/benchmark_dict.pkl"):
-        with open(f"{results_dir}/benchmark_dict.pkl", "rb") as f:
-            benchmark_dict = pickle.load(f)
-
-    if not os.path.exists(f"{results_dir}/size_{topology_size}"):
-        os.makedirs(f"{results_dir}/size_{topology_size}")
-    
-    # sauce, dest = generate_source_destination(topology_size)
-    if topology_size not in benchmark_dict:
-        benchmark_dict[topology_size] = {}
-        benchmark_dict[topology_size]['times'] = []
-
-    # n = len(benchmark_dict[topology_size]['times'])
-    # Recalculate the whole size again if half-complete
-    # if n != TOTAL_RUNS and n >= 1 :
-    #     benchmark_dict[topology_size]['times'] = []
-
-    # print("Active threads", threading.active_count())
-    sauce, dest = generate_source_destination(topology_size)
+    os.makedirs(benchmark_dir, exist_ok=True)
+    store = BenchmarkStore(f"{benchmark_dir}/results.sqlite")
+
     print(f"====== GRAPH TYPE: {graph_type}, SIZE: {topology_size} ======")
-    print(f"{run_no}: ====== SOURCE: {sauce}, DEST: {dest} ======")
-    set_benchmark_time()
-    temp_time = run_tora_test(graph_type, size=topology_size, source_id=sauce, destination_id=dest, save_graph=True)
-
-    benchmark_dict[topology_size]['times'].append(temp_time)
-    
-    n = len(benchmark_dict[topology_size]['times'])
-    if n == TOTAL_RUNS:
-        total = sum(benchmark_dict[topology_size]['times'])
-        benchmark_dict[topology_size]['average'] = total / n
-        print(f"average of {n} runs: ", benchmark_dict[topology_size]['average'])
-    
-    # benchmark_times.append(sum(temp_time) / 3)
-    with open(f"{results_dir}/benchmark_dict.pkl", "wb") as f:
-        pickle.dump(benchmark_dict, f)
+    result = benchmark_run(graph_type, topology_size, run_no, seed)
+    print(f"{run_no}: ====== SOURCE: {result['source']}, DEST: {result['destination']} ======")
+    store.add_run(result, current_commit())
+    save_graph_figures(nx_graph(graph_type, topology_size, seed), result, f"{results_dir}/size_{topology_size}")
+
+    times = [run['total_time'] for run in store.runs(graph_type) if run['size'] == topology_size]
+    statistics = describe(times)
+    print(f"median of {statistics['n']} runs: {statistics['median']}, p95: {statistics['p95']}")
+    store.close()
 
 
 if __name__ == "__main__":